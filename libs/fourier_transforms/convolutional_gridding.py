@@ -8,7 +8,12 @@ This approach may be extended to include image plane effect such as the w term a
 This module contains functions for performing the gridding process and the inverse degridding process.
 """
 
+import copy
+import functools
+import hashlib
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy
 
@@ -66,9 +71,9 @@ def coordinates2Offset(npixel: int, cx: int, cy: int):
     return (mg[0] - cy) / npixel, (mg[1] - cx) / npixel
 
 
-def anti_aliasing_calculate(shape, oversampling=1, support=3):
+def anti_aliasing_calculate(shape, oversampling=1, support=3, kernel='grdsf', padding=2.0):
     """
-    Compute the prolate spheroidal anti-aliasing function
+    Compute the anti-aliasing (gridding) kernel and the matching gridding correction function
     
     The kernel is to be used in gridding visibility data onto a grid on for degridding from a grid.
     The gridding correction function (gcf) is used to correct the image for decorrelation due to
@@ -76,32 +81,155 @@ def anti_aliasing_calculate(shape, oversampling=1, support=3):
     
     Return the 2D grid correction function (gcf), and the convolving kernel (kernel
 
+    The default kernel is the prolate spheroidal function of grdsf, which is fixed at a support of 3 and is meant
+    for a padding of 2. The families in gridding_kernels ('pswf' and 'kaiser_bessel') take any support, with a
+    shape parameter chosen for the padding, so that a wider kernel can be traded for a smaller padded grid. Their
+    gcf is calculated numerically from the Fourier transform of the kernel.
+
+    The kernel and the 1D factors of the gcf are memoized by their parameters and so are shared between all
+    callers. The kernel is returned read-only: copy before modifying. The 2D gcf is formed from its factors on each
+    call, so that the memoized tables stay small for any size of grid.
+
     See VLA Scientific Memoranda 129, 131, 132
     :param shape: (height, width) pair
     :param oversampling: Number of sub-samples per grid pixel
     :param support: Support of kernel (in pixels) width is 2*support+2
+    :param kernel: Kernel family: 'grdsf' or one of gridding_kernels
+    :param padding: Padding of the grid relative to the image, used to shape the kernel families
+    """
+    assert kernel == 'grdsf' or kernel in gridding_kernels, "Unknown gridding kernel %s" % kernel
+    ny, nx = (int(n) for n in shape)
+    padding = float(padding)
+    if kernel == 'grdsf':
+        gcf1d = _gridding_correction_factor(nx, support, kernel, padding)
+        gcf = numpy.outer(gcf1d, gcf1d)
+        gcf[gcf > 0.0] = gcf.max() / gcf[gcf > 0.0]
+    else:
+        gcf = numpy.outer(_gridding_correction_factor(ny, support, kernel, padding),
+                          _gridding_correction_factor(nx, support, kernel, padding))
+    return gcf, _anti_aliasing_kernel(int(oversampling), support, kernel, padding)
+
+
+@functools.lru_cache(maxsize=64)
+def _gridding_correction_factor(npixel, support, kernel, padding):
+    """ One axis of the gcf for anti_aliasing_calculate (for grdsf, the kernel before inversion)
+    
     """
+    if kernel == 'grdsf':
+        factor, _ = grdsf(numpy.abs(2.0 * coordinates(npixel)))
+    else:
+        factor = gridding_correction(npixel, support, kernel, kernel_shape_parameter(support, padding))
+    factor.flags.writeable = False
+    return factor
+
+
+@functools.lru_cache(maxsize=16)
+def _anti_aliasing_kernel(oversampling, support, kernel, padding):
+    """ Calculate the oversampled kernel for anti_aliasing_calculate
     
-    # 2D Prolate spheroidal angular function is separable
-    ny, nx = shape
-    nu = numpy.abs(2.0 * coordinates(nx))
-    gcf1d, _ = grdsf(nu)
-    gcf = numpy.outer(gcf1d, gcf1d)
-    gcf[gcf > 0.0] = gcf.max() / gcf[gcf > 0.0]
+    """
+    # 2D anti-aliasing functions are separable
+    nu = numpy.arange(-support, +support, 1.0 / oversampling)
+    if kernel == 'grdsf':
+        kernel1d = grdsf(nu / support)[1]
+    else:
+        kernel1d = gridding_kernels[kernel](nu / support, kernel_shape_parameter(support, padding))
     
     s1d = 2 * support + 2
-    nu = numpy.arange(-support, +support, 1.0 / oversampling)
-    kernel1d = grdsf(nu / support)[1]
     l1d = len(kernel1d)
     # Rearrange to get the convolution function isolated by (yf, xf). For this convolution function
     # the result is heavily redundant but it does fit well into the general framework
     kernel4d = numpy.zeros((oversampling, oversampling, s1d, s1d))
-    for yf in range(oversampling):
-        my = range(yf, l1d, oversampling)[::-1]
-        for xf in range(oversampling):
-            mx = range(xf, l1d, oversampling)[::-1]
-            kernel4d[yf, xf, 2:, 2:] = numpy.outer(kernel1d[my], kernel1d[mx])
-    return gcf, (kernel4d / numpy.sum(kernel4d[0, 0, :, :])).astype('complex')
+    m = numpy.array([range(f, l1d, oversampling)[::-1] for f in range(oversampling)])
+    kernel4d[..., 2:, 2:] = kernel1d[m][:, numpy.newaxis, :, numpy.newaxis] * \
+                            kernel1d[m][numpy.newaxis, :, numpy.newaxis, :]
+    kernel4d = (kernel4d / numpy.sum(kernel4d[0, 0, :, :])).astype('complex')
+    kernel4d.flags.writeable = False
+    return kernel4d
+
+
+def kernel_shape_parameter(support, padding=2.0):
+    """ Shape parameter of a gridding kernel for a given support and padding
+    
+    This is the Kaiser-Bessel beta of Beatty, Nishimura and Pauly (2005), "Rapid gridding reconstruction with a
+    minimal oversampling ratio". It is also close to the best bandwidth parameter c of the prolate spheroidal
+    function for the same support and padding.
+
+    :param support: Half width of the kernel in pixels (the full width is 2 * support)
+    :param padding: Padding of the grid relative to the image
+    :return: shape parameter
+    """
+    assert padding > 0.5, "padding must be greater than 0.5"
+    width = 2.0 * support
+    return numpy.pi * numpy.sqrt(max((width / padding) ** 2 * (padding - 0.5) ** 2 - 0.8, 0.0))
+
+
+def pswf(nu, c):
+    """ Prolate spheroidal wave function of order zero, zero outside ]-1, 1[ and normalised to 1 at nu=0
+
+    :param nu: Coordinates in units of the half width of the kernel
+    :param c: Bandwidth parameter, see kernel_shape_parameter
+    :return: kernel values
+    """
+    import scipy.special
+    nu = numpy.asarray(nu, dtype='float')
+    inside = numpy.abs(nu) < 1.0
+    # pro_ang1 is not defined at the end points
+    values = scipy.special.pro_ang1(0, 0, c, numpy.clip(nu, -0.9999999, 0.9999999))[0]
+    return numpy.where(inside, values / scipy.special.pro_ang1(0, 0, c, 0.0)[0], 0.0)
+
+
+def kaiser_bessel(nu, beta):
+    """ Kaiser-Bessel function, zero outside [-1, 1] and normalised to 1 at nu=0
+
+    :param nu: Coordinates in units of the half width of the kernel
+    :param beta: Shape parameter, see kernel_shape_parameter
+    :return: kernel values
+    """
+    import scipy.special
+    nu = numpy.asarray(nu, dtype='float')
+    inside = numpy.abs(nu) <= 1.0
+    return numpy.where(inside, scipy.special.i0(beta * numpy.sqrt(numpy.where(inside, 1.0 - nu * nu, 0.0))), 0.0) / \
+        scipy.special.i0(beta)
+
+
+gridding_kernels = {'pswf': pswf, 'kaiser_bessel': kaiser_bessel}
+
+
+def gridding_kernel_integral(kernel, support, beta):
+    """ Integral in pixels of one of gridding_kernels over its support
+    
+    The kernel divided by this has unit integral, so that gridding_correction is its gridding correction.
+
+    :param kernel: Name of the kernel in gridding_kernels
+    :param support: Half width of the kernel in pixels
+    :param beta: Shape parameter of the kernel
+    :return: integral
+    """
+    nodes, weights = numpy.polynomial.legendre.leggauss(4 * support + 32)
+    return support * numpy.sum(weights * gridding_kernels[kernel](nodes, beta))
+
+
+def gridding_correction(npixel, support, kernel, beta):
+    """ Gridding correction function along one axis for one of gridding_kernels
+    
+    This is the reciprocal of the Fourier transform of the kernel at the pixels of a centred image of npixel
+    pixels, calculated by Gauss-Legendre quadrature and normalised to 1 at the centre. Pixels where the transform
+    is not positive are set to zero, as for grdsf.
+
+    :param npixel: Number of (padded) image pixels
+    :param support: Half width of the kernel in pixels
+    :param kernel: Name of the kernel in gridding_kernels
+    :param beta: Shape parameter of the kernel
+    :return: correction [npixel]
+    """
+    nodes, weights = numpy.polynomial.legendre.leggauss(4 * support + 32)
+    wf = weights * gridding_kernels[kernel](nodes, beta)
+    x = coordinates(npixel)
+    ft = numpy.sum(wf * numpy.cos(2.0 * numpy.pi * support * x[:, numpy.newaxis] * nodes), axis=1)
+    gcf = numpy.zeros_like(ft)
+    gcf[ft > 0.0] = numpy.sum(wf) / ft[ft > 0.0]
+    return gcf
 
 
 def grdsf(nu):
@@ -183,6 +311,83 @@ def w_beam(npixel, field_of_view, w, cx=None, cy=None, remove_shift=False):
     return cp
 
 
+def w_beams(npixel, field_of_view, w, cx=None, cy=None, resync=16):
+    """ W beams for a sequence of evenly spaced w, generated by recurrence
+
+    The w beam is an exponential in w, so w_beam(w + dw) = w_beam(w) * w_beam(dw). Each beam after the first
+    is the previous one times the beam for the spacing dw: one complex multiplication per pixel instead of a
+    square root and an exponential. Every resync beams the beam is evaluated exactly, which bounds the rounding
+    error of the recurrence at about resync * 1e-16. If w is not evenly spaced every beam is evaluated exactly.
+
+    :param npixel: Size of the grid in pixels
+    :param field_of_view: Field of view
+    :param w: Sequence of baseline distances to the projection plane
+    :param cx: location of delay centre def :npixel//2
+    :param cy: location of delay centre def :npixel//2
+    :param resync: Number of beams between exact evaluations
+    :return: generator of npixel x npixel arrays, as w_beam, one for each w
+    """
+    w = numpy.atleast_1d(numpy.asarray(w, dtype='float'))
+    ly, mx = coordinates2Offset(npixel, cx, cy)
+    mx *= field_of_view
+    ly *= field_of_view
+    r2 = ly ** 2 + mx ** 2
+    inside = r2 < 1.0
+    # Phase per unit w
+    ph = 1 - numpy.sqrt(1.0 - r2[inside])
+
+    def exact(wk):
+        cp = numpy.zeros(r2.shape, dtype='complex')
+        cp[inside] = numpy.exp(-2j * numpy.pi * wk * ph)
+        return cp
+
+    step = None
+    if len(w) > 1 and w[1] != w[0] and numpy.allclose(numpy.diff(w), w[1] - w[0], rtol=1e-9, atol=0.0):
+        step = exact(w[1] - w[0])
+    beam = None
+    for k, wk in enumerate(w):
+        if step is None or k % resync == 0:
+            beam = exact(wk)
+        else:
+            beam = beam * step
+        yield beam
+
+
+def w_kernel(npixel, field_of_view, w, oversampling, kernelwidth, gcf=None, cx=None, cy=None, remove_shift=False):
+    """ Oversampled w convolution kernel, evaluated only on the kernel support
+    
+    This gives the same kernel as padding the w beam (divided by gcf) to oversampling * npixel, transforming,
+    and extracting the kernel with convert_image_to_kernel. Rather than the full oversampled transform, the
+    oversampling * kernelwidth samples needed along each axis are evaluated directly as two matrix
+    products with the w beam. The cost is O(oversampling * kernelwidth * npixel**2) in time and
+    O(npixel**2) in memory instead of O((oversampling * npixel)**2).
+    
+    :param npixel: Size of the grid in pixels
+    :param field_of_view: Field of view
+    :param w: Baseline distance to the projection plane
+    :param oversampling: Oversampling factor
+    :param kernelwidth: Kernel width
+    :param gcf: Gridding correction function to be divided into the w beam (npixel x npixel)
+    :param cx: location of delay centre def :npixel//2
+    :param cy: location of delay centre def :npixel//2
+    :param remove_shift: Remove overall phase shift at the centre of the image
+    :return: numpy.ndarray[oversampling, oversampling, kernelwidth, kernelwidth]
+    """
+    assert oversampling * kernelwidth < oversampling * npixel, "Specified kernel width %d too large" % kernelwidth
+    screen = w_beam(npixel, field_of_view, w, cx=cx, cy=cy, remove_shift=remove_shift)
+    if gcf is not None:
+        screen /= gcf
+    # Grid offsets of the kernel samples [oversampling, kernelwidth] in units of 1 / oversampling pixels,
+    # following the ordering used by convert_image_to_kernel
+    u = oversampling * (kernelwidth // 2 - numpy.arange(kernelwidth))[numpy.newaxis, :] + \
+        numpy.arange(oversampling)[:, numpy.newaxis]
+    p = numpy.arange(npixel) - npixel // 2
+    dft = numpy.exp(2j * numpy.pi * numpy.outer(u.flatten(), p) / (oversampling * npixel))
+    kernel = numpy.dot(numpy.dot(dft, screen), dft.T) / npixel ** 2
+    kernel = kernel.reshape([oversampling, kernelwidth, oversampling, kernelwidth])
+    return numpy.ascontiguousarray(kernel.transpose([0, 2, 1, 3]))
+
+
 def frac_coord(npixel, kernel_oversampling, p):
     """ Compute whole and fractional parts of coordinates, rounded to
     kernel_oversampling-th fraction of pixel size
@@ -203,150 +408,994 @@ def frac_coord(npixel, kernel_oversampling, p):
     return flx.astype(int), fracx.astype(int)
 
 
-def convolutional_degrid(kernel_list, vshape, uvgrid, vuvwmap, vfrequencymap):
+def separate_kernel(kernel, tolerance=1e-12):
+    """ Find the real 1D factors of an oversampled kernel, if it is real and separable
+    
+    A separable kernel (such as the prolate spheroidal kernel from anti_aliasing_calculate) satisfies
+    kernel[yf, xf, j, i] = ky[yf, j] * kx[xf, i] for real ky, kx.
+    
+    :param kernel: Oversampled kernel [oversampling, oversampling, gh, gw]
+    :param tolerance: Maximum error relative to the kernel peak
+    :return: (ky [oversampling, gh], kx [oversampling, gw]) or None if the kernel is not real and separable
+    """
+    peak = numpy.max(numpy.abs(kernel))
+    if peak == 0.0 or numpy.max(numpy.abs(numpy.imag(kernel))) > tolerance * peak:
+        return None
+    kernel = numpy.real(kernel)
+    y0, x0, j0, i0 = numpy.unravel_index(numpy.argmax(numpy.abs(kernel)), kernel.shape)
+    ky = numpy.ascontiguousarray(kernel[:, x0, :, i0])
+    kx = numpy.ascontiguousarray(kernel[y0, :, j0, :] / kernel[y0, x0, j0, i0])
+    separated = ky[:, numpy.newaxis, :, numpy.newaxis] * kx[numpy.newaxis, :, numpy.newaxis, :]
+    if numpy.max(numpy.abs(separated - kernel)) > tolerance * peak:
+        return None
+    return ky, kx
+
+
+class GriddingPlan:
+    """ Precomputed grid coordinates for a set of visibilities
+
+    Holds everything that convolutional_grid and convolutional_degrid derive from the uvw and
+    frequencies of the visibilities: the flat index of the kernel corner in the grid, the oversampled
+    kernel offsets, the kernel index and the image channel of each row. uvw, frequencies and image
+    geometry do not change between major cycles so one plan can be used for all of them.
+    """
+    
+    def __init__(self, kernel_list, shape, vuvwmap, vfrequencymap, padding=1, separable=True):
+        """ Calculate the plan
+        
+        If there is only one kernel and it is real and separable (as for the prolate spheroidal kernel used
+        when there are no w kernels) the 1D factors are kept in separable, and the gridder backends apply
+        them along u and v instead of using the 2D complex kernel.
+        
+        :param kernel_list: (kernel indices, list of oversampled convolution kernels)
+        :param shape: Shape of the uv grid [nchan, npol, ny, nx]
+        :param vuvwmap: map uvw to grid fractions
+        :param vfrequencymap: map frequency to image channels
+        :param padding: Padding of the grid relative to the image (for reference only)
+        :param separable: Use the 1D factors of a separable kernel
+        """
+        kernel_indices, kernels = kernel_list
+        kernel_oversampling, _, gh, gw = kernels[0].shape
+        assert gh % 2 == 0, "Convolution kernel must have even number of pixels"
+        assert gw % 2 == 0, "Convolution kernel must have even number of pixels"
+        inchan, inpol, ny, nx = shape
+        
+        self.kernel_list = kernel_list
+        self.shape = tuple(shape)
+        self.padding = padding
+        
+        # uvw -> fraction of grid mapping
+        self.y, self.yf = frac_coord(ny, kernel_oversampling, vuvwmap[:, 1])
+        self.y -= gh // 2
+        self.x, self.xf = frac_coord(nx, kernel_oversampling, vuvwmap[:, 0])
+        self.x -= gw // 2
+        self.chan = numpy.array(vfrequencymap, dtype='int')
+        self.nvis = len(self.chan)
+        
+        # Flat index of the kernel corner for each row in the [nchan, npol, ny, nx] grid, and the offsets
+        # of the kernel pixels relative to that corner
+        self.corner = (self.chan * inpol * ny + self.y) * nx + self.x
+        self.offsets = (numpy.arange(gh)[:, numpy.newaxis] * nx + numpy.arange(gw)[numpy.newaxis, :]).ravel()
+        
+        if len(kernels) > 1:
+            self.kernels = numpy.array(kernels)
+            self.kind = numpy.array(kernel_indices, dtype='int')
+        else:
+            # This is the usual case. All rows use the first kernel
+            self.kernels = kernels[0][numpy.newaxis, ...]
+            self.kind = numpy.zeros([self.nvis], dtype='int')
+        self.separable = None
+        if separable and len(kernels) == 1:
+            self.separable = separate_kernel(kernels[0])
+        # Rows whose visibilities are conjugated before gridding and after degridding (see half_plane)
+        self.conjugate = None
+        self._reset_caches()
+    
+    @property
+    def ckernels(self):
+        """ Conjugate kernels, as needed for degridding. Calculated once on first use
+        """
+        if self._ckernels is None:
+            self._ckernels = numpy.conjugate(self.kernels)
+        return self._ckernels
+    
+    def kernel_arrays(self, dtype='complex', separable=False, degrid=False):
+        """ The kernels in the precision of a grid, as needed by the gridder backends
+        
+        The result is calculated once for each precision.
+        
+        :param dtype: dtype of the grid e.g. 'complex' or 'complex64'
+        :param separable: Get the real 1D factors of a separable kernel
+        :param degrid: Get the conjugate kernels
+        :return: kernels [nkernels, oversampling, oversampling, kernel pixels], or (ky, kx) if separable
+        """
+        key = (numpy.dtype(dtype), separable, degrid and not separable)
+        if key not in self._kernel_arrays:
+            if separable:
+                realtype = numpy.finfo(dtype).dtype
+                arrays = tuple(k.astype(realtype, copy=False) for k in self.separable)
+            else:
+                kernels = self.ckernels if degrid else self.kernels
+                arrays = kernels.reshape(kernels.shape[:3] + (-1,)).astype(dtype, copy=False)
+            self._kernel_arrays[key] = arrays
+        return self._kernel_arrays[key]
+    
+    @property
+    def kernel_shape(self):
+        return self.kernels.shape[-2:]
+    
+    def tiles(self, tile_size):
+        """ Bucket the visibility rows by the uv tile holding their kernel corner
+        
+        The grid is divided into square tiles of side tile_size. A kernel with its corner in a tile may extend
+        beyond the tile by up to the kernel width (the halo). Within a tile the rows keep their original order.
+        The result is calculated once per tile size.
+        
+        :param tile_size: Side of tile in grid pixels
+        :return: list of (y0, x0, rows) for the occupied tiles, in a fixed order
+        """
+        if tile_size not in self._tiles:
+            _, _, ny, nx = self.shape
+            ntx = (nx + tile_size - 1) // tile_size
+            tile = (self.y // tile_size) * ntx + self.x // tile_size
+            order = numpy.argsort(tile, kind='mergesort')
+            utiles, starts = numpy.unique(tile[order], return_index=True)
+            bucketed = numpy.split(order, starts[1:])
+            self._tiles[tile_size] = [((t // ntx) * tile_size, (t % ntx) * tile_size, rows)
+                                      for t, rows in zip(utiles, bucketed)]
+        return self._tiles[tile_size]
+    
+    def sparse_operator_bytes(self, dtype='complex'):
+        """ Approximate size in bytes of the sparse gridding operator (see sparse_operator)
+        
+        :param dtype: dtype of the grid
+        :return: size in bytes
+        """
+        inchan, inpol, ny, nx = self.shape
+        nnz = self.nvis * len(self.offsets)
+        itemsize = numpy.finfo(dtype).dtype.itemsize if self.separable is not None else numpy.dtype(dtype).itemsize
+        indexsize = 4 if max(nnz, inchan * ny * nx) < 2 ** 31 else 8
+        return nnz * (itemsize + indexsize) + (inchan * ny * nx + 1) * indexsize
+    
+    def sparse_operator(self, dtype='complex', degrid=False):
+        """ The gridding of this plan as a scipy.sparse CSR matrix
+        
+        Gridding is a fixed linear map from the visibility rows to the pixels of one polarisation of the grid,
+        the same for all polarisations. The matrix has shape [nchan * ny * nx, nvis], so that one polarisation
+        is gridded by a single sparse matrix-vector product. The degridding operator is its conjugate
+        transpose, held separately as a CSR matrix of shape [nvis, nchan * ny * nx]. Rows that are conjugated
+        (see half_plane) are handled by the caller, as for the gridder backends.
+        
+        The matrices are calculated once for each precision and kept in the plan, so that they are reused in
+        every major cycle. They take about sparse_operator_bytes each: see convolutional_grid for the limit.
+        
+        :param dtype: dtype of the grid e.g. 'complex' or 'complex64'. Real separable kernels give a real matrix
+        :param degrid: Get the degridding operator
+        :return: scipy.sparse.csr_matrix
+        """
+        import scipy.sparse
+        key = (numpy.dtype(dtype), degrid)
+        if key not in self._sparse:
+            if degrid:
+                operator = self.sparse_operator(dtype).conj().T.tocsr()
+            else:
+                inchan, inpol, ny, nx = self.shape
+                npatch = len(self.offsets)
+                if self.separable is not None:
+                    ky, kx = self.kernel_arrays(dtype, separable=True)
+                    patches = ky[self.yf][:, :, numpy.newaxis] * kx[self.xf][:, numpy.newaxis, :]
+                else:
+                    patches = self.kernel_arrays(dtype)[self.kind, self.yf, self.xf]
+                # Flat index of each kernel pixel in the [nchan, ny, nx] grid of one polarisation
+                pixels = self.corner[:, numpy.newaxis] + self.offsets[numpy.newaxis, :] - \
+                    (self.chan * (inpol - 1) * ny * nx)[:, numpy.newaxis]
+                rows = numpy.repeat(numpy.arange(self.nvis), npatch)
+                operator = scipy.sparse.csr_matrix((patches.reshape([-1]), (pixels.reshape([-1]), rows)),
+                                                   shape=(inchan * ny * nx, self.nvis))
+            self._sparse[key] = operator
+        return self._sparse[key]
+    
+    def release_caches(self):
+        """ Drop the kernel arrays, tiles, sparse operators, partitions and derived plans kept with this plan
+        
+        They are calculated again when next needed. The grid coordinates and kernels are kept.
+        """
+        self._reset_caches()
+    
+    def _reset_caches(self, keep=()):
+        """ Empty the caches that are filled on first use, apart from those named in keep
+        
+        A plan derived from another (see select, with_kernels, with_polarisations and half_plane) starts as a
+        copy of it, and keeps shared only the caches that are still valid for it.
+        
+        :param keep: Names of the caches to keep
+        """
+        for name in ['_kernel_arrays', '_tiles', '_sparse', '_partitions', '_kernel_plans', '_polarisation_plans']:
+            if name not in keep:
+                setattr(self, name, dict())
+        for name in ['_ckernels', '_half_plane']:
+            if name not in keep:
+                setattr(self, name, None)
+    
+    def select(self, rows):
+        """ Plan for a subset of the visibility rows
+
+        The kernels, and the kernel arrays calculated so far, are shared with this plan.
+
+        :param rows: Indices of the rows
+        :return: GriddingPlan for rows
+        """
+        sub = copy.copy(self)
+        for name in ['y', 'yf', 'x', 'xf', 'chan', 'corner', 'kind', 'conjugate']:
+            if getattr(self, name) is not None:
+                setattr(sub, name, getattr(self, name)[rows])
+        sub.nvis = len(sub.chan)
+        sub._reset_caches(keep=['_ckernels', '_kernel_arrays'])
+        return sub
+
+    def partition(self, labels):
+        """ Split the rows into groups with the same label e.g. the w plane of each row
+
+        The rows are sorted by label in one pass, keeping their original order within a group, and a plan is
+        made for each group (see select). The result is calculated once for each labelling, so that the plans
+        of the groups, with their tiles and sparse operators, are reused in later major cycles.
+
+        :param labels: Integer label of each row
+        :return: list of (label, rows, GriddingPlan) for the labels present, in increasing order of label
+        """
+        labels = numpy.asarray(labels)
+        assert labels.shape == (self.nvis,), "Need one label per row"
+        key = hashlib.sha1(numpy.ascontiguousarray(labels).tobytes()).hexdigest()
+        if key not in self._partitions:
+            order = numpy.argsort(labels, kind='mergesort')
+            ulabels, starts = numpy.unique(labels[order], return_index=True)
+            self._partitions[key] = [(label, rows, self.select(rows))
+                                     for label, rows in zip(ulabels, numpy.split(order, starts[1:]))]
+        return self._partitions[key]
+    
+    def with_kernels(self, key, kernel_list):
+        """ Plan for the same rows with other kernels of the same shape e.g. the w kernels of another facet
+        
+        The grid coordinates and kernel index of each row are shared with this plan. The plan is made once for
+        each key, and only then is kernel_list called.
+        
+        :param key: Key identifying the kernels
+        :param kernel_list: Function returning (kernel indices, list of oversampled convolution kernels)
+        :return: GriddingPlan with the kernels
+        """
+        if key not in self._kernel_plans:
+            kernel_indices, kernels = kernel_list()
+            assert kernels[0].shape == self.kernels.shape[1:], "Kernels have shape %s, not %s" % \
+                                                               (str(kernels[0].shape), str(self.kernels.shape[1:]))
+            assert len(kernels) == len(self.kernels), "Need %d kernels, not %d" % (len(self.kernels), len(kernels))
+            sub = copy.copy(self)
+            sub.kernel_list = (kernel_indices, kernels)
+            sub.kernels = numpy.array(kernels)
+            if self.separable is not None:
+                sub.separable = separate_kernel(kernels[0])
+            sub._reset_caches()
+            self._kernel_plans[key] = sub
+        return self._kernel_plans[key]
+    
+    def with_polarisations(self, npol):
+        """ Plan for the same rows on a grid with another number of polarisations
+        
+        The extra polarisations may hold other data with the same coordinates, e.g. the PSF alongside the dirty
+        image, so that both are gridded in one pass over the rows: the kernel of each row is evaluated once for
+        all its polarisations. The tiles and sparse operators are the same for every polarisation, so they are
+        shared with this plan. The result is calculated once for each number of polarisations.
+        
+        :param npol: Number of polarisations of the grid
+        :return: GriddingPlan for the grid [nchan, npol, ny, nx]
+        """
+        if npol not in self._polarisation_plans:
+            inchan, inpol, ny, nx = self.shape
+            sub = copy.copy(self)
+            sub.shape = (inchan, npol, ny, nx)
+            sub.corner = (self.chan * npol * ny + self.y) * nx + self.x
+            sub._reset_caches(keep=['_ckernels', '_kernel_arrays', '_tiles', '_sparse'])
+            self._polarisation_plans[npol] = sub
+        return self._polarisation_plans[npol]
+
+    def half_plane(self):
+        """ Plan for gridding onto the u >= 0 half of the grid, as needed for real images
+        
+        The grid of a real image is Hermitian, so a visibility V with kernel K contributes the same to the
+        image as conj(V) with conj(K) at the mirrored pixels. The rows with u < 0 are therefore gridded at
+        their mirrored position with the flipped conjugate kernels, and the visibilities of those rows are
+        conjugated (see conjugate). The grid has shape [nchan, npol, ny + gh, gw + nx // 2 + 1], where
+        column gw is u = 0. The extra rows and columns hold the parts of the kernels that fall past v = ny / 2
+        and u = 0. They are folded into the half grid by fold_half_plane, and filled from it by
+        unfold_half_plane. The kernels of the half plane plan are given by _mirror_kernels.
+        
+        The result is calculated once.
+        
+        :return: GriddingPlan for the half grid
+        """
+        if self._half_plane is None:
+            inchan, inpol, ny, nx = self.shape
+            gh, gw = self.kernel_shape
+            half = copy.copy(self)
+            half.shape = (inchan, inpol, ny + gh, gw + nx // 2 + 1)
+            # A mirrored kernel patch starts at the mirror of the last pixel of the original patch
+            mirror = self.x + gw // 2 < nx // 2
+            half.y, half.x, half.conjugate = half_plane_coordinates(ny, nx, self.y + (gh - 1) * mirror,
+                                                                    self.x + (gw - 1) * mirror, mirror)
+            half.x += gw
+            half.corner = (self.chan * inpol * half.shape[2] + half.y) * half.shape[3] + half.x
+            half.offsets = (numpy.arange(gh)[:, numpy.newaxis] * half.shape[3] +
+                            numpy.arange(gw)[numpy.newaxis, :]).ravel()
+            half.kernels, half.kind, half.separable = self._mirror_kernels(mirror)
+            half._reset_caches()
+            self._half_plane = half
+        return self._half_plane
+    
+    def _mirror_kernels(self, mirror):
+        """ Kernels for the half plane plan: the mirrored rows use the flipped conjugate kernels
+        
+        :param mirror: Rows to mirror
+        :return: kernels, kernel index of each row, separable factors (None)
+        """
+        kernels = numpy.concatenate([self.kernels, numpy.conjugate(self.kernels[..., ::-1, ::-1])])
+        return kernels, self.kind + len(self.kernels) * mirror, None
+    
+    def check(self, shape, nvis):
+        """ Check that the plan is consistent with a grid shape and number of visibility rows
+        """
+        assert tuple(shape) == self.shape, "Gridding plan is for grid shape %s, not %s" % (str(self.shape),
+                                                                                         str(tuple(shape)))
+        assert nvis == self.nvis, "Gridding plan is for %d rows, not %d" % (self.nvis, nvis)
+
+
+def half_plane_coordinates(ny, nx, y, x, mirror=None):
+    """ Map pixels of a centred grid onto the u >= 0 half grid, using G(-u, -v) = conj(G(u, v))
+    
+    In the half grid column 0 is u = 0, as for rfft. Pixels with u < 0 (or those selected by mirror) are
+    mirrored through the grid centre, and their values must be conjugated.
+    
+    :param ny: Number of rows of the grid
+    :param nx: Number of columns of the grid
+    :param y: Row of each pixel
+    :param x: Column of each pixel
+    :param mirror: Pixels to mirror (default: those with u < 0)
+    :return: row and column of each pixel in the half grid, mirrored pixels
+    """
+    if mirror is None:
+        mirror = x < nx // 2
+    hy = numpy.where(mirror, (ny - y) % ny, y)
+    hx = numpy.where(mirror, nx - x, x) - nx // 2
+    return hy, hx, mirror
+
+
+def fold_half_plane(hgrid, kernel_shape):
+    """ Fold the extra rows and columns of a half grid, as gridded with GriddingPlan.half_plane
+    
+    The rows past v = ny / 2 wrap round to the top and the columns u < 0 are mirrored and conjugated. The
+    interior columns are halved, giving the Hermitian part of the full grid as needed by irfft.
+    
+    :param hgrid: Half grid [nchan, npol, ny + gh, gw + nx // 2 + 1] (changed in place)
+    :param kernel_shape: Kernel shape (gh, gw)
+    :return: view of hgrid [nchan, npol, ny, nx // 2 + 1]
+    """
+    gh, gw = kernel_shape
+    ny = hgrid.shape[-2] - gh
+    nxh = hgrid.shape[-1] - gw
+    assert gw < nxh, "Kernel is too wide for the half grid"
+    hgrid[..., :gh, :] += hgrid[..., ny:, :]
+    rows = (ny - numpy.arange(ny)) % ny
+    cols = numpy.arange(gw)
+    hgrid[..., :ny, 2 * gw - cols] += numpy.conjugate(hgrid[..., :ny, cols][..., rows, :])
+    half = hgrid[..., :ny, gw:]
+    half[..., 1:nxh - 1] *= 0.5
+    return half
+
+
+def unfold_half_plane(half, hgrid, kernel_shape):
+    """ Copy a half grid, as from rfft, to a grid for degridding with GriddingPlan.half_plane
+    
+    This is the reverse of fold_half_plane: the extra rows and columns are filled from the Hermitian
+    symmetry of the grid.
+    
+    :param half: Half grid [nchan, npol, ny, nx // 2 + 1]
+    :param hgrid: Grid to fill [nchan, npol, ny + gh, gw + nx // 2 + 1]
+    :param kernel_shape: Kernel shape (gh, gw)
+    :return: hgrid
+    """
+    gh, gw = kernel_shape
+    ny = half.shape[-2]
+    assert hgrid.shape[-2:] == (ny + gh, gw + half.shape[-1]), "Half grid shape %s does not match %s" % \
+                                                                (str(hgrid.shape), str(half.shape))
+    hgrid[..., :ny, gw:] = half
+    rows = (ny - numpy.arange(ny)) % ny
+    cols = numpy.arange(gw)
+    hgrid[..., :ny, cols] = numpy.conjugate(hgrid[..., :ny, 2 * gw - cols][..., rows, :])
+    hgrid[..., ny:, :] = hgrid[..., :gh, :]
+    return hgrid
+
+
+def numpy_grid_rows(flatgrid, corner, offsets, kernels, kind, yf, xf, viswt, polstride):
+    """ Grid a block of rows using numpy scatter-add (the reference gridder backend)
+    
+    :param flatgrid: Flattened grid to add to
+    :param corner: Flat index in the grid of the kernel corner of each row
+    :param offsets: Flat offsets of the kernel pixels relative to the corner
+    :param kernels: Kernels [nkernels, oversampling, oversampling, kernel pixels]
+    :param kind: Kernel index of each row
+    :param yf: Fractional v offset of each row
+    :param xf: Fractional u offset of each row
+    :param viswt: Weighted visibilities [nrows, npol]
+    :param polstride: Separation of the polarisations in flatgrid
+    """
+    indices = corner[:, numpy.newaxis] + offsets[numpy.newaxis, :]
+    patches = kernels[kind, yf, xf]
+    for pol in range(viswt.shape[1]):
+        numpy.add.at(flatgrid, indices + pol * polstride, patches * viswt[:, pol, numpy.newaxis])
+
+
+def numpy_degrid_rows(flatgrid, corner, offsets, ckernels, kind, yf, xf, vis, polstride):
+    """ Degrid a block of rows using a numpy gather (the reference degridder backend)
+    
+    :param flatgrid: Flattened grid to degrid from
+    :param corner: Flat index in the grid of the kernel corner of each row
+    :param offsets: Flat offsets of the kernel pixels relative to the corner
+    :param ckernels: Conjugate kernels [nkernels, oversampling, oversampling, kernel pixels]
+    :param kind: Kernel index of each row
+    :param yf: Fractional v offset of each row
+    :param xf: Fractional u offset of each row
+    :param vis: Visibilities to fill [nrows, npol]
+    :param polstride: Separation of the polarisations in flatgrid
+    """
+    indices = corner[:, numpy.newaxis] + offsets[numpy.newaxis, :]
+    patches = ckernels[kind, yf, xf]
+    for pol in range(vis.shape[1]):
+        vis[:, pol] = numpy.einsum('ij,ij->i', flatgrid[indices + pol * polstride], patches)
+
+
+def numpy_grid_rows_separable(flatgrid, corner, offsets, ky, kx, yf, xf, viswt, polstride):
+    """ Grid a block of rows with a real separable kernel using numpy scatter-add
+    
+    The arguments are as for numpy_grid_rows except that the kernel is given by its 1D factors
+    
+    :param ky: Kernel along v [oversampling, gh]
+    :param kx: Kernel along u [oversampling, gw]
+    """
+    indices = corner[:, numpy.newaxis] + offsets[numpy.newaxis, :]
+    nrows = corner.shape[0]
+    patches = (ky[yf][:, :, numpy.newaxis] * kx[xf][:, numpy.newaxis, :]).reshape([nrows, -1])
+    for pol in range(viswt.shape[1]):
+        numpy.add.at(flatgrid, indices + pol * polstride, patches * viswt[:, pol, numpy.newaxis])
+
+
+def numpy_degrid_rows_separable(flatgrid, corner, offsets, ky, kx, yf, xf, vis, polstride):
+    """ Degrid a block of rows with a real separable kernel using a numpy gather
+    
+    The grid patches are reduced along v and then u. The arguments are as for numpy_degrid_rows except that
+    the kernel is given by its 1D factors
+    
+    :param ky: Kernel along v [oversampling, gh]
+    :param kx: Kernel along u [oversampling, gw]
+    """
+    indices = corner[:, numpy.newaxis] + offsets[numpy.newaxis, :]
+    nrows = corner.shape[0]
+    gh, gw = ky.shape[1], kx.shape[1]
+    rky = ky[yf][:, numpy.newaxis, :]
+    rkx = kx[xf]
+    for pol in range(vis.shape[1]):
+        patches = flatgrid[indices + pol * polstride].reshape([nrows, gh, gw])
+        vis[:, pol] = numpy.einsum('ri,ri->r', numpy.matmul(rky, patches)[:, 0, :], rkx)
+
+
+def loop_grid_rows(flatgrid, corner, offsets, kernels, kind, yf, xf, viswt, polstride):
+    """ Grid a block of rows with explicit loops. This is compiled by numba for the numba backend.
+    
+    The arguments are as for numpy_grid_rows
+    """
+    for row in range(corner.shape[0]):
+        for pol in range(viswt.shape[1]):
+            v = viswt[row, pol]
+            start = corner[row] + pol * polstride
+            for k in range(offsets.shape[0]):
+                flatgrid[start + offsets[k]] += kernels[kind[row], yf[row], xf[row], k] * v
+
+
+def loop_degrid_rows(flatgrid, corner, offsets, ckernels, kind, yf, xf, vis, polstride):
+    """ Degrid a block of rows with explicit loops. This is compiled by numba for the numba backend.
+    
+    The arguments are as for numpy_degrid_rows
+    """
+    for row in range(corner.shape[0]):
+        for pol in range(vis.shape[1]):
+            start = corner[row] + pol * polstride
+            total = 0.0j
+            for k in range(offsets.shape[0]):
+                total += flatgrid[start + offsets[k]] * ckernels[kind[row], yf[row], xf[row], k]
+            vis[row, pol] = total
+
+
+def loop_grid_rows_separable(flatgrid, corner, offsets, ky, kx, yf, xf, viswt, polstride):
+    """ Grid a block of rows with a real separable kernel with explicit loops. This is compiled by numba for the
+    numba backend.
+    
+    The arguments are as for numpy_grid_rows_separable
+    """
+    gh = ky.shape[1]
+    gw = kx.shape[1]
+    for row in range(corner.shape[0]):
+        for pol in range(viswt.shape[1]):
+            start = corner[row] + pol * polstride
+            for j in range(gh):
+                v = ky[yf[row], j] * viswt[row, pol]
+                for i in range(gw):
+                    flatgrid[start + offsets[j * gw + i]] += kx[xf[row], i] * v
+
+
+def loop_degrid_rows_separable(flatgrid, corner, offsets, ky, kx, yf, xf, vis, polstride):
+    """ Degrid a block of rows with a real separable kernel with explicit loops. This is compiled by numba for
+    the numba backend.
+    
+    The arguments are as for numpy_degrid_rows_separable
+    """
+    gh = ky.shape[1]
+    gw = kx.shape[1]
+    for row in range(corner.shape[0]):
+        for pol in range(vis.shape[1]):
+            start = corner[row] + pol * polstride
+            total = 0.0j
+            for j in range(gh):
+                subtotal = 0.0j
+                for i in range(gw):
+                    subtotal += flatgrid[start + offsets[j * gw + i]] * kx[xf[row], i]
+                total += subtotal * ky[yf[row], j]
+            vis[row, pol] = total
+
+
+# Gridder backends: name -> (grid rows function, degrid rows function)
+gridder_backends = {'numpy': (numpy_grid_rows, numpy_degrid_rows)}
+# Separable kernel versions: name -> (grid rows function, degrid rows function)
+separable_gridder_backends = {'numpy': (numpy_grid_rows_separable, numpy_degrid_rows_separable)}
+
+
+def register_gridder_backend(name, grid_rows, degrid_rows, grid_rows_separable=None, degrid_rows_separable=None):
+    """ Register a gridder backend
+    
+    The functions must have the same arguments as numpy_grid_rows and numpy_degrid_rows, and, if given, as
+    numpy_grid_rows_separable and numpy_degrid_rows_separable. This allows e.g. a compiled extension to
+    provide the inner loops. A backend without separable functions uses the 2D kernel for separable kernels.
+    
+    :param name: Name of backend
+    :param grid_rows: Function to grid a block of rows
+    :param degrid_rows: Function to degrid a block of rows
+    :param grid_rows_separable: Function to grid a block of rows with a separable kernel
+    :param degrid_rows_separable: Function to degrid a block of rows with a separable kernel
+    """
+    gridder_backends[name] = (grid_rows, degrid_rows)
+    if grid_rows_separable is not None and degrid_rows_separable is not None:
+        separable_gridder_backends[name] = (grid_rows_separable, degrid_rows_separable)
+    else:
+        separable_gridder_backends.pop(name, None)
+
+
+try:
+    import numba
+    register_gridder_backend('numba', numba.njit(nogil=True)(loop_grid_rows),
+                             numba.njit(nogil=True)(loop_degrid_rows),
+                             numba.njit(nogil=True)(loop_grid_rows_separable),
+                             numba.njit(nogil=True)(loop_degrid_rows_separable))
+except ImportError:
+    pass
+
+
+def get_gridder_backend(name=None, separable=False):
+    """ Get the grid and degrid functions of a gridder backend
+    
+    If name is None, the environment variable ARL_GRIDDER is used, and failing that 'numpy'. If the backend
+    is not available (e.g. numba is not installed) the numpy backend is used.
+    
+    :param name: Name of backend e.g. 'numpy', 'numba'
+    :param separable: Get the functions for separable kernels
+    :return: (grid rows function, degrid rows function), or None if separable and the backend has no
+        separable functions
+    """
+    if name is None:
+        name = os.getenv('ARL_GRIDDER', 'numpy')
+    if name not in gridder_backends:
+        log.warning("get_gridder_backend: gridder backend %s is not available, using numpy" % name)
+        name = 'numpy'
+    if separable:
+        return separable_gridder_backends.get(name, None)
+    return gridder_backends[name]
+
+
+def _kernel_arguments(plan, gridder=None, degrid=False, dtype='complex'):
+    """ Select the backend function and kernel arguments for a gridding plan
+    
+    :param plan: GriddingPlan
+    :param gridder: Name of gridder backend
+    :param degrid: Degridding?
+    :param dtype: dtype of the grid
+    :return: rows function, function giving the kernel arguments for rows (kernels and kind, or ky and kx)
+    """
+    if plan.separable is not None:
+        backend = get_gridder_backend(gridder, separable=True)
+        if backend is None and plan.kernels is None:
+            # The plan has only the separable factors, e.g. NUFFTPlan
+            backend = separable_gridder_backends['numpy']
+        if backend is not None:
+            separable = plan.kernel_arrays(dtype, separable=True)
+            return backend[degrid], lambda rows: separable
+    backend = get_gridder_backend(gridder)
+    kernels = plan.kernel_arrays(dtype, degrid=degrid)
+    return backend[degrid], lambda rows: (kernels, plan.kind[rows])
+
+
+# Largest sparse gridding operator (in bytes) that convolutional_grid and convolutional_degrid will build
+sparse_operator_max_bytes = 2 ** 30
+
+
+def _sparse_operator(plan, sparse, dtype, degrid=False):
+    """ The sparse operator of a plan if it has been asked for and is within sparse_operator_max_bytes
+    
+    :return: scipy.sparse.csr_matrix or None to use the gridder backends
+    """
+    if not sparse:
+        return None
+    nbytes = plan.sparse_operator_bytes(dtype)
+    if nbytes > sparse_operator_max_bytes:
+        log.debug("convolutional_grid: sparse operator would need %.1f MB, using gridder backend" %
+                  (nbytes / 2 ** 20))
+        return None
+    return plan.sparse_operator(dtype, degrid=degrid)
+
+
+def convolutional_degrid(kernel_list, vshape, uvgrid, vuvwmap=None, vfrequencymap=None, vis_block=16384, plan=None,
+                         threads=None, gridder=None, sparse=False):
     """Convolutional degridding with frequency and polarisation independent
 
     Takes into account fractional `uv` coordinate values where the GCF
     is oversampled
 
+    The visibilities are processed in blocks of vis_block rows. For each block the kernel sized grid
+    patches of all rows are gathered from the uv grid with one fancy index operation, multiplied by the
+    conjugate kernels and summed. If threads is set, the blocks are shared out to a pool of threads.
+    
+    The degridding is done in the precision of uvgrid (complex or complex64). The visibilities are double.
+
     :param kernel_list: list of oversampled convolution kernel
     :param vshape: Shape of visibility
     :param uvgrid:   The uv plane to de-grid from
     :param vuvwmap: function to map uvw to grid fractions
     :param vfrequencymap: function to map frequency to image channels
+    :param vis_block: Number of visibility rows to degrid at once (bounds the temporary memory)
+    :param plan: GriddingPlan to use instead of kernel_list, vuvwmap, and vfrequencymap
+    :param threads: Number of threads to use (default None: no threads)
+    :param gridder: Name of gridder backend (see get_gridder_backend)
+    :param sparse: Degrid with the sparse operator of the plan (see GriddingPlan.sparse_operator)
     :return: Array of visibilities.
     """
-    kernel_indices, kernels = kernel_list
-    kernel_oversampling, _, gh, gw = kernels[0].shape
-    assert gh % 2 == 0, "Convolution kernel must have even number of pixels"
-    assert gw % 2 == 0, "Convolution kernel must have even number of pixels"
+    if plan is None:
+        plan = GriddingPlan(kernel_list, uvgrid.shape, vuvwmap, vfrequencymap)
+    plan.check(uvgrid.shape, vshape[0])
+    
     inchan, inpol, ny, nx = uvgrid.shape
-    vnpol = vshape[1]
     vis = numpy.zeros(vshape, dtype='complex')
     
-    # uvw -> fraction of grid mapping
-    y, yf = frac_coord(ny, kernel_oversampling, vuvwmap[:, 1])
-    y -= gh // 2
-    x, xf = frac_coord(nx, kernel_oversampling, vuvwmap[:, 0])
-    x -= gw // 2
-    
-    if len(kernels) > 1:
-        coords = kernel_indices, list(vfrequencymap), x, y, xf, yf
-        ckernels = numpy.conjugate(kernels)
-        for pol in range(vnpol):
-            vis[..., pol] = [
-                numpy.sum(uvgrid[chan, pol, yy: yy + gh, xx:xx + gw] * ckernels[kind][yyf, xxf, :, :])
-                for kind, chan, xx, yy, xxf, yyf in zip(*coords)
-            ]
+    operator = _sparse_operator(plan, sparse, uvgrid.dtype, degrid=True)
+    if operator is not None:
+        for pol in range(vshape[-1]):
+            vis[:, pol] = operator @ uvgrid[:, pol].reshape([-1])
+        if plan.conjugate is not None:
+            vis[plan.conjugate] = numpy.conjugate(vis[plan.conjugate])
+        return vis
+    
+    degrid_rows, kernel_args = _kernel_arguments(plan, gridder, degrid=True, dtype=uvgrid.dtype)
+    flatgrid = uvgrid.reshape([-1])
+    
+    def degrid_block(start):
+        rows = slice(start, min(start + vis_block, plan.nvis))
+        degrid_rows(flatgrid, plan.corner[rows], plan.offsets, *kernel_args(rows), plan.yf[rows],
+                    plan.xf[rows], vis[rows], ny * nx)
+    
+    # Each block writes to different rows so the blocks can be done in any order
+    if threads is None or threads <= 1:
+        for start in range(0, plan.nvis, vis_block):
+            degrid_block(start)
     else:
-        # This is the usual case. We trim a bit of time by avoiding the kernel lookup
-        coords = list(vfrequencymap), x, y, xf, yf
-        ckernel0 = numpy.conjugate(kernels[0])
-        for pol in range(vnpol):
-            vis[..., pol] = [
-                numpy.sum(uvgrid[chan, pol, yy: yy + gh, xx: xx + gw] * ckernel0[yyf, xxf, :, :])
-                for chan, xx, yy, xxf, yyf in zip(*coords)
-            ]
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(degrid_block, range(0, plan.nvis, vis_block)))
+    
+    if plan.conjugate is not None:
+        vis[plan.conjugate] = numpy.conjugate(vis[plan.conjugate])
             
-    return numpy.array(vis)
+    return vis
 
 
-def convolutional_grid(kernel_list, uvgrid, vis, visweights, vuvwmap, vfrequencymap):
+def convolutional_grid(kernel_list, uvgrid, vis, visweights, vuvwmap=None, vfrequencymap=None, vis_block=16384,
+                       plan=None, threads=None, tile_size=256, gridder=None, sparse=False, factors=None,
+                       psf_factors=None, psf_phasor=None):
     """Grid after convolving with frequency and polarisation independent gcf
 
     Takes into account fractional `uv` coordinate values where the GCF is oversampled
 
+    The grid is divided into tiles of side tile_size and the visibilities are bucketed by tile. The rows of
+    each tile are processed in blocks of vis_block rows: for each block the flat indices of every kernel pixel
+    are calculated and the kernel weighted visibilities are scatter-added into a buffer for the tile. The tile
+    buffers are added into the grid in a fixed order. If threads is set, the tiles are gridded concurrently by
+    a pool of threads. The result depends on the tile size but is bitwise the same for any number of threads,
+    including none.
+
+    If sparse is set, the gridding is done by the sparse operator of the plan (see GriddingPlan.sparse_operator),
+    one sparse matrix product for all the polarisations. The operator is built on first use and kept in the plan,
+    so this pays off when the plan is reused over major cycles. If the operator would be larger than
+    sparse_operator_max_bytes the gridder backends are used instead. threads and tile_size are then ignored.
+    
+    Several images of the same rows can be gridded in one pass as terms of the grid, each term being npol
+    polarisations of the grid (see GriddingPlan.with_polarisations). Term k of the visibilities grids the
+    weighted visibilities times factors[:, k], e.g. the frequency weighting of a Taylor term. Then term k of
+    the PSF grids the weights times psf_factors[:, k] and psf_phasor, the visibility of a unit point source at
+    the phase centre. The factors are applied to each block of rows as it is gridded, so no copies of the
+    visibilities are made for the terms. The grid then has (nterms + npsfterms) * npol polarisations, with the
+    terms of the visibilities first. The sparse operator grids each term in one product.
+
+    The gridding is done in the precision of uvgrid (complex or complex64). sumwt is always double.
+
     :param kernel_list: List of oversampled convolution kernels
     :param uvgrid: Grid to add to [nchan, npol, npixel, npixel]
     :param vis: Visibility values
     :param visweights: Visibility weights
     :param vuvwmap: map uvw to grid fractions
     :param vfrequencymap: map frequency to image channels
-    :return: uv grid[nchan, npol, ny, nx], sumwt[nchan, npol]
+    :param vis_block: Number of visibility rows to grid at once (bounds the temporary memory)
+    :param plan: GriddingPlan to use instead of kernel_list, vuvwmap, and vfrequencymap
+    :param threads: Number of threads to use for gridding the tiles (default None: no threads)
+    :param tile_size: Side of the uv tiles in pixels
+    :param gridder: Name of gridder backend (see get_gridder_backend)
+    :param sparse: Grid with the sparse operator of the plan
+    :param factors: Real factors [nvis, nterms] of the terms of the visibilities (default None: one term of 1)
+    :param psf_factors: Real factors [nvis, npsfterms] of the terms of the PSF (default None: no PSF terms)
+    :param psf_phasor: Visibility of a unit point source for each row [nvis] (default None: 1)
+    :return: uv grid[nchan, npol, ny, nx], sumwt[nchan, npol] where the sum of weights of each term includes
+        its factors
     """
+    if plan is None:
+        plan = GriddingPlan(kernel_list, uvgrid.shape, vuvwmap, vfrequencymap)
+    plan.check(uvgrid.shape, vis.shape[0])
     
-    kernel_indices, kernels = kernel_list
-    kernel_oversampling, _, gh, gw = kernels[0].shape
-    assert gh % 2 == 0, "Convolution kernel must have even number of pixels"
-    assert gw % 2 == 0, "Convolution kernel must have even number of pixels"
+    grid_rows, kernel_args = _kernel_arguments(plan, gridder, dtype=uvgrid.dtype)
+    operator = _sparse_operator(plan, sparse, uvgrid.dtype)
     inchan, inpol, ny, nx = uvgrid.shape
+    gh, gw = plan.kernel_shape
     
     # Construct output grids (in uv space)
     sumwt = numpy.zeros([inchan, inpol])
     
-    # uvw -> fraction of grid mapping
-    y, yf = frac_coord(ny, kernel_oversampling, vuvwmap[:, 1])
-    y -= gh // 2
-    x, xf = frac_coord(nx, kernel_oversampling, vuvwmap[:, 0])
-    x -= gw // 2
+    nvis = plan.nvis
+    npol = vis.shape[-1]
+    wts = numpy.reshape(visweights, [nvis, npol])
+    viswt = (numpy.reshape(vis, [nvis, npol]) * wts).astype(uvgrid.dtype, copy=False)
+    if plan.conjugate is not None:
+        viswt[plan.conjugate] = numpy.conjugate(viswt[plan.conjugate])
     
-    # About 228k samples per second for standard kernel so about 10 million CMACs per second
+    if factors is None and psf_factors is None:
+        grid_terms = None
+    else:
+        factors = numpy.ones([nvis, 1]) if factors is None else numpy.reshape(factors, [nvis, -1])
+        psf_factors = numpy.zeros([nvis, 0]) if psf_factors is None else numpy.reshape(psf_factors, [nvis, -1])
+        nterms = factors.shape[1]
+        assert inpol == (nterms + psf_factors.shape[1]) * npol, \
+            "Grid has %d polarisations, not %d terms of %d" % (inpol, nterms + psf_factors.shape[1], npol)
+        if psf_phasor is not None and plan.conjugate is not None:
+            psf_phasor = numpy.array(psf_phasor)
+            psf_phasor[plan.conjugate] = numpy.conjugate(psf_phasor[plan.conjugate])
+        
+        def term_viswt(term, rows):
+            # The weighted visibilities of one term for a block of rows
+            if term < nterms:
+                termwt = viswt[rows] * factors[rows, term][:, numpy.newaxis]
+            else:
+                termwt = wts[rows] * psf_factors[rows, term - nterms][:, numpy.newaxis]
+                if psf_phasor is not None:
+                    termwt = termwt * psf_phasor[rows][:, numpy.newaxis]
+            return termwt.astype(uvgrid.dtype, copy=False)
+        
+        def grid_terms(rows):
+            # All the terms for a block of rows, as the polarisations of the grid
+            return numpy.concatenate([term_viswt(term, rows) for term in range(inpol // npol)], axis=1)
     
-    # Now we can loop over all rows
-    wts = visweights[...]
-    viswt = vis[...] * visweights[...]
-    npol = vis.shape[-1]
-
-    if len(kernels) > 1:
-        coords = kernel_indices, list(vfrequencymap), x, y, xf, yf
-        for pol in range(npol):
-            for v, vwt, kind, chan, xx, yy, xxf, yyf in zip(viswt[..., pol], wts[..., pol], *coords):
-                uvgrid[chan, pol, yy: yy + gh, xx: xx + gw] += kernels[kind][yyf, xxf, :, :] * v
-                sumwt[chan, pol] += vwt
+    if operator is not None:
+        # One sparse matrix product grids all the polarisations of a term in one pass over the operator
+        if grid_terms is None:
+            uvgrid += numpy.moveaxis((operator @ viswt).reshape([inchan, ny, nx, npol]), 3, 1)
+        else:
+            for term in range(inpol // npol):
+                uvgrid[:, term * npol:(term + 1) * npol] += numpy.moveaxis(
+                    (operator @ term_viswt(term, slice(None))).reshape([inchan, ny, nx, npol]), 3, 1)
     else:
-        kernel0 = kernels[0]
-        coords = list(vfrequencymap), x, y, xf, yf
+        # Each tile is gridded into its own buffer, including a halo for the kernels that extend past the
+        # tile edge, so the threads never write to shared memory. The buffers are then added into the grid
+        # in a fixed order, so the result does not depend on the number of threads. Without threads one
+        # buffer is used for all the tiles.
+        tshape = [inchan, inpol, tile_size + gh, tile_size + gw]
+        toffsets = (numpy.arange(gh)[:, numpy.newaxis] * tshape[3] + numpy.arange(gw)[numpy.newaxis, :]).ravel()
+        
+        def grid_tile(tile, tilegrid=None):
+            y0, x0, tilerows = tile
+            if tilegrid is None:
+                tilegrid = numpy.zeros(tshape, dtype=uvgrid.dtype)
+            else:
+                tilegrid.fill(0)
+            flattilegrid = tilegrid.reshape([-1])
+            for start in range(0, len(tilerows), vis_block):
+                rows = tilerows[start:start + vis_block]
+                corner = (plan.chan[rows] * inpol * tshape[2] + plan.y[rows] - y0) * tshape[3] + plan.x[rows] - x0
+                grid_rows(flattilegrid, corner, toffsets, *kernel_args(rows), plan.yf[rows], plan.xf[rows],
+                          viswt[rows] if grid_terms is None else grid_terms(rows), tshape[2] * tshape[3])
+            return tilegrid
+        
+        def add_tile(tile, tilegrid):
+            y0, x0, _ = tile
+            y1 = min(y0 + tshape[2], ny)
+            x1 = min(x0 + tshape[3], nx)
+            uvgrid[..., y0:y1, x0:x1] += tilegrid[..., :y1 - y0, :x1 - x0]
+        
+        tiles = plan.tiles(tile_size)
+        if threads is None:
+            tilegrid = numpy.empty(tshape, dtype=uvgrid.dtype)
+            for tile in tiles:
+                add_tile(tile, grid_tile(tile, tilegrid))
+        else:
+            with ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+                for tile, tilegrid in zip(tiles, executor.map(grid_tile, tiles)):
+                    add_tile(tile, tilegrid)
+    
+    if grid_terms is None:
         for pol in range(npol):
-            for v, vwt, chan, xx, yy, xxf, yyf in zip(viswt[..., pol], wts[..., pol], *coords):
-                uvgrid[chan, pol, yy: yy + gh, xx: xx + gw] += kernel0[yyf, xxf, :, :] * v
-                sumwt[chan, pol] += vwt
+            sumwt[:, pol] += numpy.bincount(plan.chan, weights=wts[:, pol], minlength=inchan)
+    else:
+        for term, termfactors in enumerate(numpy.concatenate([factors, psf_factors], axis=1).T):
+            for pol in range(npol):
+                sumwt[:, term * npol + pol] += numpy.bincount(plan.chan, weights=wts[:, pol] * termfactors,
+                                                              minlength=inchan)
 
     return uvgrid, sumwt
 
 
-def weight_gridding(shape, visweights, vuvwmap, vfrequencymap, vpolarisationmap=None, weighting='uniform'):
+weighting_schemes = ['uniform', 'briggs', 'super-uniform', 'super-briggs']
+
+
+def _weighting_cells(shape, vuvwmap, vfrequencymap, weighting='uniform', half_plane=False, field_of_view=None):
+    """ The cells of the density grid for each sample, see weight_gridding
+    
+    :return: shape of density grid, flat cell of each row, flat cells to count, row of each cell to count
+    """
+    if field_of_view is None:
+        field_of_view = 1.0 / 3.0 if weighting.startswith('super-') else 1.0
+    inchan, inpol, ny, nx = shape
+    ny = max(1, int(round(field_of_view * ny)))
+    nx = max(1, int(round(field_of_view * nx)))
+    
+    nvis = len(vfrequencymap)
+    y, _ = frac_coord(ny, 1.0, vuvwmap[:, 1])
+    x, _ = frac_coord(nx, 1.0, vuvwmap[:, 0])
+    chan = numpy.array(vfrequencymap, dtype='int')
+    if half_plane:
+        y, x, _ = half_plane_coordinates(ny, nx, y, x)
+        gridshape = (inchan, inpol, ny, nx // 2 + 1)
+        cell = (chan * ny + y) * gridshape[3] + x
+        # The columns u = 0 and u = nx / 2 are their own mirror images so both copies of those samples are kept
+        edge = numpy.nonzero((x == 0) | (x == nx // 2))[0]
+        cells = numpy.concatenate([cell, (chan[edge] * ny + (ny - y[edge]) % ny) * gridshape[3] + x[edge]])
+        rows = numpy.concatenate([numpy.arange(nvis), edge])
+    else:
+        gridshape = (inchan, inpol, ny, nx)
+        cell = (chan * ny + y) * nx + x
+        my, _ = frac_coord(ny, 1.0, -vuvwmap[:, 1])
+        mx, _ = frac_coord(nx, 1.0, -vuvwmap[:, 0])
+        cells = numpy.concatenate([cell, (chan * ny + my) * nx + mx])
+        rows = numpy.concatenate([numpy.arange(nvis), numpy.arange(nvis)])
+    return gridshape, cell, cells, rows
+
+
+def density_gridding(shape, visweights, vuvwmap, vfrequencymap, weighting='uniform', half_plane=False,
+                     field_of_view=None):
+    """ The density grid for weighting: the sum of the weights of the samples in each cell
+    
+    The density grid is linear in the samples, so the grids of parts of the data for the same image can be summed
+    to give the grid of all the data, and passed to weight_gridding as densitygrid.
+    
+    :param shape: Shape of the uv grid [nchan, npol, ny, nx]
+    :param visweights: Visibility weights
+    :param vuvwmap: map uvw to grid fractions
+    :param vfrequencymap: map frequency to image channels
+    :param weighting: Weighting scheme, see weight_gridding
+    :param half_plane: Keep only the u >= 0 half of the density grid
+    :param field_of_view: Field of view for weighting, as a fraction of the image
+    :return: densitygrid, or None for natural weighting
+    """
+    if weighting not in weighting_schemes:
+        return None
+    gridshape, _, cells, rows = _weighting_cells(shape, vuvwmap, vfrequencymap, weighting, half_plane,
+                                                 field_of_view)
+    inchan, inpol, ny, nxg = gridshape
+    densitygrid = numpy.zeros(gridshape, dtype='float')
+    for pol in range(inpol):
+        grid = numpy.bincount(cells, weights=visweights[rows, pol], minlength=inchan * ny * nxg)
+        densitygrid[:, pol] = grid.reshape([inchan, ny, nxg])
+    return densitygrid
+
+
+def weight_gridding(shape, visweights, vuvwmap, vfrequencymap, vpolarisationmap=None, weighting='uniform',
+                    half_plane=False, robustness=0.0, field_of_view=None, densitygrid=None):
     """Reweight data using one of a number of algorithms
+    
+    The weights are summed in cells of a density grid, using numpy.bincount on the flat cell index of each
+    sample (see density_gridding). The density of samples is symmetric, D(-u, -v) = D(u, v), so each sample is
+    counted at both (u, v) and (-u, -v). If half_plane is True only the u >= 0 half of the density grid is kept,
+    using the same convention as GriddingPlan.half_plane: each sample is counted once, at its mirrored position
+    if u < 0.
+    
+    The schemes are:
+        - 'natural': the weights are not changed
+        - 'uniform': each weight is divided by the density D of its cell
+        - 'briggs': each weight is divided by 1 + D f^2, where f^2 = (5 10^-robustness)^2 / (sum D^2 / sum D)
+          for each channel and polarisation. robustness -2 is close to uniform and 2 close to natural
+        - 'super-uniform' and 'super-briggs': as uniform and briggs, with a default field_of_view of 1/3
+    
+    field_of_view is the field over which the sidelobes are minimised, as a fraction of the image. The density
+    grid has field_of_view times the number of cells of the uv grid on each axis, so that a smaller field of view
+    sums the weights over larger cells.
+    
+    Other schemes are treated as natural. If densitygrid is given, e.g. the sum of the density grids of all the
+    parts of the data, it is used instead of the density grid of visweights.
 
-    :param shape:
+    :param shape: Shape of the uv grid [nchan, npol, ny, nx]
     :param visweights: Visibility weights
     :param vuvwmap: map uvw to grid fractions
     :param vfrequencymap: map frequency to image channels
     :param vpolarisationmap: map polarisation to image polarisation
-    :param weighting: '' | 'uniform'
+    :param weighting: 'natural' | 'uniform' | 'briggs' | 'super-uniform' | 'super-briggs'
+    :param half_plane: Keep only the u >= 0 half of the density grid [nchan, npol, ny, nx // 2 + 1]
+    :param robustness: Briggs robustness
+    :param field_of_view: Field of view for weighting, as a fraction of the image (1, or 1/3 for super-)
+    :param densitygrid: Density grid to use (optional)
     :return: visweights, density, densitygrid
     """
-    densitygrid = numpy.zeros(shape, dtype='float')
-    if weighting == 'uniform':
-        log.info("weight_gridding: Performing uniform weighting")
-        inchan, inpol, ny, nx = shape
-
-        wts = visweights[...]
-        # uvw -> fraction of grid mapping
-        for flip in [-1.0, 1.0]:
-            y, yf = frac_coord(ny, 1.0, flip * vuvwmap[:, 1])
-            x, xf = frac_coord(nx, 1.0, flip * vuvwmap[:, 0])
-            coords = list(vfrequencymap), x, y
-            for pol in range(inpol):
-                for vwt, chan, x, y in zip(wts, *coords):
-                    densitygrid[chan, pol, y, x] += vwt[..., pol]
-                    
-        # Find the total weight per sample counting redundancies with other samples
-        newvisweights = numpy.zeros_like(visweights)
-        density = numpy.zeros_like(visweights)
-        y, _ = frac_coord(ny, 1.0, vuvwmap[:, 1])
-        x, _ = frac_coord(nx, 1.0, vuvwmap[:, 0])
-        coords = list(vfrequencymap), x, y
-        for pol in range(inpol):
-            density[..., pol] += [densitygrid[chan, pol, y, x] for chan, x, y in zip(*coords)]
-
-        # Normalise each visibility weight to sum to one in a grid cell
-        if numpy.sum(density[:, 0] > 0.0) < visweights.shape[0]:
-            log.warning("weight_gridding: Losing samples in weighting")
-            
-        newvisweights[density > 0.0] = visweights[density > 0.0] / density[density > 0.0]
-        return newvisweights, density, densitygrid
-    else:
+    if weighting not in weighting_schemes:
         return visweights, None, None
+    
+    gridshape, cell, cells, rows = _weighting_cells(shape, vuvwmap, vfrequencymap, weighting, half_plane,
+                                                    field_of_view)
+    log.info("weight_gridding: Performing %s weighting on %d x %d cells%s" %
+             (weighting, gridshape[2], gridshape[3], " (half plane)" if half_plane else ""))
+    if densitygrid is None:
+        densitygrid = density_gridding(shape, visweights, vuvwmap, vfrequencymap, weighting, half_plane,
+                                       field_of_view)
+    assert densitygrid.shape == gridshape, "Density grid has shape %s, not %s" % (str(densitygrid.shape),
+                                                                                 str(gridshape))
+    
+    inchan, inpol, ny, nxg = gridshape
+    density = numpy.zeros_like(visweights)
+    for pol in range(inpol):
+        density[:, pol] = densitygrid[:, pol].reshape([-1])[cell]
+    
+    if numpy.sum(density[:, 0] > 0.0) < visweights.shape[0]:
+        log.warning("weight_gridding: Losing samples in weighting")
+    
+    newvisweights = numpy.zeros_like(visweights)
+    if weighting in ['briggs', 'super-briggs']:
+        # The sums are over the full density grid: the columns of a half grid other than u = 0 and u = nx / 2
+        # stand for two columns
+        columns = numpy.ones(nxg)
+        if half_plane:
+            columns[1:nxg - 1] = 2.0
+        sumd = numpy.einsum('cpyx,x->cp', densitygrid, columns)
+        sumd2 = numpy.einsum('cpyx,x->cp', densitygrid ** 2, columns)
+        f2 = numpy.zeros_like(sumd)
+        f2[sumd2 > 0.0] = (5.0 * 10.0 ** -robustness) ** 2 * sumd[sumd2 > 0.0] / sumd2[sumd2 > 0.0]
+        chan = numpy.array(vfrequencymap, dtype='int')
+        newvisweights[density > 0.0] = (visweights / (1.0 + density * f2[chan]))[density > 0.0]
+    else:
+        newvisweights[density > 0.0] = visweights[density > 0.0] / density[density > 0.0]
+    return newvisweights, density, densitygrid
 
 
 def visibility_recentre(uvw, dl, dm):
@@ -2,42 +2,402 @@
 
 """
 
+import collections
+import contextlib
+import logging
+import os
+import threading
+
 import numpy
+import scipy.fft
+
+log = logging.getLogger(__name__)
+
+
+def _single_precision(a):
+    """ Is a single precision?
+    """
+    return a.dtype == numpy.complex64 or a.dtype == numpy.float32
+
+
+def numpy_fft2(a, axes=(-2, -1), workers=1, overwrite_x=False):
+    """ 2D FFT using numpy.fft (the reference FFT backend)
+    
+    numpy.fft always works in double precision and in one thread, so single precision arrays are transformed
+    by scipy.fft, which keeps the precision of its input.
+    
+    :param a: Array to transform
+    :param axes: Axes to transform
+    :param workers: Number of threads (used only for single precision)
+    :param overwrite_x: a may be overwritten (and the result may then share its memory)
+    :return: transformed array
+    """
+    if _single_precision(a):
+        return scipy.fft.fft2(a, axes=axes, workers=workers, overwrite_x=overwrite_x)
+    return numpy.fft.fft2(a, axes=axes)
+
+
+def numpy_ifft2(a, axes=(-2, -1), workers=1, overwrite_x=False):
+    """ 2D inverse FFT using numpy.fft (the reference FFT backend)
+    
+    The arguments are as for numpy_fft2
+    """
+    if _single_precision(a):
+        return scipy.fft.ifft2(a, axes=axes, workers=workers, overwrite_x=overwrite_x)
+    return numpy.fft.ifft2(a, axes=axes)
+
+
+def scipy_fft2(a, axes=(-2, -1), workers=1, overwrite_x=False):
+    """ 2D FFT using scipy.fft, threaded over workers. With overwrite_x the transform is done in place.
+    
+    The arguments are as for numpy_fft2
+    """
+    return scipy.fft.fft2(a, axes=axes, workers=workers, overwrite_x=overwrite_x)
+
+
+def scipy_ifft2(a, axes=(-2, -1), workers=1, overwrite_x=False):
+    """ 2D inverse FFT using scipy.fft, threaded over workers. With overwrite_x the transform is done in place.
+    
+    The arguments are as for numpy_fft2
+    """
+    return scipy.fft.ifft2(a, axes=axes, workers=workers, overwrite_x=overwrite_x)
+
+
+def numpy_rfft2(a, axes=(-2, -1), workers=1):
+    """ 2D FFT of a real array using numpy.fft, giving the non-negative frequencies of the last axis
+    
+    As for numpy_fft2, single precision arrays are transformed by scipy.fft.
+    
+    :param a: Real array to transform
+    :param axes: Axes to transform
+    :param workers: Number of threads (used only for single precision)
+    :return: transformed array, with a.shape[axes[-1]] // 2 + 1 elements along the last axis
+    """
+    if _single_precision(a):
+        return scipy.fft.rfft2(a, axes=axes, workers=workers)
+    return numpy.fft.rfft2(a, axes=axes)
+
+
+def numpy_irfft2(a, s, axes=(-2, -1), workers=1):
+    """ 2D inverse of numpy_rfft2 using numpy.fft
+    
+    :param a: Complex array holding the non-negative frequencies of the last axis
+    :param s: Shape of the real output along axes
+    :param axes: Axes to transform
+    :param workers: Number of threads (used only for single precision)
+    :return: real array
+    """
+    if _single_precision(a):
+        return scipy.fft.irfft2(a, s=s, axes=axes, workers=workers)
+    return numpy.fft.irfft2(a, s=s, axes=axes)
+
+
+def scipy_rfft2(a, axes=(-2, -1), workers=1):
+    """ 2D FFT of a real array using scipy.fft, threaded over workers
+    
+    The arguments are as for numpy_rfft2
+    """
+    return scipy.fft.rfft2(a, axes=axes, workers=workers)
+
+
+def scipy_irfft2(a, s, axes=(-2, -1), workers=1):
+    """ 2D inverse of scipy_rfft2, threaded over workers
+    
+    The arguments are as for numpy_irfft2
+    """
+    return scipy.fft.irfft2(a, s=s, axes=axes, workers=workers)
+
+
+# FFT backends: name -> (fft2 function, ifft2 function)
+fft_backends = {'numpy': (numpy_fft2, numpy_ifft2), 'scipy': (scipy_fft2, scipy_ifft2)}
+
+# Real FFT backends: name -> (rfft2 function, irfft2 function)
+real_fft_backends = {'numpy': (numpy_rfft2, numpy_irfft2), 'scipy': (scipy_rfft2, scipy_irfft2)}
+
+
+def register_fft_backend(name, fft2_function, ifft2_function, rfft2_function=None, irfft2_function=None):
+    """ Register an FFT backend
+    
+    The functions must have the same arguments and normalisation as numpy_fft2, numpy_ifft2, numpy_rfft2 and
+    numpy_irfft2. If the real transforms are not given the numpy ones are used with this backend.
+    
+    :param name: Name of backend
+    :param fft2_function: 2D FFT function
+    :param ifft2_function: 2D inverse FFT function
+    :param rfft2_function: 2D real to complex FFT function
+    :param irfft2_function: 2D complex to real inverse FFT function
+    """
+    fft_backends[name] = (fft2_function, ifft2_function)
+    if rfft2_function is not None and irfft2_function is not None:
+        real_fft_backends[name] = (rfft2_function, irfft2_function)
+
+
+try:
+    import pyfftw
+    
+    # FFTW plans, most recently used last
+    _fftw_plans = collections.OrderedDict()
+    fftw_plan_cache_size = 16
+    
+    def _fftw_transform(a, axes, workers, builder, s=None):
+        """ Transform using a cached FFTW plan for the builder, shape, dtype, axes and number of threads of a
+        """
+        key = (a.shape, a.dtype.str, tuple(axes), workers, builder.__name__, s)
+        if key not in _fftw_plans:
+            extra = {} if s is None else {'s': s}
+            _fftw_plans[key] = builder(pyfftw.empty_aligned(a.shape, dtype=a.dtype), axes=axes, threads=workers,
+                                       planner_effort='FFTW_MEASURE', **extra)
+            while len(_fftw_plans) > fftw_plan_cache_size:
+                _fftw_plans.popitem(last=False)
+        else:
+            _fftw_plans.move_to_end(key)
+        # The plan owns its output array so the result must be copied before the plan is used again
+        return _fftw_plans[key](a).copy()
+    
+    def pyfftw_fft2(a, axes=(-2, -1), workers=1, overwrite_x=False):
+        """ 2D FFT using pyFFTW with cached plans
+
+        The arguments are as for numpy_fft2
+        """
+        return _fftw_transform(a, axes, workers, pyfftw.builders.fft2)
+    
+    def pyfftw_ifft2(a, axes=(-2, -1), workers=1, overwrite_x=False):
+        """ 2D inverse FFT using pyFFTW with cached plans
+
+        The arguments are as for numpy_fft2
+        """
+        return _fftw_transform(a, axes, workers, pyfftw.builders.ifft2)
+    
+    def pyfftw_rfft2(a, axes=(-2, -1), workers=1):
+        """ 2D real to complex FFT using pyFFTW with cached plans
+
+        The arguments are as for numpy_rfft2
+        """
+        return _fftw_transform(a, axes, workers, pyfftw.builders.rfft2)
+    
+    def pyfftw_irfft2(a, s, axes=(-2, -1), workers=1):
+        """ 2D complex to real inverse FFT using pyFFTW with cached plans
+
+        The arguments are as for numpy_irfft2
+        """
+        return _fftw_transform(a, axes, workers, pyfftw.builders.irfft2, s=tuple(s))
+    
+    register_fft_backend('pyfftw', pyfftw_fft2, pyfftw_ifft2, pyfftw_rfft2, pyfftw_irfft2)
+except ImportError:
+    pass
+
+# Default FFT backend and number of threads, see set_fft_backend
+_fft_config = {'backend': os.getenv('ARL_FFT', 'numpy'), 'workers': int(os.getenv('ARL_FFT_WORKERS', '1'))}
+
+
+def set_fft_backend(name=None, workers=None):
+    """ Set the default FFT backend and number of threads
+    
+    The initial defaults are given by the environment variables ARL_FFT (default 'numpy') and ARL_FFT_WORKERS
+    (default 1).
+    
+    :param name: Name of backend e.g. 'numpy', 'scipy', 'pyfftw' (None: unchanged)
+    :param workers: Number of threads (None: unchanged)
+    """
+    if name is not None:
+        _fft_config['backend'] = name
+    if workers is not None:
+        _fft_config['workers'] = workers
+
+
+def get_fft_backend(name=None, workers=None):
+    """ Get the FFT functions and number of threads
+    
+    If the backend is not available (e.g. pyfftw is not installed) the numpy backend is used.
+    
+    :param name: Name of backend (default: as set by set_fft_backend)
+    :param workers: Number of threads (default: as set by set_fft_backend)
+    :return: (fft2 function, ifft2 function), workers
+    """
+    if name is None:
+        name = _fft_config['backend']
+    if workers is None:
+        workers = _fft_config['workers']
+    if name not in fft_backends:
+        log.warning("get_fft_backend: FFT backend %s is not available, using numpy" % name)
+        name = 'numpy'
+    return fft_backends[name], workers
+
+
+def get_real_fft_backend(name=None, workers=None):
+    """ Get the real FFT functions and number of threads
+    
+    If the backend has no real transforms the numpy ones are used.
+    
+    :param name: Name of backend (default: as set by set_fft_backend)
+    :param workers: Number of threads (default: as set by set_fft_backend)
+    :return: (rfft2 function, irfft2 function), workers
+    """
+    if name is None:
+        name = _fft_config['backend']
+    if workers is None:
+        workers = _fft_config['workers']
+    return real_fft_backends.get(name, real_fft_backends['numpy']), workers
+
+
+def fft2(a, axes=(-2, -1), backend=None, workers=None, overwrite_x=False):
+    """ Unshifted 2D FFT using the configured FFT backend
+    
+    :param a: Array to transform
+    :param axes: Axes to transform
+    :param backend: Name of FFT backend (see get_fft_backend)
+    :param workers: Number of threads
+    :param overwrite_x: a may be overwritten (and the result may then share its memory)
+    :return: transformed array
+    """
+    (fft2_function, _), workers = get_fft_backend(backend, workers)
+    return fft2_function(a, axes=axes, workers=workers, overwrite_x=overwrite_x)
+
+
+def ifft2(a, axes=(-2, -1), backend=None, workers=None, overwrite_x=False):
+    """ Unshifted 2D inverse FFT using the configured FFT backend
+    
+    The arguments are as for fft2
+    """
+    (_, ifft2_function), workers = get_fft_backend(backend, workers)
+    return ifft2_function(a, axes=axes, workers=workers, overwrite_x=overwrite_x)
+
+
+def checkerboard(a, flip=False):
+    """ Multiply the last two axes of a by (-1)**(y+x) in place
+    
+    For even sizes, multiplying by the checkerboard before and after an unshifted transform is the same as
+    the ifftshift and fftshift around it, except for an overall sign of (-1)**((ny+nx)/2) which is applied
+    by setting flip.
+    
+    :param a: Array to be modulated in place
+    :param flip: Also multiply by -1
+    :return: a
+    """
+    if flip:
+        a[..., 0::2, 0::2] *= -1
+        a[..., 1::2, 1::2] *= -1
+    else:
+        a[..., 0::2, 1::2] *= -1
+        a[..., 1::2, 0::2] *= -1
+    return a
+
+
+def _centred_transform(transform, a, backend=None, workers=None, out=None):
+    """ Centred 2D transform of the last two axes: fftshift(transform(ifftshift(a)))
+    
+    For even sizes the shifts are replaced by checkerboard modulation of a working array, which is out if
+    given and otherwise a single copy of a. The transform is then done in place if the backend can do so.
+    
+    :param transform: fft2 or ifft2
+    :param a: Array to transform
+    :param backend: Name of FFT backend (see get_fft_backend)
+    :param workers: Number of threads
+    :param out: Complex array to hold the result (may be a)
+    :return: transformed array (out if given)
+    """
+    ny, nx = a.shape[-2:]
+    if ny % 2 != 0 or nx % 2 != 0:
+        axes = list(range(a.ndim))[-2:]
+        result = numpy.fft.fftshift(transform(numpy.fft.ifftshift(a, axes=axes), backend=backend, workers=workers),
+                                    axes=axes)
+        if out is None:
+            return result
+        out[...] = result
+        return out
+    
+    if out is None:
+        out = a.astype(numpy.result_type(a.dtype, numpy.complex64))
+    elif out is not a:
+        out[...] = a
+    checkerboard(out)
+    result = transform(out, backend=backend, workers=workers, overwrite_x=True)
+    if not numpy.may_share_memory(result, out):
+        out[...] = result
+    return checkerboard(out, flip=((ny + nx) // 2) % 2 == 1)
 
 
-def fft(a):
+def fft(a, backend=None, workers=None, out=None):
     """ Fourier transformation from image to grid space
     
     .. note::
     
         If there are four axes then the last outer axes are not transformed
+        
+        Single precision (complex64) input gives a single precision result
+
+    The result is centred as for fftshift(fft2(ifftshift(a))) but for even sizes the shifts are done by
+    checkerboard modulation, avoiding the shifted copies. If out is given (it may be a) the result is written
+    there, and with the scipy backend no other full size array is allocated.
 
     :param a: image in `lm` coordinate space
+    :param backend: Name of FFT backend (see get_fft_backend)
+    :param workers: Number of threads
+    :param out: Complex array to hold the result
     :return: `uv` grid
     """
-    if (len(a.shape) == 4):
-        return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a, axes=[2, 3])), axes=[2, 3])
-    else:
-        return numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a)))
+    return _centred_transform(fft2, a, backend=backend, workers=workers, out=out)
 
 
-def ifft(a):
+def ifft(a, backend=None, workers=None, out=None):
     """ Fourier transformation from grid to image space
 
     .. note::
     
         If there are four axes then the last outer axes are not transformed
+        
+        Single precision (complex64) input gives a single precision result
+
+    The arguments and centring are as for fft.
 
     :param a: `uv` grid to transform
+    :param backend: Name of FFT backend (see get_fft_backend)
+    :param workers: Number of threads
+    :param out: Complex array to hold the result
     :return: an image in `lm` coordinate space
     """
-    if (len(a.shape) == 4):
-        return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a, axes=[2, 3])), axes=[2, 3])
-    else:
-        return numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a)))
+    return _centred_transform(ifft2, a, backend=backend, workers=workers, out=out)
 
 
-def pad_mid(ff, npixel):
+def rfft(a, backend=None, workers=None):
+    """ Fourier transformation of a real image to the u >= 0 half of the grid
+    
+    Since the image is real the grid is Hermitian, G(-u, -v) = conj(G(u, v)), so only the nx // 2 + 1 columns
+    u >= 0 are calculated. The rows are centred as for fft but the columns start at u = 0, so column i
+    of the result is column (nx // 2 + i) % nx of fft(a).
+
+    :param a: real image in `lm` coordinate space
+    :param backend: Name of FFT backend (see get_real_fft_backend)
+    :param workers: Number of threads
+    :return: half `uv` grid
+    """
+    (rfft2_function, _), workers = get_real_fft_backend(backend, workers)
+    axes = list(range(a.ndim))[-2:]
+    return numpy.fft.fftshift(rfft2_function(numpy.fft.ifftshift(a, axes=axes), axes=axes, workers=workers),
+                              axes=axes[0])
+
+
+def irfft(a, nx, backend=None, workers=None):
+    """ Fourier transformation from the u >= 0 half of a Hermitian grid to a real image
+    
+    This is the inverse of rfft. The half grid holds the Hermitian part (G(u, v) + conj(G(-u, -v))) / 2 of a
+    full grid G, for which the result is the real part of ifft(G). Only the Hermitian part of the columns
+    u = 0 and u = nx / 2 contributes, so for those columns G itself may be given.
+
+    :param a: half `uv` grid, as from rfft
+    :param nx: Number of columns of the image
+    :param backend: Name of FFT backend (see get_real_fft_backend)
+    :param workers: Number of threads
+    :return: a real image in `lm` coordinate space
+    """
+    (_, irfft2_function), workers = get_real_fft_backend(backend, workers)
+    axes = list(range(a.ndim))[-2:]
+    assert a.shape[-1] == nx // 2 + 1, "Half grid has %d columns, expected %d" % (a.shape[-1], nx // 2 + 1)
+    return numpy.fft.fftshift(irfft2_function(numpy.fft.ifftshift(a, axes=axes[0]), s=(a.shape[-2], nx),
+                                              axes=axes, workers=workers), axes=axes)
+
+
+def pad_mid(ff, npixel, out=None):
     """
     Pad a far field image with zeroes to make it the given size.
 
@@ -54,11 +414,26 @@ def pad_mid(ff, npixel):
     :param ff: The input far field. Should be smaller than npixelxnpixel.
 
     :param npixel:  The desired far field size
+    
+    :param out: Array to hold the result e.g. from workspace_pool (default None: allocate a new array, or if no
+        padding is needed return ff)
 
     """
     ny, nx = ff.shape[-2:]
     cx = nx // 2
     cy = ny // 2
+    if out is not None:
+        assert out.shape[-2:] == (npixel, npixel), "Output shape %s is not %d x %d" % (str(out.shape), npixel,
+                                                                                       npixel)
+        if npixel == nx:
+            out[...] = ff
+            return out
+        assert npixel > nx and npixel > ny
+        out.fill(0)
+        y0 = npixel // 2 - cy
+        x0 = npixel // 2 - cx
+        out[..., y0:y0 + ny, x0:x0 + nx] = ff
+        return out
     if npixel == nx:
         return ff
     assert npixel > nx and npixel > ny
@@ -70,7 +445,7 @@ def pad_mid(ff, npixel):
                      constant_values=0.0)
 
 
-def extract_mid(a, npixel):
+def extract_mid(a, npixel, out=None):
     """
     Extract a section from middle of a map
 
@@ -83,15 +458,121 @@ def extract_mid(a, npixel):
 
     :param npixel: desired size of the section to extract
     :param a: grid from which to extract
+    :param out: Array to hold a copy of the section (default None: return a view of a)
     """
     ny, nx = a.shape[-2:]
     cx = nx // 2
     cy = ny // 2
     s = npixel // 2
     if npixel % 2 != 0:
-        return a[..., cx - s:cx + s + 1, cy - s:cy + s + 1]
+        mid = a[..., cx - s:cx + s + 1, cy - s:cy + s + 1]
     else:
-        return a[..., cx - s:cx + s, cy - s:cy + s]
+        mid = a[..., cx - s:cx + s, cy - s:cy + s]
+    if out is None:
+        return mid
+    out[...] = mid
+    return out
+
+
+class WorkspacePool:
+    """ Pool of reusable work arrays, such as padded grids, keyed by shape and dtype
+
+    Arrays are taken from the pool with get (or the buffer context manager) and returned with release.
+    A returned array is given to the next request for the same shape and dtype, so repeated calls of
+    e.g. invert_2d and predict_2d in facet and w stacking loops do not allocate new grids. Each array is
+    used by only one caller at a time so the pool may be shared between threads. Free arrays beyond
+    max_free_bytes are dropped, oldest first.
+    """
+    
+    def __init__(self, max_free_bytes=2 ** 31):
+        """ Create an empty pool
+        
+        :param max_free_bytes: Maximum total size of the free arrays kept for reuse
+        """
+        self.max_free_bytes = max_free_bytes
+        self._free = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'allocated': 0, 'reused': 0, 'in_use_bytes': 0, 'free_bytes': 0, 'peak_bytes': 0}
+    
+    def get(self, shape, dtype='complex', zero=True):
+        """ Get an array from the pool, or a new array if there is none free
+        
+        :param shape: Shape of array
+        :param dtype: dtype of array
+        :param zero: Fill the array with zeros
+        :return: array
+        """
+        key = (tuple(int(n) for n in shape), numpy.dtype(dtype).str)
+        with self._lock:
+            arrays = self._free.get(key, None)
+            if arrays:
+                a = arrays.pop()
+                if not arrays:
+                    del self._free[key]
+                self._stats['reused'] += 1
+                self._stats['free_bytes'] -= a.nbytes
+            else:
+                a = None
+                self._stats['allocated'] += 1
+            self._stats['in_use_bytes'] += numpy.prod(key[0], dtype='int64') * numpy.dtype(dtype).itemsize
+            self._stats['peak_bytes'] = max(self._stats['peak_bytes'],
+                                            self._stats['in_use_bytes'] + self._stats['free_bytes'])
+        if a is None:
+            return numpy.zeros(key[0], dtype=dtype) if zero else numpy.empty(key[0], dtype=dtype)
+        if zero:
+            a.fill(0)
+        return a
+    
+    def release(self, a):
+        """ Return an array to the pool. The caller must not use it afterwards.
+        
+        :param a: array from get
+        """
+        key = (a.shape, a.dtype.str)
+        with self._lock:
+            self._stats['in_use_bytes'] -= a.nbytes
+            self._free.setdefault(key, []).append(a)
+            self._free.move_to_end(key)
+            self._stats['free_bytes'] += a.nbytes
+            while self._stats['free_bytes'] > self.max_free_bytes and self._free:
+                oldest = next(iter(self._free))
+                dropped = self._free[oldest].pop(0)
+                if not self._free[oldest]:
+                    del self._free[oldest]
+                self._stats['free_bytes'] -= dropped.nbytes
+    
+    @contextlib.contextmanager
+    def buffer(self, shape, dtype='complex', zero=True):
+        """ Context manager giving an array from the pool and releasing it afterwards
+        
+        :param shape: Shape of array
+        :param dtype: dtype of array
+        :param zero: Fill the array with zeros
+        """
+        a = self.get(shape, dtype, zero)
+        try:
+            yield a
+        finally:
+            self.release(a)
+    
+    def clear(self):
+        """ Drop all free arrays
+        """
+        with self._lock:
+            self._free.clear()
+            self._stats['free_bytes'] = 0
+    
+    def statistics(self):
+        """ Memory statistics of the pool
+        
+        :return: dict with the number of arrays allocated and reused, and the bytes in use, free, and at peak
+        """
+        with self._lock:
+            return dict(self._stats)
+
+
+# The pool shared by the imaging functions
+workspace_pool = WorkspacePool(max_free_bytes=int(os.getenv('ARL_WORKSPACE_MAX_BYTES', str(2 ** 31))))
 
 
 def extract_oversampled(a, xf, yf, kernel_oversampling, kernelwidth):
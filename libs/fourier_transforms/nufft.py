@@ -0,0 +1,162 @@
+""" Non-uniform FFT support using the exponential of semicircle (ES) kernel
+
+Gridding followed by an FFT is a type 1 non-uniform FFT, and an FFT followed by degridding is a type 2 non-uniform
+FFT. The accuracy is set by the kernel: the ES kernel
+
+.. math::
+
+    \\phi(z) = e^{\\beta (\\sqrt{1-z^2} - 1)}, |z| \\le 1
+
+is evaluated exactly at each visibility, rather than looked up in an oversampled table, so the support, kernel
+shape and grid upsampling can be chosen from a target accuracy epsilon. For epsilon down to 1e-8 an upsampling
+of 1.25 is enough, instead of the padding of 2 used with the prolate spheroidal kernel. See Barnett, Magland and
+af Klinteberg (2019), "A parallel non-uniform fast Fourier transform library based on an exponential of
+semicircle kernel".
+"""
+
+import logging
+
+import numpy
+import scipy.fft
+
+from libs.fourier_transforms.convolutional_gridding import GriddingPlan
+
+log = logging.getLogger(__name__)
+
+
+def es_kernel(z, beta):
+    """ Exponential of semicircle kernel, zero outside [-1, 1]
+
+    :param z: Coordinates in units of the half width of the kernel
+    :param beta: Shape parameter
+    :return: kernel values
+    """
+    z = numpy.asarray(z)
+    inside = numpy.abs(z) <= 1.0
+    return numpy.where(inside, numpy.exp(beta * (numpy.sqrt(numpy.where(inside, 1.0 - z * z, 0.0)) - 1.0)), 0.0)
+
+
+def nufft_parameters(epsilon=1e-6, upsampling=None):
+    """ Choose the support and shape of the ES kernel for a target accuracy
+
+    The rules are those of FINUFFT. If upsampling is not given it is 1.25 for epsilon >= 1e-8 and otherwise 2.
+
+    :param epsilon: Target relative accuracy
+    :param upsampling: Ratio of the grid size to the image size
+    :return: support (pixels), beta, upsampling
+    """
+    assert 1e-15 < epsilon < 1.0, "epsilon %g is out of range" % epsilon
+    if upsampling is None:
+        upsampling = 1.25 if epsilon >= 1e-8 else 2.0
+    assert upsampling > 1.0, "upsampling must be greater than 1"
+    if upsampling == 2.0:
+        support = int(numpy.ceil(-numpy.log10(epsilon / 10.0)))
+    else:
+        support = int(numpy.ceil(-numpy.log(epsilon) / (numpy.pi * numpy.sqrt(1.0 - 1.0 / upsampling))))
+    support = max(2, support)
+    if support > 16:
+        log.warning("nufft_parameters: support %d needed for epsilon %g, using 16" % (support, epsilon))
+        support = 16
+    if upsampling == 2.0:
+        beta = {2: 2.20, 3: 2.26, 4: 2.38}.get(support, 2.30) * support
+    else:
+        beta = 0.97 * numpy.pi * (1.0 - 0.5 / upsampling) * support
+    return support, beta, upsampling
+
+
+def nufft_grid_size(npixel, upsampling, support):
+    """ Even grid size of at least upsampling * npixel (and twice the support) with small prime factors
+
+    :param npixel: Number of image pixels
+    :param upsampling: Ratio of the grid size to the image size
+    :param support: Support of the kernel in pixels
+    :return: grid size
+    """
+    ngrid = max(int(numpy.ceil(upsampling * npixel)), 2 * support)
+    while True:
+        ngrid = scipy.fft.next_fast_len(ngrid)
+        if ngrid % 2 == 0:
+            return ngrid
+        ngrid += 1
+
+
+def es_correction(ngrid, support, beta):
+    """ Gridding correction along one axis for the ES kernel
+
+    This is the reciprocal of the Fourier transform of the kernel (in grid pixels) at the image pixels of a
+    centred grid of ngrid pixels, calculated by Gauss-Legendre quadrature.
+
+    :param ngrid: Number of grid (and padded image) pixels
+    :param support: Support of the kernel in pixels
+    :param beta: Shape parameter
+    :return: correction [ngrid]
+    """
+    nodes, weights = numpy.polynomial.legendre.leggauss(4 * support + 16)
+    f = (numpy.arange(ngrid) - ngrid // 2) / ngrid
+    ft = 0.5 * support * numpy.sum(weights * es_kernel(nodes, beta) *
+                                   numpy.cos(numpy.pi * support * f[:, numpy.newaxis] * nodes), axis=1)
+    return 1.0 / ft
+
+
+class NUFFTPlan(GriddingPlan):
+    """ Gridding plan for a kernel evaluated at each visibility, by default the ES kernel
+
+    The kernel is real and separable, so the plan holds the 1D kernel values of each row along v and u and gives
+    every row its own entry in them. Gridding and degridding then use the separable gridder backends, through
+    convolutional_grid and convolutional_degrid.
+    """
+
+    def __init__(self, shape, vuvwmap, vfrequencymap, support, beta, padding=1, kernel=es_kernel, scale=1.0):
+        """ Calculate the plan
+
+        :param shape: Shape of the uv grid [nchan, npol, ny, nx]
+        :param vuvwmap: map uvw to grid fractions
+        :param vfrequencymap: map frequency to image channels
+        :param support: Support of the kernel in pixels
+        :param beta: Shape parameter of the kernel
+        :param padding: Padding of the grid relative to the image (for reference only)
+        :param kernel: Kernel function of (z, beta), z in units of the half width (default es_kernel)
+        :param scale: Factor applied to the kernel values
+        """
+        inchan, inpol, ny, nx = shape
+        self.kernel_list = None
+        self.shape = tuple(shape)
+        self.padding = padding
+        self.support = support
+        self.beta = beta
+
+        # Kernel pixels are those within support / 2 of the visibility
+        self.chan = numpy.array(vfrequencymap, dtype='int')
+        self.nvis = len(self.chan)
+        yg = ny // 2 + vuvwmap[:, 1] * ny
+        xg = nx // 2 + vuvwmap[:, 0] * nx
+        self.y = numpy.ceil(yg - 0.5 * support).astype(int)
+        self.x = numpy.ceil(xg - 0.5 * support).astype(int)
+        pixels = numpy.arange(support)
+        ky = scale * kernel((2.0 / support) * (self.y[:, numpy.newaxis] + pixels - yg[:, numpy.newaxis]), beta)
+        kx = scale * kernel((2.0 / support) * (self.x[:, numpy.newaxis] + pixels - xg[:, numpy.newaxis]), beta)
+        self.separable = (ky, kx)
+        self.yf = numpy.arange(self.nvis)
+        self.xf = self.yf
+
+        assert numpy.all((self.y >= 0) & (self.y + support <= ny) & (self.x >= 0) & (self.x + support <= nx)), \
+            "Kernels extend beyond the grid: reduce the cellsize"
+
+        self.corner = (self.chan * inpol * ny + self.y) * nx + self.x
+        self.offsets = (pixels[:, numpy.newaxis] * nx + pixels[numpy.newaxis, :]).ravel()
+
+        self.kernels = None
+        self.kind = None
+        self.conjugate = None
+        self._reset_caches()
+
+    @property
+    def kernel_shape(self):
+        return self.support, self.support
+
+    def _mirror_kernels(self, mirror):
+        """ Kernels for the half plane plan: the mirrored rows have their 1D kernels reversed
+        """
+        ky, kx = self.separable
+        mirror = mirror[:, numpy.newaxis]
+        return None, None, (numpy.where(mirror, ky[:, ::-1], ky), numpy.where(mirror, kx[:, ::-1], kx))
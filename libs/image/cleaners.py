@@ -6,6 +6,8 @@ import numpy
 import logging
 import time
 
+from ..fourier_transforms.fft_support import fft2, ifft2
+
 log = logging.getLogger(__name__)
 
 
@@ -263,13 +265,13 @@ def convolve_scalestack(scalestack, img):
     """
 
     convolved = numpy.zeros(scalestack.shape)
-    ximg = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.fftshift(img)))
+    ximg = numpy.fft.fftshift(fft2(numpy.fft.fftshift(img)))
 
     nscales = scalestack.shape[0]
     for iscale in range(nscales):
-        xscale = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.fftshift(scalestack[iscale, :, :])))
+        xscale = numpy.fft.fftshift(fft2(numpy.fft.fftshift(scalestack[iscale, :, :])))
         xmult = ximg * numpy.conjugate(xscale)
-        convolved[iscale, :, :] = numpy.real(numpy.fft.ifftshift(numpy.fft.ifft2(numpy.fft.ifftshift(xmult))))
+        convolved[iscale, :, :] = numpy.real(numpy.fft.ifftshift(ifft2(numpy.fft.ifftshift(xmult))))
     return convolved
 
 
@@ -284,17 +286,17 @@ def convolve_convolve_scalestack(scalestack, img):
     nscales, nx, ny = scalestack.shape
     convolved_shape = [nscales, nscales, nx, ny]
     convolved = numpy.zeros(convolved_shape)
-    ximg = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.fftshift(img)))
+    ximg = numpy.fft.fftshift(fft2(numpy.fft.fftshift(img)))
 
     xscaleshape = [nscales, nx, ny]
     xscale = numpy.zeros(xscaleshape, dtype='complex')
     for s in range(nscales):
-        xscale[s] = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.fftshift(scalestack[s, ...])))
+        xscale[s] = numpy.fft.fftshift(fft2(numpy.fft.fftshift(scalestack[s, ...])))
 
     for s in range(nscales):
         for p in range(nscales):
             xmult = ximg * xscale[p] * numpy.conjugate(xscale[s])
-            convolved[s, p, ...] = numpy.real(numpy.fft.ifftshift(numpy.fft.ifft2(numpy.fft.ifftshift(xmult))))
+            convolved[s, p, ...] = numpy.real(numpy.fft.ifftshift(ifft2(numpy.fft.ifftshift(xmult))))
     return convolved
 
 
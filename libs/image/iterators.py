@@ -18,12 +18,13 @@ from ..image.operations import create_empty_image_like
 log = logging.getLogger(__name__)
 
 
-def image_null_iter(im: Image, facets=1, overlap=0) -> collections.Iterable:
+def image_null_iter(im: Image, facets=1, overlap=0, taper=None) -> collections.Iterable:
     """One time iterator
 
     :param im:
     :param facets: Number of image partitions on each axis (2)
     :param overlap: overlap in pixels
+    :param taper: method of tapering at the edges (ignored)
     :return:
     """
     yield im
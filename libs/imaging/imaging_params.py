@@ -2,8 +2,13 @@
 Functions that aid definition of fourier transform processing.
 """
 
+import collections
+import functools
+import hashlib
 import logging
+import os
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 
 from astropy.wcs import FITSFixedWarning
 
@@ -13,9 +18,11 @@ from data_models.memory_data_models import Visibility, Image
 from data_models.parameters import get_parameter
 from data_models.polarisation import PolarisationFrame
 
-from ..fourier_transforms.convolutional_gridding import anti_aliasing_calculate
-from ..image.operations import convert_image_to_kernel
-from ..image.operations import copy_image, fft_image, pad_image, create_w_term_like
+from ..fourier_transforms.convolutional_gridding import anti_aliasing_calculate, GriddingPlan, w_kernel, \
+    gridding_kernels, w_beams, gridding_kernel_integral, kernel_shape_parameter
+from ..fourier_transforms.idg import IDGPlan, idg_correction
+from ..fourier_transforms.nufft import NUFFTPlan, nufft_parameters, nufft_grid_size, es_correction
+from ..image.operations import pad_image
 
 log = logging.getLogger(__name__)
 
@@ -69,6 +76,48 @@ def get_polarisation_map(vis: Visibility, im: Image = None):
     return "unknown", lambda pol: pol
 
 
+def get_imaging_dtypes(precision='double'):
+    """ Get the complex and real dtypes used for grids and images
+    
+    :param precision: 'double' (complex128/float64) or 'single' (complex64/float32)
+    :return: complex dtype, real dtype
+    """
+    assert precision in ['double', 'single'], "Unknown imaging precision %s" % precision
+    if precision == 'single':
+        return numpy.dtype('complex64'), numpy.dtype('float32')
+    return numpy.dtype('complex128'), numpy.dtype('float64')
+
+
+def get_gridding_options(degrid=False, **kwargs):
+    """ Get the gridding and FFT options shared by the imaging functions
+
+    The options are:
+
+     * precision: 'double' or 'single' (see get_imaging_dtypes). In single precision the grid, FFT and kernels are
+       complex64 and the image float32, and the relative error is about 1e-7, rising towards the image edge where
+       the gridding correction is large. The sum of weights is always double.
+     * gridding_threads: Number of threads (default None). The result is bitwise the same for any number of
+       threads, including none, with the same gridding_tile_size.
+     * gridding_tile_size: Side in pixels of the tiles of the grid that are gridded concurrently (256)
+     * gridder: Gridder backend e.g. 'numpy' or 'numba' (see get_gridder_backend)
+     * gridding_sparse: Grid and degrid as a sparse matrix-vector product with an operator kept with the cached
+       gridding plan (see convolutional_grid). Operators larger than sparse_operator_max_bytes are not built.
+     * fft_backend, fft_workers: FFT backend and number of threads (see set_fft_backend)
+
+    :param degrid: Options for convolutional_degrid, which has no tiles
+    :return: complex dtype, real dtype, options of convolutional_grid or convolutional_degrid, options of fft
+    """
+    complex_type, real_type = get_imaging_dtypes(get_parameter(kwargs, "precision", "double"))
+    gridding_options = {'threads': get_parameter(kwargs, "gridding_threads", None),
+                        'gridder': get_parameter(kwargs, "gridder", None),
+                        'sparse': get_parameter(kwargs, "gridding_sparse", False)}
+    if not degrid:
+        gridding_options['tile_size'] = get_parameter(kwargs, "gridding_tile_size", 256)
+    fft_options = {'backend': get_parameter(kwargs, "fft_backend", None),
+                   'workers': get_parameter(kwargs, "fft_workers", None)}
+    return complex_type, real_type, gridding_options, fft_options
+
+
 def get_rowmap(col, ucol=None):
     """ Map to unique cols
     
@@ -116,40 +165,210 @@ def get_uvw_map(vis: Visibility, im: Image, padding=2):
     return uvw_mode, shape, padding, vuvwmap
 
 
-def standard_kernel_list(vis: Visibility, shape, oversampling=8, support=3):
+def standard_kernel_list(vis: Visibility, shape, oversampling=8, support=3, kernel='grdsf', padding=2.0):
     """Return a generator to calculate the standard visibility kernel
 
     :param vis: visibility
     :param shape: tuple with 2D shape of grid
     :param oversampling: Oversampling factor
     :param support: Support of kernel
+    :param kernel: Kernel family (see anti_aliasing_calculate)
+    :param padding: Padding of the grid relative to the image
     :return: Function to look up gridding kernel
     """
-    return numpy.zeros_like(vis.w, dtype='int'), [anti_aliasing_calculate(shape, oversampling, support)[1]]
+    return numpy.zeros_like(vis.w, dtype='int'), \
+        [anti_aliasing_calculate(shape, oversampling, support, kernel=kernel, padding=padding)[1]]
+
+
+# w kernel stacks, most recently used last
+_w_kernel_cache = collections.OrderedDict()
+w_kernel_cache_size = 4
+
+
+def clear_w_kernel_cache():
+    """ Remove all w kernels cached in memory
+    
+    """
+    _w_kernel_cache.clear()
+
+
+def w_kernel_key(im: Image, wmaxabs, oversampling=1, wstep=50.0, kernelwidth=16, remove_shift=False,
+                 kernel='grdsf', support=3, padding=2.0):
+    """ Key identifying a stack of w kernels
+    
+    The kernels depend only on the image size, cellsize and reference pixel, the range and step in w, and
+    the oversampling, kernel width and remove_shift parameters, and on the anti-aliasing kernel family whose
+    correction is applied to the w screen. The key is also used as the file name in the on-disk cache.
+    
+    :param im: Template image
+    :param wmaxabs: Maximum absolute w
+    :return: key (str)
+    """
+    nchan, npol, ny, nx = im.shape
+    key = "ny=%d nx=%d cellsize=%r crpix=%r wmaxabs=%r oversampling=%d wstep=%r kernelwidth=%d remove_shift=%s" % \
+          (ny, nx, float(im.wcs.wcs.cdelt[0]), tuple(float(p) for p in im.wcs.wcs.crpix[0:2]), float(wmaxabs),
+           oversampling, float(wstep), kernelwidth, bool(remove_shift))
+    # The grdsf correction does not depend on support or padding, so keys for it are unchanged
+    if kernel != 'grdsf':
+        key += " kernel=%s support=%d padding=%r" % (kernel, support, float(padding))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def _get_cached_w_kernels(key, cache_dir=None):
+    """ Look for a stack of w kernels in the memory cache and then the disk cache
+    
+    :param key: Key from w_kernel_key
+    :param cache_dir: Directory of on-disk cache, or None
+    :return: list of kernels or None
+    """
+    if key in _w_kernel_cache:
+        _w_kernel_cache.move_to_end(key)
+        log.debug("w_kernel_list: using w kernels cached in memory")
+        return _w_kernel_cache[key]
+    
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, "wkernels_%s.npy" % key)
+        if os.path.isfile(filename):
+            try:
+                stack = numpy.load(filename)
+            except (IOError, ValueError) as err:
+                log.warning("w_kernel_list: cannot read cached w kernels %s: %s" % (filename, err))
+                return None
+            log.debug("w_kernel_list: using w kernels cached in %s" % filename)
+            kernels = list(stack)
+            _put_cached_w_kernels(key, kernels)
+            return kernels
+    
+    return None
+
+
+def _put_cached_w_kernels(key, kernels, cache_dir=None):
+    """ Save a stack of w kernels in the memory cache and optionally the disk cache
+    
+    The kernels are made read-only since they are shared between all users of the cache.
+    
+    :param key: Key from w_kernel_key
+    :param kernels: list of kernels
+    :param cache_dir: Directory of on-disk cache, or None
+    """
+    for kernel in kernels:
+        kernel.flags.writeable = False
+    _w_kernel_cache[key] = kernels
+    while len(_w_kernel_cache) > w_kernel_cache_size:
+        _w_kernel_cache.popitem(last=False)
+    
+    if cache_dir is not None:
+        filename = os.path.join(cache_dir, "wkernels_%s.npy" % key)
+        # Write to a temporary file and rename so that concurrent readers never see a partial file
+        tmpname = "%s.%d.tmp" % (filename, os.getpid())
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(tmpname, 'wb') as f:
+                numpy.save(f, numpy.array(kernels))
+            os.replace(tmpname, filename)
+            log.debug("w_kernel_list: saved w kernels to %s" % filename)
+        except OSError as err:
+            log.warning("w_kernel_list: cannot save w kernels to %s: %s" % (filename, err))
+
+
+# w screens, most recently used last
+_w_screen_cache = collections.OrderedDict()
+w_screen_cache_max_bytes = 2 ** 30
+w_screen_resync = 16
+
+
+def clear_w_screen_cache():
+    """ Remove all w screens cached in memory
+    
+    """
+    _w_screen_cache.clear()
+
+
+def w_screen_key(im: Image, w):
+    """ Key identifying the w screens of an image for a sequence of w
+    
+    The screens depend only on the image size, cellsize and reference pixel, and on w.
+    
+    :param im: Template image
+    :param w: Sequence of w
+    :return: key (str)
+    """
+    nchan, npol, ny, nx = im.shape
+    key = "nx=%d cellsize=%r crpix=%r" % (nx, float(im.wcs.wcs.cdelt[0]),
+                                          tuple(float(p) for p in im.wcs.wcs.crpix[0:2]))
+    h = hashlib.sha1(key.encode())
+    h.update(numpy.ascontiguousarray(w, dtype='float').tobytes())
+    return h.hexdigest()
+
+
+def get_w_screens(im: Image, w, **kwargs):
+    """ The w screens of create_w_term_like for a sequence of w, using cached screens if possible
+    
+    The screens are generated by recurrence for evenly spaced w, with an exact evaluation every w_screen_resync
+    screens (see w_beams). w and the image geometry do not change between major cycles, so the screens are kept
+    in memory, unless w_screen_cache is False or they would take more than w_screen_cache_max_bytes. The least
+    recently used screens are removed to stay within that size. Cached screens are read-only.
+    
+    :param im: Template image
+    :param w: Sequence of w
+    :return: sequence of [ny, nx] complex arrays, one for each w. If not cached this is a generator, so that
+        only one screen is in memory at a time
+    """
+    w = numpy.atleast_1d(numpy.asarray(w, dtype='float'))
+    nchan, npol, ny, nx = im.shape
+    cellsize = abs(im.wcs.wcs.cdelt[0]) * numpy.pi / 180.0
+    cx, cy = im.wcs.wcs.crpix[0] - 1.0, im.wcs.wcs.crpix[1] - 1.0
+    resync = get_parameter(kwargs, "w_screen_resync", w_screen_resync)
+    screens = w_beams(nx, nx * cellsize, w, cx=cx, cy=cy, resync=resync)
+    
+    nbytes = len(w) * nx * nx * numpy.dtype('complex').itemsize
+    if not get_parameter(kwargs, "w_screen_cache", True) or nbytes > w_screen_cache_max_bytes:
+        return screens
+    
+    key = w_screen_key(im, w)
+    if key in _w_screen_cache:
+        _w_screen_cache.move_to_end(key)
+        log.debug("get_w_screens: using cached w screens")
+        return _w_screen_cache[key]
+    
+    screens = list(screens)
+    for screen in screens:
+        screen.flags.writeable = False
+    _w_screen_cache[key] = screens
+    while sum(len(s) * s[0].nbytes for s in _w_screen_cache.values()) > w_screen_cache_max_bytes:
+        _w_screen_cache.popitem(last=False)
+    return screens
 
 
 # noinspection PyTypeChecker
-def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernelwidth=16, **kwargs):
+def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernelwidth=16, w_kernel_cache=True,
+                  w_kernel_cache_dir=None, w_kernel_processes=1, **kwargs):
     """ Calculate w convolution kernels
     
-    Uses create_w_term_like to calculate the w screen. This is exactly as wstacking does.
+    Uses the same w screen as create_w_term_like i.e. exactly as wstacking does. The kernels are evaluated
+    only over their support (see w_kernel) rather than by transforming the oversampled screen.
 
     Returns (indices to the w kernel for each row, kernels)
 
     Each kernel has axes [centre_v, centre_u, offset_v, offset_u]. We currently use the same
     convolution function for all channels and polarisations. Changing that behaviour would
     require modest changes here and to the gridding/degridding routines.
+    
+    The kernels are cached in memory (see w_kernel_key) and, if w_kernel_cache_dir is set, on disk so that
+    repeated cycles and repeated runs do not need to recalculate them. Cached kernels are read-only.
 
     :param im:
     :param kernelwidth:
     :param vis: visibility
     :param oversampling: Oversampling factor
     :param wstep: Step in w between cached functions
+    :param w_kernel_cache: Use the cache of w kernels?
+    :param w_kernel_cache_dir: Directory for on-disk cache of w kernels (default None: no disk cache)
+    :param w_kernel_processes: Number of processes used to calculate the kernels (default 1)
     :return: (indices to the w kernel for each row, kernels)
     """
 
     nchan, npol, ny, nx = im.shape
-    gcf, _ = anti_aliasing_calculate((ny, nx))
 
     assert oversampling % 2 == 0 or oversampling == 1, "oversampling must be unity or even"
     assert kernelwidth % 2 == 0, "kernelwidth must be even"
@@ -162,41 +381,85 @@ def w_kernel_list(vis: Visibility, im: Image, oversampling=1, wstep=50.0, kernel
     
     # Find all the unique indices for which we need a kernel
     nwsteps = digitise(wmaxabs, wstep) + 1
-    w_list = numpy.linspace(-wmaxabs, +wmaxabs, nwsteps)
-    
-    wtemplate = copy_image(im)
-    
-    wtemplate.data = numpy.zeros(wtemplate.shape, dtype=im.data.dtype)
     
-    padded_shape = list(wtemplate.shape)
-    padded_shape[3] *= oversampling
-    padded_shape[2] *= oversampling
-
-    # For all the unique indices, calculate the corresponding w kernel
-    kernels = list()
-    for w in w_list:
-        # Make a w screen
-        wscreen = create_w_term_like(wtemplate, w, vis.phasecentre, **kwargs)
-        wscreen.data /= gcf
-        assert numpy.max(numpy.abs(wscreen.data)) > 0.0, 'w screen is empty'
-        wscreen_padded = pad_image(wscreen, padded_shape)
-
-        wconv = fft_image(wscreen_padded)
-        wconv.data *= float(oversampling)**2
-        # For the moment, ignore the polarisation and channel axes
-        kernels.append(convert_image_to_kernel(wconv, oversampling,
-                                               kernelwidth).data[0, 0, ...])
+    kernels = None
+    if w_kernel_cache:
+        key = w_kernel_key(im, wmaxabs, oversampling=oversampling, wstep=wstep, kernelwidth=kernelwidth,
+                           remove_shift=get_parameter(kwargs, "remove_shift", False),
+                           kernel=get_parameter(kwargs, "kernel", 'grdsf'),
+                           support=get_parameter(kwargs, "support", 3),
+                           padding=get_parameter(kwargs, "padding", 2.0))
+        kernels = _get_cached_w_kernels(key, w_kernel_cache_dir)
+        
+    if kernels is None:
+        kernels = _calculate_w_kernels(vis, im, numpy.linspace(-wmaxabs, +wmaxabs, nwsteps),
+                                       oversampling=oversampling, kernelwidth=kernelwidth,
+                                       processes=w_kernel_processes, **kwargs)
+        if w_kernel_cache:
+            _put_cached_w_kernels(key, kernels, w_kernel_cache_dir)
     
     # Now make a lookup table from row number of vis to the kernel
     kernel_indices = digitise(vis.w, wstep)
     assert numpy.max(kernel_indices) < len(kernels), "wabsmax %f wstep %f" % (wmaxabs, wstep)
     assert numpy.min(kernel_indices) >= 0, "wabsmax %f wstep %f" % (wmaxabs, wstep)
-    return kernel_indices, kernels
+    return kernel_indices, list(kernels)
+
+
+def _calculate_w_kernels(vis: Visibility, im: Image, w_list, oversampling=1, kernelwidth=16, processes=1,
+                         remove_shift=False, kernel='grdsf', support=3, padding=2.0, **kwargs):
+    """ Calculate the w convolution kernels for a list of w values
+    
+    Each kernel is evaluated by w_kernel only over its support. This is the same kernel that would be found by
+    padding the w screen (as from create_w_term_like) to the oversampled size, transforming and extracting
+    with convert_image_to_kernel. The w planes are independent and may be calculated in a process pool.
+    
+    :param vis: visibility
+    :param im: Template image
+    :param w_list: w values
+    :param oversampling: Oversampling factor
+    :param kernelwidth: Kernel width
+    :param processes: Number of processes (default 1: calculate in this process)
+    :param remove_shift: Remove overall phase shift at the centre of the image
+    :param kernel: Anti-aliasing kernel family (see anti_aliasing_calculate)
+    :param support: Support of the anti-aliasing kernel
+    :param padding: Padding of the image, used to shape the anti-aliasing kernel
+    :return: list of kernels
+    """
+    nchan, npol, ny, nx = im.shape
+    assert ny == nx, "w kernels require a square image"
+    gcf, _ = anti_aliasing_calculate((ny, nx), support=support, kernel=kernel, padding=padding)
+    
+    cellsize = abs(im.wcs.wcs.cdelt[0]) * numpy.pi / 180.0
+    wkernel = functools.partial(w_kernel, nx, nx * cellsize, oversampling=oversampling, kernelwidth=kernelwidth,
+                                gcf=gcf, cx=im.wcs.wcs.crpix[0] - 1.0, cy=im.wcs.wcs.crpix[1] - 1.0,
+                                remove_shift=remove_shift)
+    
+    if processes is not None and processes > 1 and len(w_list) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            return list(executor.map(wkernel, w_list))
+    
+    return [wkernel(w) for w in w_list]
+
+
+def get_kernel_family(**kwargs):
+    """ The anti-aliasing kernel family given by the kernel and support parameters
+    
+    :return: kernel if it is one of gridding_kernels, otherwise 'grdsf' for support 3 and 'pswf' for other supports
+    """
+    kernel = get_parameter(kwargs, "kernel", None)
+    if kernel in gridding_kernels:
+        return kernel
+    return 'grdsf' if get_parameter(kwargs, "support", 3) == 3 else 'pswf'
 
 
 def get_kernel_list(vis: Visibility, im: Image, **kwargs):
     """Get the list of kernels, one per visibility
     
+    The anti-aliasing kernel is chosen by kernel and support (see get_kernel_family). The default is the prolate
+    spheroidal function grdsf with support 3, which needs padding=2. The kernel families of gridding_kernels take
+    any support and are shaped for the padding. The kernels are tables oversampled by oversampling, by default 8
+    for grdsf and 16 / padding (rounded up to even) for the families, since the error of the tables grows as
+    1 / (padding * oversampling). get_gridding_plan only uses the tables of the families for w projection.
     """
     
     shape = im.data.shape
@@ -204,10 +467,15 @@ def get_kernel_list(vis: Visibility, im: Image, **kwargs):
     cellsize = numpy.pi * im.wcs.wcs.cdelt[1] / 180.0
     
     wstep = get_parameter(kwargs, "wstep", 0.0)
-    oversampling = get_parameter(kwargs, "oversampling", 8)
     padding = get_parameter(kwargs, "padding", 2)
+    support = get_parameter(kwargs, "support", 3)
+    kernel = get_kernel_family(**kwargs)
+    oversampling = get_parameter(kwargs, "oversampling", None)
+    if oversampling is None:
+        oversampling = 8 if kernel == 'grdsf' else 2 * int(numpy.ceil(8.0 / padding))
+    npad = int(round(padding * npixel))
     
-    gcf, _ = anti_aliasing_calculate((padding * npixel, padding * npixel), oversampling)
+    gcf, _ = anti_aliasing_calculate((npad, npad), oversampling, support, kernel=kernel, padding=padding)
     
     wabsmax = numpy.max(numpy.abs(vis.w))
     if wstep > 0.0 and wabsmax > 0.0:
@@ -217,7 +485,7 @@ def get_kernel_list(vis: Visibility, im: Image, **kwargs):
 
         # The field of view must be as padded! R_F is for reporting only so that
         # need not be padded.
-        fov = cellsize * npixel * padding
+        fov = cellsize * npad
         r_f = (cellsize * npixel / 2) ** 2 / abs(cellsize)
         log.debug("get_kernel_list: Fresnel number = %f" % r_f)
  
@@ -227,15 +495,245 @@ def get_kernel_list(vis: Visibility, im: Image, **kwargs):
         kernelwidth = max(kernelwidth, 8)
         assert kernelwidth % 2 == 0
         log.debug("get_kernel_list: Maximum w kernel full width = %d pixels" % kernelwidth)
-        padded_shape = [im.shape[0], im.shape[1], im.shape[2] * padding, im.shape[3] * padding]
+        padded_shape = [im.shape[0], im.shape[1], int(round(im.shape[2] * padding)), npad]
 
         remove_shift = get_parameter(kwargs, "remove_shift", True)
+        w_kernel_cache = get_parameter(kwargs, "w_kernel_cache", True)
+        w_kernel_cache_dir = get_parameter(kwargs, "w_kernel_cache_dir", os.getenv('ARL_W_KERNEL_CACHE', None))
+        w_kernel_processes = get_parameter(kwargs, "w_kernel_processes", 1)
         padded_image = pad_image(im, padded_shape)
         kernel_list = w_kernel_list(vis, padded_image, oversampling=oversampling, wstep=wstep,
-                                    kernelwidth=kernelwidth, remove_shift=remove_shift)
+                                    kernelwidth=kernelwidth, remove_shift=remove_shift,
+                                    w_kernel_cache=w_kernel_cache, w_kernel_cache_dir=w_kernel_cache_dir,
+                                    w_kernel_processes=w_kernel_processes, kernel=kernel, support=support,
+                                    padding=padding)
     else:
         kernelname = '2d'
-        kernel_list = standard_kernel_list(vis, (padding * npixel, padding * npixel),
-                                           oversampling=oversampling)
+        kernel_list = standard_kernel_list(vis, (npad, npad), oversampling=oversampling, support=support,
+                                           kernel=kernel, padding=padding)
     
     return kernelname, gcf, kernel_list
+
+
+# Gridding plans, most recently used last
+_gridding_plan_cache = collections.OrderedDict()
+gridding_plan_cache_size = 8
+gridding_plan_cache_max_bytes = 2 ** 32
+
+
+def clear_gridding_plan_cache():
+    """ Remove all cached gridding plans
+    
+    """
+    _gridding_plan_cache.clear()
+
+
+def _plan_nbytes(obj, seen):
+    """ Bytes held by obj, following the arrays, containers and plans it refers to
+    
+    :param obj: Array, sparse matrix, container or plan
+    :param seen: ids of the objects already counted, so that shared arrays and plans are counted once
+    :return: number of bytes
+    """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    if isinstance(obj, numpy.ndarray):
+        if isinstance(obj.base, numpy.ndarray):
+            return _plan_nbytes(obj.base, seen)
+        return obj.nbytes
+    if isinstance(obj, dict):
+        return sum(_plan_nbytes(value, seen) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return sum(_plan_nbytes(value, seen) for value in obj)
+    if isinstance(obj, (GriddingPlan, IDGPlan)):
+        return sum(_plan_nbytes(value, seen) for value in vars(obj).values())
+    if hasattr(obj, 'tocsr') and hasattr(obj, 'indptr'):
+        # scipy.sparse compressed matrix
+        return _plan_nbytes(obj.data, seen) + _plan_nbytes(obj.indices, seen) + _plan_nbytes(obj.indptr, seen)
+    return 0
+
+
+def gridding_plan_cache_nbytes():
+    """ Bytes held by the cached gridding plans
+    
+    This includes everything built lazily and kept with the plans, such as the tiles, the sparse operators
+    and the plans derived from them (see GriddingPlan.partition, with_kernels, with_polarisations and
+    half_plane).
+    
+    :return: number of bytes
+    """
+    seen = set()
+    return sum(_plan_nbytes(result, seen) for result in _gridding_plan_cache.values())
+
+
+def _trim_gridding_plan_cache():
+    """ Remove the least recently used plans until the cache is within its count and byte limits
+    
+    The most recently used plan is always kept. The caches of the removed plans are released, since the plans
+    may still be referred to elsewhere.
+    """
+    while len(_gridding_plan_cache) > 1 and (len(_gridding_plan_cache) > gridding_plan_cache_size or
+                                             gridding_plan_cache_nbytes() > gridding_plan_cache_max_bytes):
+        _, (_, _, plan) = _gridding_plan_cache.popitem(last=False)
+        if isinstance(plan, GriddingPlan):
+            plan.release_caches()
+
+
+def gridding_plan_key(vis: Visibility, im: Image, **kwargs):
+    """ Key identifying the gridding plan for a visibility and image
+    
+    The key depends on the content of the uvw and frequency columns, the image shape and WCS, and the
+    parameters used in get_uvw_map and get_kernel_list.
+    
+    :param vis: Visibility
+    :param im: Image
+    :return: key (str)
+    """
+    h = hashlib.sha1()
+    h.update(numpy.ascontiguousarray(vis.uvw).tobytes())
+    h.update(numpy.ascontiguousarray(vis.frequency).tobytes())
+    h.update(str(im.shape).encode())
+    h.update(im.wcs.to_header_string().encode())
+    for key in ["padding", "oversampling", "wstep", "kernelwidth", "remove_shift", "gridding_separable", "kernel",
+                "support", "subgrid_size", "idg_kernel",
+                "epsilon", "upsampling"]:
+        h.update(("%s=%s" % (key, get_parameter(kwargs, key, None))).encode())
+    return h.hexdigest()
+
+
+def get_gridding_plan(vis: Visibility, im: Image, **kwargs):
+    """ Get the gridding plan for a visibility and image, using a cached plan if possible
+    
+    The plan holds the frequency map, uvw map, kernel list and grid coordinates needed by
+    convolutional_grid and convolutional_degrid. uvw, frequencies and image geometry do not change between
+    major cycles so the plan is calculated once and then found in the cache. Set gridding_plan_cache=False
+    to always calculate a new plan. Set gridding_separable=False to always use the 2D kernels.
+    
+    The cache keeps at most gridding_plan_cache_size plans. The sparse operators, tiles and derived plans
+    are built lazily and kept with the plans, so they count towards gridding_plan_cache_max_bytes
+    (see gridding_plan_cache_nbytes). Whenever a plan is requested, the least recently used plans are
+    removed until both limits are met.
+    
+    If kernel is 'nufft' the plan is a NUFFTPlan (see get_nufft_plan), and if it is 'idg' the plan is an IDGPlan
+    (see get_idg_plan). The other kernel parameters are then not used. The kernel families of gridding_kernels are
+    evaluated at each visibility unless there is w projection (see get_evaluated_kernel_plan).
+    
+    :param vis: Visibility
+    :param im: Image
+    :return: kernel name, gridding correction function, GriddingPlan
+    """
+    use_cache = get_parameter(kwargs, "gridding_plan_cache", True)
+    if use_cache:
+        key = gridding_plan_key(vis, im, **kwargs)
+        if key in _gridding_plan_cache:
+            _gridding_plan_cache.move_to_end(key)
+            _trim_gridding_plan_cache()
+            log.debug("get_gridding_plan: using cached gridding plan")
+            return _gridding_plan_cache[key]
+    
+    if get_parameter(kwargs, "kernel", None) == 'nufft':
+        result = get_nufft_plan(vis, im, **kwargs)
+    elif get_parameter(kwargs, "kernel", None) == 'idg':
+        result = get_idg_plan(vis, im, **kwargs)
+    elif get_kernel_family(**kwargs) in gridding_kernels and \
+            not (get_parameter(kwargs, "wstep", 0.0) > 0.0 and numpy.max(numpy.abs(vis.w)) > 0.0):
+        result = get_evaluated_kernel_plan(vis, im, **kwargs)
+    else:
+        padding = {}
+        if get_parameter(kwargs, "padding", False):
+            padding = {'padding': get_parameter(kwargs, "padding", False)}
+        nchan, npol, ny, nx = im.data.shape
+        spectral_mode, vfrequencymap = get_frequency_map(vis, im)
+        uvw_mode, shape, padding, vuvwmap = get_uvw_map(vis, im, **padding)
+        kernel_name, gcf, kernel_list = get_kernel_list(vis, im, **kwargs)
+        gridshape = [nchan, npol, int(round(padding * ny)), int(round(padding * nx))]
+        separable = get_parameter(kwargs, "gridding_separable", True)
+        result = kernel_name, gcf, GriddingPlan(kernel_list, gridshape, vuvwmap, vfrequencymap, padding=padding,
+                                                separable=separable)
+    
+    if use_cache:
+        _gridding_plan_cache[key] = result
+        _trim_gridding_plan_cache()
+    
+    return result
+
+
+def get_nufft_plan(vis: Visibility, im: Image, **kwargs):
+    """ Get the plan for imaging by non-uniform FFT with the ES kernel
+    
+    The support and shape of the kernel and the grid size are chosen for the target accuracy epsilon (default
+    1e-6). The upsampling (the ratio of grid size to image size, which takes the place of padding) is chosen
+    by nufft_parameters unless given. The w term is not corrected.
+    
+    :param vis: Visibility
+    :param im: Image
+    :return: kernel name ('nufft'), gridding correction function, NUFFTPlan
+    """
+    epsilon = get_parameter(kwargs, "epsilon", 1e-6)
+    support, beta, upsampling = nufft_parameters(epsilon, get_parameter(kwargs, "upsampling", None))
+    nchan, npol, ny, nx = im.data.shape
+    assert ny == nx, "NUFFT imaging needs a square image"
+    ngrid = nufft_grid_size(nx, upsampling, support)
+    log.debug("get_nufft_plan: epsilon %g needs support %d and grid size %d" % (epsilon, support, ngrid))
+    spectral_mode, vfrequencymap = get_frequency_map(vis, im)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(vis, im, padding=ngrid / nx)
+    correction = es_correction(ngrid, support, beta)
+    gcf = numpy.outer(correction, correction)
+    return 'nufft', gcf, NUFFTPlan([nchan, npol, ngrid, ngrid], vuvwmap, vfrequencymap, support, beta,
+                                   padding=padding)
+
+
+def get_evaluated_kernel_plan(vis: Visibility, im: Image, **kwargs):
+    """ Get the plan for gridding with one of gridding_kernels evaluated at each visibility
+    
+    The kernel (see get_kernel_family), support and padding are as for get_kernel_list, but the kernel is
+    evaluated exactly, as for the NUFFT, rather than looked up in an oversampled table. The accuracy is then set by
+    the kernel and no longer by the oversampling. For the unit test model the largest error of the predicted
+    visibilities, relative to their peak, is about 1e-4 for support 3, 4e-6 for support 4 and 3e-9 for support 6
+    at padding=1.25, against 3e-2 for the table of grdsf with support 3 at padding=2.
+    
+    :param vis: Visibility
+    :param im: Image
+    :return: kernel name ('2d'), gridding correction function, NUFFTPlan
+    """
+    padding = get_parameter(kwargs, "padding", 2)
+    support = get_parameter(kwargs, "support", 3)
+    kernel = get_kernel_family(**kwargs)
+    nchan, npol, ny, nx = im.data.shape
+    spectral_mode, vfrequencymap = get_frequency_map(vis, im)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(vis, im, padding=padding)
+    gridshape = [nchan, npol, int(round(padding * ny)), int(round(padding * nx))]
+    gcf, _ = anti_aliasing_calculate(gridshape[2:], support=support, kernel=kernel, padding=padding)
+    # The kernel is scaled to unit integral, to match the gridding correction
+    beta = kernel_shape_parameter(support, padding)
+    scale = 1.0 / gridding_kernel_integral(kernel, support, beta)
+    return '2d', gcf, NUFFTPlan(gridshape, vuvwmap, vfrequencymap, 2 * support, beta, padding=padding,
+                                kernel=gridding_kernels[kernel], scale=scale)
+
+
+def get_idg_plan(vis: Visibility, im: Image, **kwargs):
+    """ Get the plan for image domain gridding
+    
+    The w term is applied exactly in the image of each subgrid, so no w kernels are needed. The parameters
+    are padding (default 2), subgrid_size (default 32), support (the half width in pixels of the Fourier
+    transform of the taper, default 4) and idg_kernel (the kernel family of the taper, default
+    'kaiser_bessel'). See IDGPlan.
+    
+    :param vis: Visibility
+    :param im: Image
+    :return: kernel name ('idg'), gridding correction function, IDGPlan
+    """
+    padding = get_parameter(kwargs, "padding", 2)
+    subgrid_size = get_parameter(kwargs, "subgrid_size", 32)
+    support = get_parameter(kwargs, "support", 4)
+    kernel = get_parameter(kwargs, "idg_kernel", 'kaiser_bessel')
+    nchan, npol, ny, nx = im.data.shape
+    spectral_mode, vfrequencymap = get_frequency_map(vis, im)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(vis, im, padding=padding)
+    gridshape = [nchan, npol, int(round(padding * ny)), int(round(padding * nx))]
+    cellsize = numpy.abs(im.wcs.wcs.cdelt[0:2]) * numpy.pi / 180.0
+    field_of_view = (cellsize[1] * gridshape[2], cellsize[0] * gridshape[3])
+    gcf = numpy.outer(idg_correction(gridshape[2], support, kernel), idg_correction(gridshape[3], support, kernel))
+    return 'idg', gcf, IDGPlan(gridshape, vuvwmap, vfrequencymap, vis.w, field_of_view, subgrid_size=subgrid_size,
+                               support=support, kernel=kernel, padding=padding)
@@ -57,7 +57,9 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
         comp, residual = deconvolve_cube(dirty, psf, niter=1000, gain=0.7, algorithm='msclean',
                                          scales=[0, 3, 10, 30], threshold=0.01)
                                          
-    For the MFS clean, the psf must have number of channels >= 2 * nmoments
+    For the MFS clean, the psf must have number of channels >= 2 * nmoments. Alternatively the dirty image and psf
+    may be the frequency moment images themselves (with a MOMENT axis, as made by invert_mfs), with nmoments and
+    2 * nmoments moments. The results are then moment images.
     
     :param dirty: Image dirty image
     :param psf: Image Point Spread Function
@@ -135,12 +137,21 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
         
         log.info("deconvolve_cube %s: Multi-scale multi-frequency clean of each polarisation separately"
                  % prefix)
-        nmoments = get_parameter(kwargs, "nmoments", 3)
-        assert nmoments > 0, "Number of frequency moments must be greater than zero"
-        nchan = dirty.shape[0]
-        assert nchan > 2 * nmoments, "Require nchan %d > 2 * nmoments %d" % (nchan, 2 * nmoments)
-        dirty_taylor = calculate_image_frequency_moments(dirty, nmoments=nmoments)
-        psf_taylor = calculate_image_frequency_moments(psf, nmoments=2 * nmoments)
+        given_moments = dirty.wcs.wcs.ctype[3] == 'MOMENT'
+        if given_moments:
+            # The moments were made by the imaging e.g. invert_mfs
+            nmoments = dirty.shape[0]
+            assert psf.wcs.wcs.ctype[3] == 'MOMENT', "The psf must also be a moment image"
+            assert psf.shape[0] == 2 * nmoments, "Require %d psf moments" % (2 * nmoments)
+            dirty_taylor = copy_image(dirty)
+            psf_taylor = copy_image(psf)
+        else:
+            nmoments = get_parameter(kwargs, "nmoments", 3)
+            assert nmoments > 0, "Number of frequency moments must be greater than zero"
+            nchan = dirty.shape[0]
+            assert nchan > 2 * nmoments, "Require nchan %d > 2 * nmoments %d" % (nchan, 2 * nmoments)
+            dirty_taylor = calculate_image_frequency_moments(dirty, nmoments=nmoments)
+            psf_taylor = calculate_image_frequency_moments(psf, nmoments=2 * nmoments)
         psf_peak = numpy.max(psf_taylor.data)
         dirty_taylor.data /= psf_peak
         psf_taylor.data /= psf_peak
@@ -185,7 +196,7 @@ def deconvolve_cube(dirty: Image, psf: Image, prefix='', **kwargs) -> (Image, Im
         residual_image = create_image_from_array(residual_array, dirty_taylor.wcs, dirty.polarisation_frame)
         
         return_moments = get_parameter(kwargs, "return_moments", False)
-        if not return_moments:
+        if not return_moments and not given_moments:
             log.info("deconvolve_cube %s: calculating spectral cubes" % prefix)
             comp_image = calculate_image_from_frequency_moments(dirty, comp_image)
             residual_image = calculate_image_from_frequency_moments(dirty, residual_image)
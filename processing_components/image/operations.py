@@ -187,6 +187,21 @@ def smooth_image(model: Image, width=1.0):
     return cmodel
 
 
+def frequency_moment_wcs(wcs: WCS) -> WCS:
+    """WCS of a frequency moment image, with a MOMENT axis in place of the spectral axis
+
+    :param wcs: WCS of the image cube
+    :return: New WCS
+    """
+    moment_wcs = copy.deepcopy(wcs)
+    moment_wcs.wcs.ctype[3] = 'MOMENT'
+    moment_wcs.wcs.crval[3] = 0.0
+    moment_wcs.wcs.crpix[3] = 1.0
+    moment_wcs.wcs.cdelt[3] = 1.0
+    moment_wcs.wcs.cunit[3] = ''
+    return moment_wcs
+
+
 def calculate_image_frequency_moments(im: Image, reference_frequency=None, nmoments=3) -> Image:
     """Calculate frequency weighted moments
     
@@ -224,14 +239,7 @@ def calculate_image_frequency_moments(im: Image, reference_frequency=None, nmome
             weight = numpy.power((freq[chan] - reference_frequency) / reference_frequency, moment)
             moment_data[moment, ...] += im.data[chan, ...] * weight
     
-    moment_wcs = copy.deepcopy(im.wcs)
-    moment_wcs.wcs.ctype[3] = 'MOMENT'
-    moment_wcs.wcs.crval[3] = 0.0
-    moment_wcs.wcs.crpix[3] = 1.0
-    moment_wcs.wcs.cdelt[3] = 1.0
-    moment_wcs.wcs.cunit[3] = ''
-    
-    return create_image_from_array(moment_data, moment_wcs, im.polarisation_frame)
+    return create_image_from_array(moment_data, frequency_moment_wcs(im.wcs), im.polarisation_frame)
 
 
 def calculate_image_from_frequency_moments(im: Image, moment_image: Image, reference_frequency=None) -> Image:
@@ -20,6 +20,7 @@ extra phase term in the Fourier transform cannot be ignored.
 """
 
 import collections
+import copy
 import logging
 from typing import List, Union, Tuple
 
@@ -33,12 +34,16 @@ from data_models.memory_data_models import Visibility, BlockVisibility, Image, S
 from data_models.parameters import get_parameter
 from data_models.polarisation import convert_pol_frame, PolarisationFrame
 
-from libs.fourier_transforms.convolutional_gridding import convolutional_grid, convolutional_degrid
-from libs.fourier_transforms.fft_support import fft, ifft, pad_mid, extract_mid
+from libs.fourier_transforms.convolutional_gridding import convolutional_grid, convolutional_degrid, \
+    fold_half_plane, unfold_half_plane
+from libs.fourier_transforms.fft_support import fft, ifft, rfft, irfft, pad_mid, extract_mid, workspace_pool
+from libs.fourier_transforms.idg import IDGPlan, idg_grid, idg_degrid
 from libs.image.operations import create_image_from_array
-from libs.imaging.imaging_params import get_frequency_map, get_polarisation_map, get_uvw_map, get_kernel_list
+from libs.imaging.imaging_params import get_frequency_map, get_polarisation_map, get_gridding_plan, \
+    get_gridding_options
 from libs.util.coordinate_support import simulate_point, skycoord_to_lmn
 
+from ..image.operations import frequency_moment_wcs
 from ..visibility.base import copy_visibility, phaserotate_visibility
 from ..visibility.coalesce import coalesce_visibility, decoalesce_visibility, convert_blockvisibility_to_visibility
 
@@ -80,6 +85,26 @@ def shift_vis_to_image(vis: Visibility, im: Image, tangent: bool = True, inverse
     return vis
 
 
+def image_shift_phasor(vis: Visibility, im: Image):
+    """ Phasor of each row that shifts the visibility to the FFT phase centre of the image on the tangent plane
+    
+    Multiplying the visibility array by the phasor does what shift_vis_to_image does with tangent True, without
+    copying the visibility. The phasor is also the visibility of a unit point source at the image phase centre.
+    
+    :param vis: Visibility data
+    :param im: Image model used to determine phase centre
+    :return: phasor [nvis], or None if no shift is needed
+    """
+    nchan, npol, ny, nx = im.data.shape
+    image_phasecentre = pixel_to_skycoord(nx // 2 + 1, ny // 2 + 1, im.wcs, origin=1)
+    if vis.phasecentre.separation(image_phasecentre).rad <= 1e-15:
+        return None
+    l, m, n = skycoord_to_lmn(image_phasecentre, vis.phasecentre)
+    if numpy.abs(n) <= 1e-15:
+        return None
+    return numpy.conj(simulate_point(vis.uvw, l, m))
+
+
 def normalize_sumwt(im: Image, sumwt) -> Image:
     """Normalize out the sum of weights
 
@@ -107,6 +132,9 @@ def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image,
     This is at the bottom of the layering i.e. all transforms are eventually expressed in terms of
     this function. Any shifting needed is performed here.
 
+    The gridding options are described in get_gridding_options. If half_plane is True and the model is real,
+    only the u >= 0 half of the grid is calculated, using rfft (see GriddingPlan.half_plane).
+
     :param vis: Visibility to be predicted
     :param model: model image
     :return: resulting visibility (in place works)
@@ -119,21 +147,57 @@ def predict_2d(vis: Union[BlockVisibility, Visibility], model: Image,
     
     assert isinstance(avis, Visibility), avis
     
-    _, _, ny, nx = model.data.shape
-    
-    padding = {}
-    if get_parameter(kwargs, "padding", False):
-        padding = {'padding': get_parameter(kwargs, "padding", False)}
-    spectral_mode, vfrequencymap = get_frequency_map(avis, model)
     polarisation_mode, vpolarisationmap = get_polarisation_map(avis, model)
-    uvw_mode, shape, padding, vuvwmap = get_uvw_map(avis, model, **padding)
-    kernel_name, gcf, vkernellist = get_kernel_list(avis, model, **kwargs)
+    kernel_name, gcf, plan = get_gridding_plan(avis, model, **kwargs)
+    avis.data['vis'] = predict_2d_plan(model.data, avis.data['vis'].shape, gcf, plan, **kwargs)
     
-    uvgrid = fft((pad_mid(model.data, int(round(padding * nx))) * gcf).astype(dtype=complex))
+    return _predict_2d_shift(vis, avis, model)
+
+
+def predict_2d_plan(model, vshape, gcf, plan, **kwargs):
+    """ Degrid visibilities from a model image array with a gridding plan
     
-    avis.data['vis'] = convolutional_degrid(vkernellist, avis.data['vis'].shape, uvgrid, vuvwmap, vfrequencymap)
+    This is the part of predict_2d after the gridding plan is found, for callers that use one plan for several
+    images of the same geometry (e.g. the facets in predict_facets). The parameters are as for predict_2d.
     
-    # Now we can shift the visibility from the image frame to the original visibility frame
+    :param model: Model image array [nchan, npol, ny, nx]
+    :param vshape: Shape of the visibility array
+    :param gcf: Gridding correction function of the plan
+    :param plan: Gridding plan (see get_gridding_plan)
+    :return: visibility array
+    """
+    complex_type, real_type, degridding_options, fft_options = get_gridding_options(degrid=True, **kwargs)
+    half_plane = get_parameter(kwargs, "half_plane", False) and numpy.isrealobj(model) and \
+        not isinstance(plan, IDGPlan)
+    
+    nchan, npol, _, _ = model.shape
+    npad = plan.shape[-1]
+    if half_plane:
+        hplan = plan.half_plane()
+        with workspace_pool.buffer([nchan, npol, npad, npad], real_type, zero=False) as padded:
+            pad_mid(model, npad, out=padded)
+            padded *= gcf.astype(real_type, copy=False)
+            half = rfft(padded, **fft_options)
+        with workspace_pool.buffer(hplan.shape, complex_type, zero=False) as uvgrid:
+            unfold_half_plane(half, uvgrid, hplan.kernel_shape)
+            del half
+            return convolutional_degrid(plan.kernel_list, vshape, uvgrid, plan=hplan, **degridding_options)
+    
+    # The padded grid comes from the workspace pool and is the only grid sized array: the padding, the
+    # gridding correction and the FFT are done in place
+    with workspace_pool.buffer([nchan, npol, npad, npad], complex_type, zero=False) as uvgrid:
+        pad_mid(model, npad, out=uvgrid)
+        uvgrid *= gcf.astype(real_type, copy=False)
+        fft(uvgrid, out=uvgrid, **fft_options)
+        if isinstance(plan, IDGPlan):
+            return idg_degrid(vshape, uvgrid, plan)
+        else:
+            return convolutional_degrid(plan.kernel_list, vshape, uvgrid, plan=plan, **degridding_options)
+
+
+def _predict_2d_shift(vis, avis, model):
+    """ Shift the predicted visibility from the image frame to the original visibility frame
+    """
     svis = shift_vis_to_image(avis, model, tangent=True, inverse=True)
     
     if isinstance(vis, BlockVisibility) and isinstance(svis, Visibility):
@@ -147,11 +211,16 @@ def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool =
         -> (Image, numpy.ndarray):
     """ Invert using 2D convolution function, including w projection optionally
 
-    Use the image im as a template. Do PSF in a separate call.
+    Use the image im as a template. Do PSF in a separate call, or with withpsf in the same call.
 
     This is at the bottom of the layering i.e. all transforms are eventually expressed in terms
     of this function. . Any shifting needed is performed here.
 
+    The gridding options are described in get_gridding_options. If half_plane is True (and imaginary is not)
+    only the u >= 0 half of the grid is calculated, using irfft (see GriddingPlan.half_plane). If withpsf is True
+    the PSF is gridded in the same pass, as extra polarisations of the grid (see GriddingPlan.with_polarisations),
+    and the result is (dirty image, sum of weights, psf).
+
     :param vis: Visibility to be inverted
     :param im: image template (not changed)
     :param dopsf: Make the psf instead of the dirty image
@@ -159,41 +228,51 @@ def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool =
     :return: resulting image
 
     """
+    withpsf = get_parameter(kwargs, "withpsf", False)
+    assert not (withpsf and (dopsf or get_parameter(kwargs, "imaginary", False))), \
+        "withpsf cannot be combined with dopsf or imaginary"
+    
     if not isinstance(vis, Visibility):
         svis = coalesce_visibility(vis, **kwargs)
     else:
-        svis = copy_visibility(vis)
+        svis = vis
     
+    # The shift to the image phase centre is applied to the visibility array, and is the visibility of the psf
+    phasor = image_shift_phasor(svis, im)
     if dopsf:
-        svis.data['vis'] = numpy.ones_like(svis.data['vis'])
-    
-    svis = shift_vis_to_image(svis, im, tangent=True, inverse=False)
+        visdata = numpy.ones_like(svis.data['vis'])
+    else:
+        visdata = svis.data['vis']
+    if phasor is not None:
+        visdata = visdata * phasor[:, numpy.newaxis]
     
     nchan, npol, ny, nx = im.data.shape
     
-    padding = {}
-    if get_parameter(kwargs, "padding", False):
-        padding = {'padding': get_parameter(kwargs, "padding", False)}
-    spectral_mode, vfrequencymap = get_frequency_map(svis, im)
     polarisation_mode, vpolarisationmap = get_polarisation_map(svis, im)
-    uvw_mode, shape, padding, vuvwmap = get_uvw_map(svis, im, **padding)
-    kernel_name, gcf, vkernellist = get_kernel_list(svis, im, **kwargs)
-    
-    # Optionally pad to control aliasing
-    imgridpad = numpy.zeros([nchan, npol, int(round(padding * ny)), int(round(padding * nx))], dtype='complex')
-    imgridpad, sumwt = convolutional_grid(vkernellist, imgridpad, svis.data['vis'], svis.data['imaging_weight'],
-                                          vuvwmap, vfrequencymap)
-    
-    # Fourier transform the padded grid to image, multiply by the gridding correction
-    # function, and extract the unpadded inner part.
-    
-    # Normalise weights for consistency with transform
-    sumwt /= float(padding * int(round(padding * nx)) * ny)
-    
-    imaginary = get_parameter(kwargs, "imaginary", False)
-    if imaginary:
+    kernel_name, gcf, plan = get_gridding_plan(svis, im, **kwargs)
+    if withpsf and not isinstance(plan, IDGPlan):
+        # The dirty image is the first npol polarisations of the grid and the PSF the last npol
+        result, sumwt = invert_2d_plan(visdata, svis.data['imaging_weight'], nx, gcf,
+                                       plan.with_polarisations(2 * npol), psf_factors=numpy.ones([svis.nvis, 1]),
+                                       psf_phasor=phasor, **kwargs)
+        result, psfresult, sumwt = result[:, :npol], result[:, npol:], sumwt[:, :npol]
+    else:
+        result, sumwt = invert_2d_plan(visdata, svis.data['imaging_weight'], nx, gcf, plan, **kwargs)
+        if withpsf:
+            psfdata = numpy.ones_like(svis.data['vis'])
+            if phasor is not None:
+                psfdata *= phasor[:, numpy.newaxis]
+            psfresult, _ = invert_2d_plan(psfdata, svis.data['imaging_weight'], nx, gcf, plan, **kwargs)
+    
+    if withpsf:
+        resultimage = create_image_from_array(result, im.wcs, im.polarisation_frame)
+        psfimage = create_image_from_array(psfresult, im.wcs, im.polarisation_frame)
+        if normalize:
+            resultimage = normalize_sumwt(resultimage, sumwt)
+            psfimage = normalize_sumwt(psfimage, sumwt)
+        return resultimage, sumwt, psfimage
+    elif get_parameter(kwargs, "imaginary", False):
         log.debug("invert_2d: retaining imaginary part of dirty image")
-        result = extract_mid(ifft(imgridpad) * gcf, npixel=nx)
         resultreal = create_image_from_array(result.real, im.wcs, im.polarisation_frame)
         resultimag = create_image_from_array(result.imag, im.wcs, im.polarisation_frame)
         if normalize:
@@ -201,13 +280,209 @@ def invert_2d(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool =
             resultimag = normalize_sumwt(resultimag, sumwt)
         return resultreal, sumwt, resultimag
     else:
-        result = extract_mid(numpy.real(ifft(imgridpad)) * gcf, npixel=nx)
         resultimage = create_image_from_array(result, im.wcs, im.polarisation_frame)
         if normalize:
             resultimage = normalize_sumwt(resultimage, sumwt)
         return resultimage, sumwt
 
 
+def invert_2d_plan(vis, weights, npixel, gcf, plan, factors=None, psf_factors=None, psf_phasor=None, **kwargs):
+    """ Grid a visibility array with a gridding plan and transform to an image array
+    
+    This is the part of invert_2d after the gridding plan is found, for callers that use one plan for several
+    images of the same geometry (e.g. the facets in invert_facets). The parameters are as for invert_2d. The
+    image is complex if imaginary is True.
+    
+    Several images of the same rows may be made at once as terms of the grid, with factors, psf_factors and
+    psf_phasor as for convolutional_grid. The plan is then for the polarisations of all the terms (see
+    GriddingPlan.with_polarisations). This is not supported by image domain gridding.
+    
+    :param vis: Visibility array, already shifted to the image phase centre
+    :param weights: Imaging weights
+    :param npixel: Number of pixels on each axis of the image
+    :param gcf: Gridding correction function of the plan
+    :param plan: Gridding plan (see get_gridding_plan)
+    :param factors: Real factors [nvis, nterms] of the terms of the visibilities (default None: one term of 1)
+    :param psf_factors: Real factors [nvis, npsfterms] of the terms of the PSF (default None: no PSF terms)
+    :param psf_phasor: Visibility of a unit point source for each row [nvis] (default None: 1)
+    :return: image array [nchan, npol, npixel, npixel], sumwt
+    """
+    assert not (isinstance(plan, IDGPlan) and (factors is not None or psf_factors is not None)), \
+        "Image domain gridding does not support terms"
+    nchan, npol = plan.shape[:2]
+    nypad, nxpad = plan.shape[-2:]
+    
+    # Optionally pad to control aliasing. The padded grid comes from the workspace pool.
+    complex_type, real_type, gridding_options, fft_options = get_gridding_options(**kwargs)
+    imaginary = get_parameter(kwargs, "imaginary", False)
+    half_plane = get_parameter(kwargs, "half_plane", False) and not imaginary and not isinstance(plan, IDGPlan)
+    
+    # The FFT is done in place and the gridding correction applied only to the unpadded part
+    gcf = extract_mid(gcf, npixel=npixel).astype(real_type, copy=False)
+    
+    if half_plane:
+        hplan = plan.half_plane()
+        with workspace_pool.buffer(hplan.shape, complex_type) as imgridhalf:
+            imgridhalf, sumwt = convolutional_grid(plan.kernel_list, imgridhalf, vis, weights, plan=hplan,
+                                                   factors=factors, psf_factors=psf_factors, psf_phasor=psf_phasor,
+                                                   **gridding_options)
+            imgridpad = irfft(fold_half_plane(imgridhalf, hplan.kernel_shape), nxpad, **fft_options)
+        result = extract_mid(imgridpad, npixel=npixel) * gcf
+    else:
+        with workspace_pool.buffer([nchan, npol, nypad, nxpad], complex_type) as imgridpad:
+            if isinstance(plan, IDGPlan):
+                imgridpad, sumwt = idg_grid(imgridpad, vis, weights, plan)
+            else:
+                imgridpad, sumwt = convolutional_grid(plan.kernel_list, imgridpad, vis, weights, plan=plan,
+                                                      factors=factors, psf_factors=psf_factors,
+                                                      psf_phasor=psf_phasor, **gridding_options)
+        
+            # Fourier transform the padded grid to image, multiply by the gridding correction
+            # function, and extract the unpadded inner part.
+            imgridpad = ifft(imgridpad, out=imgridpad, **fft_options)
+            if imaginary:
+                result = extract_mid(imgridpad, npixel=npixel) * gcf
+            else:
+                result = extract_mid(numpy.real(imgridpad), npixel=npixel) * gcf
+    
+    # Normalise weights for consistency with transform
+    sumwt /= float(nypad * nxpad)
+    return result, sumwt
+
+
+def predict_nufft(vis: Union[BlockVisibility, Visibility], model: Image,
+                  **kwargs) -> Union[BlockVisibility, Visibility]:
+    """ Predict using a type 2 non-uniform FFT
+    
+    This is predict_2d with the ES kernel evaluated at each visibility (see get_nufft_plan). The epsilon
+    parameter sets the target accuracy (default 1e-6) and upsampling optionally sets the ratio of grid size
+    to image size (1.25 for epsilon >= 1e-8, otherwise 2).
+    
+    :param vis: Visibility to be predicted
+    :param model: model image
+    :return: resulting visibility (in place works)
+    """
+    return predict_2d(vis, model, **dict(kwargs, kernel='nufft'))
+
+
+def invert_nufft(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool = True, **kwargs) \
+        -> (Image, numpy.ndarray):
+    """ Invert using a type 1 non-uniform FFT
+    
+    This is invert_2d with the ES kernel evaluated at each visibility. The parameters are as for predict_nufft.
+    
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :return: resulting image
+    """
+    return invert_2d(vis, im, dopsf=dopsf, normalize=normalize, **dict(kwargs, kernel='nufft'))
+
+
+def predict_idg(vis: Union[BlockVisibility, Visibility], model: Image,
+                **kwargs) -> Union[BlockVisibility, Visibility]:
+    """ Predict using image domain gridding
+    
+    This is predict_2d with the visibilities degridded from subgrids whose images include the w term (see
+    get_idg_plan), so the w term is corrected without w kernels. The subgrid_size (32), support (4) and
+    idg_kernel ('kaiser_bessel') parameters set the subgrids and the taper.
+    
+    :param vis: Visibility to be predicted
+    :param model: model image
+    :return: resulting visibility (in place works)
+    """
+    return predict_2d(vis, model, **dict(kwargs, kernel='idg'))
+
+
+def invert_idg(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool = True, **kwargs) \
+        -> (Image, numpy.ndarray):
+    """ Invert using image domain gridding
+    
+    This is invert_2d with the visibilities gridded through subgrids whose images include the w term. The
+    parameters are as for predict_idg.
+    
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :return: resulting image
+    """
+    return invert_2d(vis, im, dopsf=dopsf, normalize=normalize, **dict(kwargs, kernel='idg'))
+
+
+def invert_mfs(vis: Visibility, im: Image, nmoments=3, reference_frequency=None, normalize: bool = True,
+               **kwargs) -> (Image, numpy.ndarray):
+    """ Invert to the frequency moment (Taylor term) images of multi-frequency synthesis in one gridding pass
+    
+    Moment k is the image of the visibilities of all channels weighted by ((f - f0) / f0) ** k, where f0 is
+    the reference frequency (default the average of the channel frequencies of the visibility), as needed by
+    deconvolve_cube with algorithm='msmfsclean'. The moments are gridded onto one channel as the polarisations of
+    one grid (see GriddingPlan.with_polarisations). The frequency weighting is applied to each block of rows as
+    it is gridded (see convolutional_grid), so the kernel of each row is evaluated once for all moments and no
+    channel-weighted copies of the visibility are made. All moments are normalised by the sum of weights of
+    moment 0. Give the same reference_frequency for all the parts of a visibility set that are to be summed.
+    
+    If withpsf is True the 2 * nmoments moments of the PSF are gridded in the same pass, from the weights, and the
+    result is then (moments, sum of weights, psf moments). The other parameters are as for invert_2d, apart from
+    dopsf and imaginary which are not supported. Image domain gridding is not supported.
+    
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed), the spectral axis is not used
+    :param nmoments: Number of frequency moments (default 3)
+    :param reference_frequency: Reference frequency f0 (default None uses average)
+    :param normalize: Normalize by the sum of weights (True)
+    :return: moment image [nmoments, npol, ny, nx] with a MOMENT axis, sum of weights [1, npol]
+    """
+    assert nmoments > 0, "Number of frequency moments must be greater than zero"
+    assert not get_parameter(kwargs, "dopsf", False), "invert_mfs makes the psf with withpsf"
+    assert not get_parameter(kwargs, "imaginary", False), "invert_mfs does not keep the imaginary part"
+    withpsf = get_parameter(kwargs, "withpsf", False)
+    
+    if not isinstance(vis, Visibility):
+        svis = coalesce_visibility(vis, **kwargs)
+    else:
+        svis = vis
+    
+    phasor = image_shift_phasor(svis, im)
+    visdata = svis.data['vis'] if phasor is None else svis.data['vis'] * phasor[:, numpy.newaxis]
+    
+    if reference_frequency is None:
+        reference_frequency = numpy.average(numpy.unique(svis.frequency))
+    log.debug("invert_mfs: Reference frequency = %.3f (MHz)" % (reference_frequency / 1e6))
+    
+    # All channels are gridded onto the one channel of the template
+    nchan, npol, ny, nx = im.data.shape
+    mfs_wcs = copy.deepcopy(im.wcs)
+    mfs_wcs.wcs.crpix[3] = 1.0
+    mfs_wcs.wcs.crval[3] = reference_frequency
+    mfs = create_image_from_array(numpy.zeros([1, npol, ny, nx]), mfs_wcs, im.polarisation_frame)
+    kernel_name, gcf, plan = get_gridding_plan(svis, mfs, **kwargs)
+    assert not isinstance(plan, IDGPlan), "invert_mfs does not support image domain gridding"
+    
+    # The grid polarisations are moment-major: the moments of the visibility, then those of the psf. The
+    # frequency weighting of each moment is applied to the rows as they are gridded.
+    npsf = 2 * nmoments if withpsf else 0
+    taylor = ((svis.frequency - reference_frequency) / reference_frequency)[:, numpy.newaxis] ** \
+        numpy.arange(max(nmoments, npsf))[numpy.newaxis, :]
+    result, sumwt = invert_2d_plan(visdata, svis.data['imaging_weight'], nx, gcf,
+                                   plan.with_polarisations((nmoments + npsf) * npol), factors=taylor[:, :nmoments],
+                                   psf_factors=taylor[:, :npsf] if withpsf else None, psf_phasor=phasor, **kwargs)
+    result = result.reshape([nmoments + npsf, npol, ny, nx])
+    sumwt = sumwt[:, :npol]
+    
+    moment_wcs = frequency_moment_wcs(im.wcs)
+    resultimage = create_image_from_array(result[:nmoments], moment_wcs, im.polarisation_frame)
+    if normalize:
+        resultimage = normalize_sumwt(resultimage, numpy.repeat(sumwt, nmoments, axis=0))
+    if withpsf:
+        psfimage = create_image_from_array(result[nmoments:], moment_wcs, im.polarisation_frame)
+        if normalize:
+            psfimage = normalize_sumwt(psfimage, numpy.repeat(sumwt, npsf, axis=0))
+        return resultimage, sumwt, psfimage
+    return resultimage, sumwt
+
+
 def predict_skycomponent_visibility(vis: Union[Visibility, BlockVisibility],
                                     sc: Union[Skycomponent, List[Skycomponent]]) -> Union[Visibility, BlockVisibility]:
     """Predict the visibility from a Skycomponent, add to existing visibility, for Visibility or BlockVisibility
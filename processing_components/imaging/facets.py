@@ -0,0 +1,160 @@
+"""
+Faceted imaging divides the image into facets, each imaged on its own tangent plane grid after the visibilities are
+phase rotated to the centre of the facet. On the same tangent plane the rotation only changes the phases, so the uvw
+and hence the grid coordinates are the same for every facet.
+
+predict_facets and invert_facets process all the facets in one pass over the visibilities: the phase rotations for
+all facets are calculated in one array operation and the grid coordinates are calculated once for all facets.
+"""
+
+from typing import Union
+
+import numpy
+from astropy.wcs.utils import pixel_to_skycoord
+
+from data_models.memory_data_models import Visibility, Image, BlockVisibility
+from data_models.parameters import get_parameter
+
+from libs.imaging.imaging_params import get_gridding_plan, get_kernel_list
+from libs.util.coordinate_support import skycoord_to_lmn
+
+from ..image.gather_scatter import image_scatter_facets
+from ..image.operations import create_empty_image_like
+from ..visibility.coalesce import coalesce_visibility, decoalesce_visibility
+from ..imaging.base import predict_2d_plan, invert_2d_plan, normalize_sumwt
+
+import logging
+log = logging.getLogger(__name__)
+
+
+def facet_phasors(vis: Visibility, facet_list):
+    """ Phasors that shift the visibility from its phase centre to the centres of the facets
+    
+    The facet centre is the FFT phase centre of the facet image, as in shift_vis_to_image. The phasor for a row
+    and facet is that of a unit point source at the centre of the facet (see simulate_point), and the phases for
+    all facets are calculated in one matrix product.
+    
+    :param vis: Visibility
+    :param facet_list: List of facet images
+    :return: phasors [nvis, nfacets]
+    """
+    s = numpy.zeros([3, len(facet_list)])
+    for facet, facet_image in enumerate(facet_list):
+        _, _, ny, nx = facet_image.shape
+        facet_centre = pixel_to_skycoord(nx // 2 + 1, ny // 2 + 1, facet_image.wcs, origin=1)
+        l, m, _ = skycoord_to_lmn(facet_centre, vis.phasecentre)
+        s[:, facet] = [l, m, numpy.sqrt(1.0 - l ** 2 - m ** 2) - 1.0]
+    return numpy.exp(-2j * numpy.pi * numpy.dot(vis.uvw, s))
+
+
+def facet_plans(vis: Visibility, facet_list, **kwargs):
+    """ Gridding plans for all the facets, sharing one set of grid coordinates
+    
+    The grid coordinates depend on the uvw and on the shape and cellsize of the image but not on its centre, so
+    they are calculated once, for the first facet, in its cached gridding plan. The anti-aliasing kernel is the
+    same for every facet. The w kernels (for w projection) are evaluated at the position of each facet on the sky,
+    so each facet then has its own kernels (see GriddingPlan.with_kernels), kept with the cached plan.
+    
+    :param vis: Visibility
+    :param facet_list: List of facet images
+    :return: gridding correction function, list of GriddingPlan
+    """
+    assert len(facet_list) > 0, "No facets"
+    shape = facet_list[0].shape
+    assert all(facet_image.shape == shape for facet_image in facet_list), "Facets must all have the same shape"
+    assert shape[2] == shape[3], "Facets must be square"
+    kernel_name, gcf, plan = get_gridding_plan(vis, facet_list[0], **kwargs)
+    if kernel_name != 'wprojection':
+        return gcf, len(facet_list) * [plan]
+    
+    def facet_kernel_list(facet_image):
+        return lambda: get_kernel_list(vis, facet_image, **kwargs)[2]
+    
+    return gcf, [plan.with_kernels(tuple(facet_image.wcs.wcs.crpix[0:2]), facet_kernel_list(facet_image))
+                 for facet_image in facet_list]
+
+
+def predict_facets(vis: Union[BlockVisibility, Visibility], model: Image, facets=1, overlap=0,
+                   **kwargs) -> Union[BlockVisibility, Visibility]:
+    """ Predict using facets in a single pass over the visibilities
+    
+    The model is divided into facets x facets facets (see image_scatter_facets). Each facet is degridded using the
+    same grid coordinates (see facet_plans) and shifted back to the visibility phase centre (see facet_phasors),
+    and the results summed. The other parameters are as for predict_2d.
+    
+    :param vis: Visibility to be predicted
+    :param model: model image
+    :param facets: Number of facets on each axis
+    :param overlap: Overlap of facets in pixels
+    :return: resulting visibility (in place works)
+    """
+    if isinstance(vis, BlockVisibility):
+        log.debug("predict_facets: coalescing prior to prediction")
+        avis = coalesce_visibility(vis, **kwargs)
+    else:
+        avis = vis
+    
+    assert isinstance(avis, Visibility), avis
+    
+    facet_list = image_scatter_facets(model, facets=facets, overlap=overlap)
+    gcf, plans = facet_plans(avis, facet_list, **kwargs)
+    phasors = facet_phasors(avis, facet_list)
+    
+    vshape = avis.data['vis'].shape
+    predicted = numpy.zeros(vshape, dtype='complex')
+    for facet, (facet_image, plan) in enumerate(zip(facet_list, plans)):
+        predicted += predict_2d_plan(facet_image.data, vshape, gcf, plan, **kwargs) * phasors[:, facet, numpy.newaxis]
+    avis.data['vis'] = predicted
+    
+    if isinstance(vis, BlockVisibility):
+        log.debug("predict_facets: decoalescing post prediction")
+        return decoalesce_visibility(avis)
+    else:
+        return avis
+
+
+def invert_facets(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool = True, facets=1, overlap=0,
+                  **kwargs) -> (Image, numpy.ndarray):
+    """ Invert using facets in a single pass over the visibilities
+    
+    The image is divided into facets x facets facets (see image_scatter_facets). The visibilities are shifted to the
+    centres of all the facets at once (see facet_phasors), and each facet is gridded using the same grid
+    coordinates (see facet_plans), which are cached between major cycles as usual. The sum of weights is the same
+    for all the facets. The other parameters are as for invert_2d, apart from imaginary which is not supported.
+    
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :param facets: Number of facets on each axis
+    :param overlap: Overlap of facets in pixels
+    :return: resulting image, sum of weights
+    """
+    assert not get_parameter(kwargs, "imaginary", False), "invert_facets does not keep the imaginary part"
+    
+    if not isinstance(vis, Visibility):
+        svis = coalesce_visibility(vis, **kwargs)
+    else:
+        svis = vis
+    
+    resultimage = create_empty_image_like(im)
+    facet_list = image_scatter_facets(resultimage, facets=facets, overlap=overlap)
+    gcf, plans = facet_plans(svis, facet_list, **kwargs)
+    phasors = numpy.conj(facet_phasors(svis, facet_list))
+    
+    if dopsf:
+        visdata = numpy.ones_like(svis.data['vis'])
+    else:
+        visdata = svis.data['vis']
+    
+    sumwt = None
+    for facet, (facet_image, plan) in enumerate(zip(facet_list, plans)):
+        result, sumwt = invert_2d_plan(visdata * phasors[:, facet, numpy.newaxis], svis.data['imaging_weight'],
+                                       facet_image.shape[3], gcf, plan, **kwargs)
+        # The facet is a view of the result image
+        facet_image.data[...] = result
+    
+    if normalize:
+        resultimage = normalize_sumwt(resultimage, sumwt)
+    
+    return resultimage, sumwt
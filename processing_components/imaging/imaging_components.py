@@ -36,17 +36,20 @@ import numpy
 
 from data_models.memory_data_models import Image
 from data_models.parameters import get_parameter
+from libs.image.iterators import image_null_iter
 from libs.image.operations import copy_image, create_empty_image_like
 from ..component_support.arlexecute import arlexecute
 from ..image.deconvolution import deconvolve_cube, restore_cube
 from ..image.gather_scatter import image_scatter_facets, image_gather_facets, image_scatter_channels, \
     image_gather_channels
-from ..imaging.base import normalize_sumwt
+from ..imaging.base import normalize_sumwt, invert_2d, invert_nufft, invert_idg, invert_mfs
 from ..imaging.imaging_functions import imaging_context
-from ..imaging.weighting import weight_visibility
+from ..imaging.wstack_single import invert_wstack
+from ..imaging.weighting import weight_visibility, density_grid_visibility
 from ..visibility.base import copy_visibility
 from ..visibility.gather_scatter import visibility_scatter, visibility_gather
-from ..image.operations import calculate_image_frequency_moments
+from ..visibility.iterators import vis_null_iter
+from ..image.operations import calculate_image_frequency_moments, calculate_image_from_frequency_moments
 
 log = logging.getLogger(__name__)
 
@@ -84,6 +87,38 @@ def sum_invert_results(image_list):
     return im, sumwt
 
 
+def sum_invert_mfs_results(results):
+    """ Sum a set of invert_mfs results with appropriate weighting
+    
+    The moment images (and psf moment images) are summed weighted by the sums of weights of moment 0.
+
+    :param results: List of (moment image, sumwt) or (moment image, sumwt, psf moment image) tuples
+    :return: moment image, sum of weights [, psf moment image]
+    """
+    results = [result for result in results if result is not None]
+    assert len(results) > 0, "No invert results"
+    sumwt = numpy.sum([result[1] for result in results], axis=0)
+    
+    def weighted_sum(part):
+        im = create_empty_image_like(results[0][part])
+        for result in results:
+            im.data += result[1][..., numpy.newaxis, numpy.newaxis] * result[part].data
+        return normalize_sumwt(im, numpy.repeat(sumwt, im.shape[0], axis=0))
+    
+    if len(results[0]) == 3:
+        return weighted_sum(0), sumwt, weighted_sum(2)
+    return weighted_sum(0), sumwt
+
+
+def mfs_reference_frequency(vis_list):
+    """ Find the default reference frequency of multi-frequency synthesis: the average channel frequency
+    
+    :param vis_list: List of Visibility or BlockVisibility
+    :return: Reference frequency (Hz)
+    """
+    return numpy.average(numpy.unique(numpy.concatenate([vis.frequency for vis in vis_list if vis is not None])))
+
+
 def remove_sumwt(results):
     """ Remove sumwt term in list of tuples (image, sumwt)
     
@@ -182,22 +217,10 @@ def weight_vislist_component(vis_list, model_imagelist, weighting='uniform', **k
     :param vis_list:
     :param model_imagelist: Model required to determine weighting parameters
     :param weighting: Type of weighting
-    :param kwargs: Parameters for functions in components
+    :param kwargs: Parameters for functions in components, see weight_component
     :return: List of vis_lists
    """
-    
-    def weight_vis(vis, model):
-        if vis is not None:
-            if model is not None:
-                vis, _, _ = weight_visibility(vis, model, weighting=weighting, **kwargs)
-                return vis
-            else:
-                return None
-        else:
-            return None
-    
-    return [arlexecute.execute(weight_vis, pure=True, nout=1)(vis_list[i], model_imagelist[i])
-            for i in range(len(vis_list))]
+    return weight_component(vis_list, model_imagelist, weighting=weighting, **kwargs)
 
 
 def invert_component(vis_list, template_model_imagelist, dopsf=False, normalize=True,
@@ -223,16 +246,18 @@ def invert_component(vis_list, template_model_imagelist, dopsf=False, normalize=
     invert = c['invert']
     inner = c['inner']
     
-    if facets % 2 == 0 or facets == 1:
-        actual_number_facets = facets
+    # Contexts that do not iterate over the image (e.g. facets_batched) get all of it, and use facets themselves
+    scatter_facets = 1 if c['image_iterator'] is image_null_iter else facets
+    if scatter_facets % 2 == 0 or scatter_facets == 1:
+        actual_number_facets = scatter_facets
     else:
-        actual_number_facets = max(1, (facets - 1))
+        actual_number_facets = max(1, (scatter_facets - 1))
     
     def gather_image_iteration_results(results, template_model):
         result = create_empty_image_like(template_model)
         i = 0
         sumwt = numpy.zeros([template_model.nchan, template_model.npol])
-        for dpatch in image_scatter_facets(result, facets=facets):
+        for dpatch in image_scatter_facets(result, facets=scatter_facets):
             assert i < len(results), "Too few results in gather_image_iteration_results"
             if results[i] is not None:
                 assert len(results[i]) == 2, results[i]
@@ -254,10 +279,12 @@ def invert_component(vis_list, template_model_imagelist, dopsf=False, normalize=
         # Create the graph to divide an image into facets. This is by reference.
         facet_lists = arlexecute.execute(image_scatter_facets, nout=actual_number_facets ** 2)(template_model_imagelist[
                                                                                                    freqwin],
-                                                                                               facets=facets)
-        # Create the graph to divide the visibility into slices. This is by copy.
-        sub_vis_lists = arlexecute.execute(visibility_scatter, nout=vis_slices)(vis_list, vis_iter,
-                                                                                vis_slices=vis_slices)
+                                                                                               facets=scatter_facets)
+        # Create the graph to divide the visibility into slices. This is by copy. Contexts that do not
+        # iterate over the visibility (e.g. wstack_planes) get all of it, and use vis_slices themselves.
+        scatter_slices = 1 if vis_iter is vis_null_iter else vis_slices
+        sub_vis_lists = arlexecute.execute(visibility_scatter, nout=scatter_slices)(vis_list, vis_iter,
+                                                                                    vis_slices=scatter_slices)
         
         # Iterate within each vis_list
         if inner == 'vis':
@@ -286,6 +313,47 @@ def invert_component(vis_list, template_model_imagelist, dopsf=False, normalize=
     return results_vislist
 
 
+def invert_psf_component(vis_list, template_model_imagelist, normalize=True, facets=1, vis_slices=1, context='2d',
+                         **kwargs):
+    """ Make the dirty images and the PSFs, in one gridding pass where the context allows
+    
+    The contexts that invert all of the visibility and image at once (2d, nufft, idg, wstack_planes, and facets
+    with one facet) grid the visibilities and the PSF together (see invert_2d, withpsf), so the coordinates,
+    kernels and weights are only processed once. For the other contexts this is invert_component without and with dopsf.
+    
+    :param vis_list:
+    :param template_model_imagelist: Model used to determine image parameters
+    :param normalize: Normalize by sumwt
+    :param facets: Number of facets
+    :param vis_slices: Number of slices
+    :param context: Imaging context
+    :param kwargs: Parameters for functions in components
+    :return: list of (dirty image, sumwt), list of (psf, sumwt)
+    """
+    if not isinstance(template_model_imagelist, collections.Iterable):
+        template_model_imagelist = [template_model_imagelist]
+    
+    c = imaging_context(context)
+    invert = c['invert']
+    if facets > 1 or c['vis_iterator'] is not vis_null_iter or c['image_iterator'] is image_null_iter or \
+            invert not in [invert_2d, invert_nufft, invert_idg, invert_wstack]:
+        return (invert_component(vis_list, template_model_imagelist, dopsf=False, normalize=normalize,
+                                 facets=facets, vis_slices=vis_slices, context=context, **kwargs),
+                invert_component(vis_list, template_model_imagelist, dopsf=True, normalize=normalize,
+                                 facets=facets, vis_slices=vis_slices, context=context, **kwargs))
+    
+    def invert_with_psf(vis, model):
+        if vis is None:
+            return (create_empty_image_like(model), 0.0), (create_empty_image_like(model), 0.0)
+        dirty, sumwt, psf = invert(vis, model, normalize=normalize, withpsf=True, facets=facets,
+                                   vis_slices=vis_slices, **kwargs)
+        return (dirty, sumwt), (psf, sumwt.copy())
+    
+    results = [arlexecute.execute(invert_with_psf, nout=2)(vis, template_model_imagelist[freqwin])
+               for freqwin, vis in enumerate(vis_list)]
+    return [result[0] for result in results], [result[1] for result in results]
+
+
 def predict_component(vis_list, model_imagelist, vis_slices=1, facets=1, context='2d', **kwargs):
     """Predict, iterating over both the scattered vis_list and image
     
@@ -308,10 +376,11 @@ def predict_component(vis_list, model_imagelist, vis_slices=1, facets=1, context
     predict = c['predict']
     inner = c['inner']
     
-    if facets % 2 == 0 or facets == 1:
-        actual_number_facets = facets
+    scatter_facets = 1 if c['image_iterator'] is image_null_iter else facets
+    if scatter_facets % 2 == 0 or scatter_facets == 1:
+        actual_number_facets = scatter_facets
     else:
-        actual_number_facets = facets - 1
+        actual_number_facets = scatter_facets - 1
     
     def predict_ignore_none(vis, model):
         if vis is not None:
@@ -324,9 +393,11 @@ def predict_component(vis_list, model_imagelist, vis_slices=1, facets=1, context
     for freqwin, vis_list in enumerate(vis_list):
         # Create the graph to divide an image into facets. This is by reference.
         facet_lists = arlexecute.execute(image_scatter_facets, nout=actual_number_facets ** 2)(model_imagelist[freqwin],
-                                                                                               facets=facets)
+                                                                                               facets=scatter_facets)
         # Create the graph to divide the visibility into slices. This is by copy.
-        sub_vis_lists = arlexecute.execute(visibility_scatter, nout=vis_slices)(vis_list, vis_iter, vis_slices)
+        scatter_slices = 1 if vis_iter is vis_null_iter else vis_slices
+        sub_vis_lists = arlexecute.execute(visibility_scatter, nout=scatter_slices)(vis_list, vis_iter,
+                                                                                    scatter_slices)
         
         if inner == 'vis':
             facet_vis_lists = list()
@@ -362,6 +433,54 @@ def predict_component(vis_list, model_imagelist, vis_slices=1, facets=1, context
     return image_results_list_list
 
 
+def invert_mfs_component(vis_list, template_model_imagelist, nmoments=3, reference_frequency=None, withpsf=True,
+                         facets=1, context='2d', **kwargs):
+    """ Make the frequency moment images of multi-frequency synthesis over all the frequency windows
+    
+    Each frequency window is inverted by invert_mfs, with the moments of the PSF gridded in the same pass if withpsf
+    is True, and the normalised moments are summed over the windows weighted by the sums of weights. All windows use
+    the same reference frequency, by default the average channel frequency of vis_list. The moment images are as
+    needed by deconvolve_mfs_component. Only the contexts that invert with invert_2d on all of the visibility (2d,
+    nufft, facets with one facet) are supported.
+    
+    :param vis_list:
+    :param template_model_imagelist: Model used to determine image parameters
+    :param nmoments: Number of frequency moments (default 3)
+    :param reference_frequency: Reference frequency (default None uses average)
+    :param withpsf: Also make the moments of the PSF (True)
+    :param facets: Number of facets
+    :param context: Imaging context
+    :param kwargs: Parameters for functions in components
+    :return: graph for (moment image, sumwt) and, if withpsf, graph for (psf moment image, sumwt)
+    """
+    if not isinstance(template_model_imagelist, collections.Iterable):
+        template_model_imagelist = [template_model_imagelist]
+    
+    c = imaging_context(context)
+    assert facets == 1 and c['vis_iterator'] is vis_null_iter and c['invert'] in [invert_2d, invert_nufft], \
+        "Multi-frequency synthesis is not supported for context %s" % context
+    if c['invert'] is invert_nufft:
+        kwargs['kernel'] = 'nufft'
+    
+    if reference_frequency is None:
+        reference_frequency = arlexecute.execute(mfs_reference_frequency, nout=1)(vis_list)
+    
+    def invert_window(vis, model, f0):
+        if vis is None:
+            return None
+        return invert_mfs(vis, model, nmoments=nmoments, reference_frequency=f0, withpsf=withpsf, **kwargs)
+    
+    def sum_windows(results):
+        summed = sum_invert_mfs_results(results)
+        if withpsf:
+            return (summed[0], summed[1]), (summed[2], summed[1].copy())
+        return summed
+    
+    results = [arlexecute.execute(invert_window, nout=1)(vis, template_model_imagelist[freqwin], reference_frequency)
+               for freqwin, vis in enumerate(vis_list)]
+    return arlexecute.execute(sum_windows, nout=2 if withpsf else 1)(results)
+
+
 def residual_component(vis, model_imagelist, context='2d', **kwargs):
     """ Create a graph to calculate residual image using w stacking and faceting
 
@@ -380,6 +499,41 @@ def residual_component(vis, model_imagelist, context='2d', **kwargs):
                             **kwargs)
 
 
+def residual_psf_component(vis, model_imagelist, context='2d', **kwargs):
+    """ Create a graph to calculate the residual images and the PSFs in one gridding pass
+    
+    As residual_component, but the PSFs are made from the residual visibilities by invert_psf_component.
+
+    :param vis:
+    :param model_imagelist: Model used to determine image parameters
+    :param context: Imaging context
+    :param kwargs: Parameters for functions in components
+    :return: list of (residual image, sumwt), list of (psf, sumwt)
+    """
+    model_vis = zero_vislist_component(vis)
+    model_vis = predict_component(model_vis, model_imagelist, context=context, **kwargs)
+    residual_vis = subtract_vislist_component(vis, model_vis)
+    return invert_psf_component(residual_vis, model_imagelist, normalize=True, context=context, **kwargs)
+
+
+def residual_mfs_component(vis, model_imagelist, withpsf=False, context='2d', **kwargs):
+    """ Create a graph to calculate the frequency moments of the residual images
+    
+    As residual_component, but the residual visibilities are imaged by invert_mfs_component.
+
+    :param vis:
+    :param model_imagelist: Model used to determine image parameters
+    :param withpsf: Also make the moments of the PSF from the residual visibilities (False)
+    :param context: Imaging context
+    :param kwargs: Parameters for functions in components
+    :return: graph for (moment image, sumwt) and, if withpsf, graph for (psf moment image, sumwt)
+    """
+    model_vis = zero_vislist_component(vis)
+    model_vis = predict_component(model_vis, model_imagelist, context=context, **kwargs)
+    residual_vis = subtract_vislist_component(vis, model_vis)
+    return invert_mfs_component(residual_vis, model_imagelist, withpsf=withpsf, context=context, **kwargs)
+
+
 def restore_component(model_imagelist, psf_imagelist, residual_imagelist, **kwargs):
     """ Create a graph to calculate the restored image
 
@@ -509,6 +663,41 @@ def deconvolve_component(dirty_list, psf_list, model_imagelist, prefix='', **kwa
     return arlexecute.execute(image_scatter_channels, nout=nchan)(gathered_results_list, subimages=nchan), flat_list
 
 
+def deconvolve_mfs_component(dirty, psf, model_imagelist, reference_frequency, prefix='', **kwargs):
+    """Create a graph for the deconvolution of frequency moment images, adding to the model
+    
+    The moment images of the dirty image and PSF made by invert_mfs_component are cleaned together by deconvolve_cube
+    with a multi-frequency clean (algorithm 'msmfsclean' by default), so no spectral cube is made. The moment model is
+    evaluated at the channel frequencies of each model image and added to it.
+
+    :param dirty: Graph for (moment image, sumwt)
+    :param psf: Graph for (psf moment image, sumwt), with twice as many moments as dirty
+    :param model_imagelist: Current model
+    :param reference_frequency: Reference frequency used to make the moments
+    :param prefix: Prefix for the log messages
+    :param kwargs: Parameters for functions in components
+    :return: List of graphs for the model images
+    """
+    algorithm = get_parameter(kwargs, 'algorithm', 'msmfsclean')
+    assert algorithm in ['msmfsclean', 'mfsmsclean', 'mmclean'], \
+        "Frequency moment images need a multi-frequency clean, not %s" % algorithm
+    
+    def deconvolve(dirty, psf):
+        result, _ = deconvolve_cube(dirty[0], psf[0], prefix=prefix, **dict(kwargs, algorithm=algorithm))
+        log.info('deconvolve_mfs_component %s: cleaned flux in moment 0 %.6f'
+                 % (prefix, numpy.sum(result.data[0, 0, ...])))
+        return result
+    
+    def add_model(model, moment_model, f0):
+        result = calculate_image_from_frequency_moments(model, moment_model, reference_frequency=f0)
+        result.data += model.data
+        return result
+    
+    moment_model = arlexecute.execute(deconvolve, nout=1)(dirty, psf)
+    return [arlexecute.execute(add_model, nout=1)(model, moment_model, reference_frequency)
+            for model in model_imagelist]
+
+
 def deconvolve_channel_component(dirty_list, psf_list, model_imagelist, subimages, **kwargs):
     """Create a graph for deconvolution by channels, adding to the model
 
@@ -542,25 +731,50 @@ def deconvolve_channel_component(dirty_list, psf_list, model_imagelist, subimage
     return arlexecute.execute(add_model, nout=1, pure=True)(result, model_imagelist)
 
 
-def weight_component(vis_list, model_imagelist, weighting='uniform', **kwargs):
+def weight_component(vis_list, model_imagelist, weighting='uniform', merge_density_grids=False, **kwargs):
     """ Weight the visibility data
+    
+    Each visibility is usually weighted by its own density grid. If merge_density_grids is True the density
+    grids of all the visibilities (see density_grid_visibility) are summed by one reduction, and every visibility
+    is weighted by the merged grid, so that the visibilities are weighted as one data set without gridding them
+    again. All the models must then have the same shape. The weights are cached (see weight_visibility).
 
     :param vis_list:
     :param model_imagelist: Model required to determine weighting parameters
     :param weighting: Type of weighting
+    :param merge_density_grids: Weight with the sum of the density grids of all the visibilities
     :param kwargs: Parameters for functions in graphs
     :return: List of vis_graphs
    """
     
-    def weight_vis(vis, model):
+    def weight_vis(vis, model, densitygrid=None):
         if vis is not None:
             if model is not None:
-                vis, _, _ = weight_visibility(vis, model, weighting=weighting, **kwargs)
+                vis, _, _ = weight_visibility(vis, model, weighting=weighting, densitygrid=densitygrid, **kwargs)
                 return vis
             else:
                 return None
         else:
             return None
     
-    return [arlexecute.execute(weight_vis, pure=True, nout=1)(vis_list[i], model_imagelist[i])
+    if not merge_density_grids:
+        return [arlexecute.execute(weight_vis, pure=True, nout=1)(vis_list[i], model_imagelist[i])
+                for i in range(len(vis_list))]
+    
+    def density_grid(vis, model):
+        if vis is not None and model is not None:
+            return density_grid_visibility(vis, model, weighting=weighting, **kwargs)
+        else:
+            return None
+    
+    def sum_density_grids(grids):
+        grids = [grid for grid in grids if grid is not None]
+        if len(grids) == 0:
+            return None
+        return numpy.sum(grids, axis=0)
+    
+    grids = [arlexecute.execute(density_grid, pure=True, nout=1)(vis_list[i], model_imagelist[i])
+             for i in range(len(vis_list))]
+    densitygrid = arlexecute.execute(sum_density_grids, pure=True, nout=1)(grids)
+    return [arlexecute.execute(weight_vis, pure=True, nout=1)(vis_list[i], model_imagelist[i], densitygrid)
             for i in range(len(vis_list))]
@@ -12,12 +12,14 @@ import numpy
 
 from data_models.memory_data_models import Visibility, Image
 
-from ..image.gather_scatter import image_scatter_facets
+from libs.image.iterators import image_null_iter, image_raster_iter
+
 from ..image.operations import create_empty_image_like
 from ..imaging.base import normalize_sumwt
-from ..imaging.base import predict_2d, invert_2d
+from ..imaging.base import predict_2d, invert_2d, predict_nufft, invert_nufft, predict_idg, invert_idg
+from ..imaging.facets import predict_facets, invert_facets
 from ..imaging.timeslice_single import predict_timeslice_single, invert_timeslice_single
-from ..imaging.wstack_single import predict_wstack_single, invert_wstack_single
+from ..imaging.wstack_single import predict_wstack_single, invert_wstack_single, predict_wstack, invert_wstack
 from ..visibility.base import copy_visibility, create_visibility_from_rows
 from ..visibility.coalesce import convert_blockvisibility_to_visibility, convert_visibility_to_blockvisibility
 from ..visibility.iterators import vis_timeslice_iter, vis_null_iter, vis_wslice_iter
@@ -40,27 +42,53 @@ def imaging_contexts():
     contexts = {'2d': {'predict': predict_2d,
                        'invert': invert_2d,
                        'vis_iterator': vis_null_iter,
+                       'image_iterator': image_raster_iter,
                        'inner': 'image'},
+                'nufft': {'predict': predict_nufft,
+                          'invert': invert_nufft,
+                          'vis_iterator': vis_null_iter,
+                          'image_iterator': image_raster_iter,
+                          'inner': 'image'},
+                'idg': {'predict': predict_idg,
+                        'invert': invert_idg,
+                        'vis_iterator': vis_null_iter,
+                        'image_iterator': image_raster_iter,
+                        'inner': 'image'},
                 'facets': {'predict': predict_2d,
                            'invert': invert_2d,
                            'vis_iterator': vis_null_iter,
+                           'image_iterator': image_raster_iter,
                            'inner': 'image'},
                 'facets_timeslice': {'predict': predict_timeslice_single,
                                      'invert': invert_timeslice_single,
                                      'vis_iterator': vis_timeslice_iter,
+                                     'image_iterator': image_raster_iter,
                                      'inner': 'image'},
                 'facets_wstack': {'predict': predict_wstack_single,
                                   'invert': invert_wstack_single,
                                   'vis_iterator': vis_wslice_iter,
+                                  'image_iterator': image_raster_iter,
                                   'inner': 'image'},
                 'timeslice': {'predict': predict_timeslice_single,
                               'invert': invert_timeslice_single,
                               'vis_iterator': vis_timeslice_iter,
+                              'image_iterator': image_raster_iter,
                               'inner': 'image'},
                 'wstack': {'predict': predict_wstack_single,
                            'invert': invert_wstack_single,
                            'vis_iterator': vis_wslice_iter,
-                           'inner': 'image'}}
+                           'image_iterator': image_raster_iter,
+                           'inner': 'image'},
+                'wstack_planes': {'predict': predict_wstack,
+                                  'invert': invert_wstack,
+                                  'vis_iterator': vis_null_iter,
+                                  'image_iterator': image_raster_iter,
+                                  'inner': 'image'},
+                'facets_batched': {'predict': predict_facets,
+                                   'invert': invert_facets,
+                                   'vis_iterator': vis_null_iter,
+                                   'image_iterator': image_null_iter,
+                                   'inner': 'image'}}
     
     return contexts
 
@@ -76,10 +104,14 @@ def invert_function(vis, im: Image, dopsf=False, normalize=True, context='2d', i
     """ Invert using algorithm specified by context:
 
      * 2d: Two-dimensional transform
+     * nufft: Two-dimensional non-uniform FFT with accuracy epsilon (default 1e-6)
+     * idg: Image domain gridding, correcting the w term in the image of each subgrid
      * wstack: wstacking with either vis_slices or wstack (spacing between w planes) set
+     * wstack_planes: wstacking of all the w planes in one pass over the visibilities, with vis_slices or wstack set
      * wprojection: w projection with wstep (spacing between w places) set, also kernel='wprojection'
      * timeslice: snapshot imaging with either vis_slices or timeslice set. timeslice='auto' does every time
      * facets: Faceted imaging with facets facets on each axis
+     * facets_batched: Faceted imaging of all the facets in one pass over the visibilities, with facets set
      * facets_wprojection: facets AND wprojection
      * facets_wstack: facets AND wstacking
      * wprojection_wstack: wprojection and wstacking
@@ -96,6 +128,7 @@ def invert_function(vis, im: Image, dopsf=False, normalize=True, context='2d', i
     """
     c = imaging_context(context)
     vis_iter = c['vis_iterator']
+    image_iter = c['image_iterator']
     invert = c['invert']
     if inner is None:
         inner = c['inner']
@@ -114,9 +147,9 @@ def invert_function(vis, im: Image, dopsf=False, normalize=True, context='2d', i
                 visslice = create_visibility_from_rows(svis, rows)
                 sumwt = 0.0
                 workimage = create_empty_image_like(im)
-                for dpatch in image_scatter_facets(workimage, facets=facets, overlap=overlap, taper=taper):
+                for dpatch in image_iter(workimage, facets=facets, overlap=overlap, taper=taper):
                     result, sumwt = invert(visslice, dpatch, dopsf, normalize=False, facets=facets,
-                                           vis_slices=vis_slices, **kwargs)
+                                           overlap=overlap, vis_slices=vis_slices, **kwargs)
                     # Ensure that we fill in the elements of dpatch instead of creating a new numpy arrray
                     dpatch.data[...] = result.data[...]
                 # Assume that sumwt is the same for all patches
@@ -129,12 +162,13 @@ def invert_function(vis, im: Image, dopsf=False, normalize=True, context='2d', i
         # We assume that the weight is the same for all image iterations
         totalwt = None
         workimage = create_empty_image_like(im)
-        for dpatch in image_scatter_facets(workimage, facets=facets, overlap=overlap, taper=taper):
+        for dpatch in image_iter(workimage, facets=facets, overlap=overlap, taper=taper):
             totalwt = None
             for rows in vis_iter(svis, vis_slices=vis_slices):
                 if numpy.sum(rows):
                     visslice = create_visibility_from_rows(svis, rows)
-                    result, sumwt = invert(visslice, dpatch, dopsf, normalize=False, **kwargs)
+                    result, sumwt = invert(visslice, dpatch, dopsf, normalize=False, facets=facets,
+                                           overlap=overlap, **kwargs)
                     # Ensure that we fill in the elements of dpatch instead of creating a new numpy arrray
                     dpatch.data[...] += result.data[...]
                     if totalwt is None:
@@ -156,10 +190,14 @@ def predict_function(vis, model: Image, context='2d', inner=None, vis_slices=1,
     """Predict visibilities using algorithm specified by context
     
      * 2d: Two-dimensional transform
+     * nufft: Two-dimensional non-uniform FFT with accuracy epsilon (default 1e-6)
+     * idg: Image domain gridding, correcting the w term in the image of each subgrid
      * wstack: wstacking with either vis_slices or wstack (spacing between w planes) set
+     * wstack_planes: wstacking of all the w planes in one pass over the visibilities, with vis_slices or wstack set
      * wprojection: w projection with wstep (spacing between w places) set, also kernel='wprojection'
      * timeslice: snapshot imaging with either vis_slices or timeslice set. timeslice='auto' does every time
      * facets: Faceted imaging with facets facets on each axis
+     * facets_batched: Faceted imaging of all the facets in one pass over the visibilities, with facets set
      * facets_wprojection: facets AND wprojection
      * facets_wstack: facets AND wstacking
      * wprojection_wstack: wprojection and wstacking
@@ -176,6 +214,7 @@ def predict_function(vis, model: Image, context='2d', inner=None, vis_slices=1,
     """
     c = imaging_context(context)
     vis_iter = c['vis_iterator']
+    image_iter = c['image_iterator']
     predict = c['predict']
     if inner is None:
         inner = c['inner']
@@ -192,17 +231,19 @@ def predict_function(vis, model: Image, context='2d', inner=None, vis_slices=1,
             if numpy.sum(rows):
                 visslice = create_visibility_from_rows(svis, rows)
                 visslice.data['vis'][...] = 0.0
-                for dpatch in image_scatter_facets(model, facets=facets, overlap=overlap, taper=taper):
+                for dpatch in image_iter(model, facets=facets, overlap=overlap, taper=taper):
                     result.data['vis'][...] = 0.0
-                    result = predict(visslice, dpatch, **kwargs)
+                    result = predict(visslice, dpatch, facets=facets, overlap=overlap, vis_slices=vis_slices,
+                                     **kwargs)
                     svis.data['vis'][rows] += result.data['vis']
     else:
-        for dpatch in image_scatter_facets(model, facets=facets, overlap=overlap, taper=taper):
+        for dpatch in image_iter(model, facets=facets, overlap=overlap, taper=taper):
             for rows in vis_iter(svis, vis_slices=vis_slices):
                 if numpy.sum(rows):
                     visslice = create_visibility_from_rows(svis, rows)
                     result.data['vis'][...] = 0.0
-                    result = predict(visslice, dpatch, **kwargs)
+                    result = predict(visslice, dpatch, facets=facets, overlap=overlap, vis_slices=vis_slices,
+                                     **kwargs)
                     svis.data['vis'][rows] += result.data['vis']
 
     if not isinstance(vis, Visibility):
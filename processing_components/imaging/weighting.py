@@ -7,17 +7,103 @@ There are two classes of functions:
 
 """
 
+import collections
+import hashlib
+import logging
+
 import numpy
 
 from libs.util.array_functions import tukey_filter
 from data_models.memory_data_models import Visibility, Image
 from data_models.parameters import get_parameter
 
-from libs.fourier_transforms.convolutional_gridding import weight_gridding
+from libs.fourier_transforms.convolutional_gridding import weight_gridding, density_gridding
 from libs.imaging.imaging_params import get_polarisation_map, get_uvw_map
 from libs.imaging.imaging_params import get_frequency_map
 
-def weight_visibility(vis: Visibility, im: Image, **kwargs) -> Visibility:
+log = logging.getLogger(__name__)
+
+# Imaging weights, most recently used last
+_imaging_weight_cache = collections.OrderedDict()
+imaging_weight_cache_size = 8
+imaging_weight_cache_max_bytes = 2 ** 30
+
+
+def clear_imaging_weight_cache():
+    """ Remove all cached imaging weights
+    
+    """
+    _imaging_weight_cache.clear()
+
+
+def imaging_weight_cache_nbytes():
+    """ Bytes held by the cached imaging weights, densities and density grids
+    
+    A density grid shared by several entries, e.g. a merged density grid, is counted once.
+    
+    :return: number of bytes
+    """
+    arrays = {id(array): array for entry in _imaging_weight_cache.values() for array in entry if array is not None}
+    return sum(array.nbytes for array in arrays.values())
+
+
+def _trim_imaging_weight_cache():
+    """ Remove the least recently used weights until the cache is within its count and byte limits
+    
+    The most recently used weights are always kept.
+    """
+    while len(_imaging_weight_cache) > 1 and (len(_imaging_weight_cache) > imaging_weight_cache_size or
+                                              imaging_weight_cache_nbytes() > imaging_weight_cache_max_bytes):
+        _imaging_weight_cache.popitem(last=False)
+
+
+def imaging_weight_key(vis: Visibility, im: Image, densitygrid=None, **kwargs):
+    """ Key identifying the imaging weights of a visibility
+    
+    The key depends on the content of the uvw, weight (which is zero for flagged data) and frequency columns, the
+    image shape and WCS, the weighting parameters and the density grid if one is given.
+    
+    :param vis: Visibility
+    :param im: Image
+    :param densitygrid: Density grid (optional)
+    :return: key (str)
+    """
+    h = hashlib.sha1()
+    h.update(numpy.ascontiguousarray(vis.uvw).tobytes())
+    h.update(numpy.ascontiguousarray(vis.weight).tobytes())
+    h.update(numpy.ascontiguousarray(vis.frequency).tobytes())
+    h.update(str(im.shape).encode())
+    h.update(im.wcs.to_header_string().encode())
+    for key, default in [("weighting", "uniform"), ("half_plane", False), ("robustness", 0.0),
+                         ("weighting_fov", None)]:
+        h.update(("%s=%s" % (key, get_parameter(kwargs, key, default))).encode())
+    if densitygrid is not None:
+        h.update(numpy.ascontiguousarray(densitygrid).tobytes())
+    return h.hexdigest()
+
+
+def density_grid_visibility(vis: Visibility, im: Image, **kwargs) -> numpy.ndarray:
+    """ The density grid used by weight_visibility for the weighting parameters in kwargs
+    
+    Density grids are additive: the grids of parts of the data for the same image can be summed, e.g. by one
+    reduction over distributed workers, and the sum passed to weight_visibility as densitygrid so that the parts
+    are weighted as a whole without gridding them again.
+    
+    :param vis: Visibility
+    :param im: Image
+    :return: density grid, or None for natural weighting
+    """
+    assert isinstance(vis, Visibility), "vis is not a Visibility: %r" % vis
+    
+    spectral_mode, vfrequencymap = get_frequency_map(vis, im)
+    uvw_mode, shape, padding, vuvwmap = get_uvw_map(vis, im)
+    return density_gridding(im.data.shape, vis.data['weight'], vuvwmap, vfrequencymap,
+                            weighting=get_parameter(kwargs, "weighting", "uniform"),
+                            half_plane=get_parameter(kwargs, "half_plane", False),
+                            field_of_view=get_parameter(kwargs, "weighting_fov", None))
+
+
+def weight_visibility(vis: Visibility, im: Image, densitygrid=None, **kwargs) -> Visibility:
     """ Reweight the visibility data using a selected algorithm
 
     Imaging uses the column "imaging_weight" when imaging. This function sets that column using a
@@ -29,10 +115,25 @@ def weight_visibility(vis: Visibility, im: Image, **kwargs) -> Visibility:
         - Super-uniform: As uniform, by sum of weights is over extended box region
         - Briggs: Compromise between natural and uniform
         - Super-briggs: As Briggs, by sum of weights is over extended box region
+    
+    The weighting parameter is 'natural', 'uniform', 'briggs', 'super-uniform' or 'super-briggs'. The Briggs
+    robustness is set by robustness (default 0), and the field of view over which the sidelobes are minimised,
+    as a fraction of the image, by weighting_fov (default 1, or 1/3 for the super- schemes). If half_plane is
+    True the density grid is only the u >= 0 half (see weight_gridding).
+    
+    If densitygrid is given, e.g. the sum of the grids from density_grid_visibility for all the parts of the
+    data, the weights are read from it instead of gridding vis.
+    
+    uvw, weights and image geometry do not change between calls, so the result is cached (see
+    imaging_weight_key) and later calls only copy the stored imaging_weight column. Set imaging_weight_cache=False
+    to always calculate the weights. The cache keeps at most imaging_weight_cache_size entries and
+    imaging_weight_cache_max_bytes bytes (see imaging_weight_cache_nbytes). The cached density and density grid
+    are read-only.
 
     :param vis:
     :param im:
-    :return: visibility with imaging_weights column added and filled
+    :param densitygrid: Density grid to use (optional)
+    :return: visibility with imaging_weights column added and filled, density, density grid
     """
     assert isinstance(vis, Visibility), "vis is not a Visibility: %r" % vis
     
@@ -42,11 +143,34 @@ def weight_visibility(vis: Visibility, im: Image, **kwargs) -> Visibility:
     uvw_mode, shape, padding, vuvwmap = get_uvw_map(vis, im)
     
     density = None
-    densitygrid = None
+    
+    use_cache = get_parameter(kwargs, "imaging_weight_cache", True)
+    given_densitygrid = densitygrid
+    if use_cache:
+        key = imaging_weight_key(vis, im, densitygrid=densitygrid, **kwargs)
+        if key in _imaging_weight_cache:
+            _imaging_weight_cache.move_to_end(key)
+            log.debug("weight_visibility: using cached imaging weights")
+            imaging_weight, density, densitygrid = _imaging_weight_cache[key]
+            vis.data['imaging_weight'] = imaging_weight
+            return vis, density, densitygrid
     
     weighting = get_parameter(kwargs, "weighting", "uniform")
+    half_plane = get_parameter(kwargs, "half_plane", False)
+    robustness = get_parameter(kwargs, "robustness", 0.0)
+    field_of_view = get_parameter(kwargs, "weighting_fov", None)
     vis.data['imaging_weight'], density, densitygrid = weight_gridding(im.data.shape, vis.data['weight'], vuvwmap,
-                                                                       vfrequencymap, vpolarisationmap, weighting)
+                                                                       vfrequencymap, vpolarisationmap, weighting,
+                                                                       half_plane=half_plane, robustness=robustness,
+                                                                       field_of_view=field_of_view,
+                                                                       densitygrid=densitygrid)
+    
+    if use_cache:
+        for array in [density, densitygrid]:
+            if array is not None and array is not given_densitygrid:
+                array.flags.writeable = False
+        _imaging_weight_cache[key] = (vis.data['imaging_weight'].copy(), density, densitygrid)
+        _trim_imaging_weight_cache()
     
     return vis, density, densitygrid
 
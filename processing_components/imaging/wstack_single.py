@@ -7,18 +7,30 @@ approximated as:
     V(u,v,w) =\\sum_i \\int \\frac{ I(l,m) e^{-2 \\pi j (w_i(\\sqrt{1-l^2-m^2}-1))})}{\\sqrt{1-l^2-m^2}} e^{-2 \\pi j (ul+vm)} dl dm
 
 If images constructed from slices in w are added after applying a w-dependent image plane correction, the w term will be corrected.
+
+predict_wstack_single and invert_wstack_single process one slice, as scattered by vis_wslice_iter. predict_wstack and
+invert_wstack process all the w planes in one pass over the visibilities.
 """
 
+from contextlib import contextmanager
+from typing import Union
+
 import numpy
 
 from data_models.memory_data_models import Visibility, Image, BlockVisibility
+from data_models.parameters import get_parameter
 
-from libs.image.operations import create_w_term_like
+from libs.fourier_transforms.convolutional_gridding import convolutional_grid, convolutional_degrid
+from libs.fourier_transforms.fft_support import fft, ifft, pad_mid, extract_mid, workspace_pool
+from libs.fourier_transforms.idg import IDGPlan
+from libs.image.operations import create_image_from_array
+from libs.imaging.imaging_params import get_gridding_plan, get_gridding_options, get_w_screens
 
 from ..image.operations import copy_image
 from ..visibility.base import copy_visibility
 from ..visibility.coalesce import coalesce_visibility, decoalesce_visibility
-from ..imaging.base import predict_2d, invert_2d
+from ..visibility.iterators import vis_wslices
+from ..imaging.base import predict_2d, invert_2d, normalize_sumwt, image_shift_phasor, _predict_2d_shift
 
 import logging
 log = logging.getLogger(__name__)
@@ -50,14 +62,14 @@ def predict_wstack_single(vis, model, remove=True, facets=1, vis_slices=1, **kwa
 
     # Calculate w beam and apply to the model. The imaginary part is not needed
     workimage = copy_image(model)
-    w_beam = create_w_term_like(model, w_average, vis.phasecentre)
+    w_beam, = get_w_screens(model, [w_average], **kwargs)
     
     # Do the real part
-    workimage.data = w_beam.data.real * model.data
+    workimage.data = w_beam.real * model.data
     avis = predict_2d(avis, workimage, facets=1, vis_slices=1, **kwargs)
     
     # and now the imaginary part
-    workimage.data = w_beam.data.imag * model.data
+    workimage.data = w_beam.imag * model.data
     tempvis = predict_2d(tempvis, workimage, facets=facets, vis_slices=vis_slices, **kwargs)
     avis.data['vis'] -= 1j * tempvis.data['vis']
     
@@ -97,7 +109,196 @@ def invert_wstack_single(vis: Visibility, im: Image, dopsf, normalize=True, remo
         vis.data['uvw'][..., 2] += w_average
 
     # Calculate w beam and apply to the model. The imaginary part is not needed
-    w_beam = create_w_term_like(im, w_average, vis.phasecentre)
-    reWorkimage.data = w_beam.data.real * reWorkimage.data - w_beam.data.imag * imWorkimage.data
+    w_beam, = get_w_screens(im, [w_average], **kwargs)
+    reWorkimage.data = w_beam.real * reWorkimage.data - w_beam.imag * imWorkimage.data
     
     return reWorkimage, sumwt
+
+
+def w_planes(w, vis_slices=1):
+    """ Evenly spaced w planes and the plane of each visibility row
+    
+    The planes are at the centres of the slices of vis_wslice_iter, i.e. vis_slices planes spanning the
+    range of abs(w), and each row belongs to the nearest plane. A single plane is at w = 0.
+    
+    :param w: w of each row (wavelengths)
+    :param vis_slices: Number of planes
+    :return: w of each plane, plane index of each row
+    """
+    w = numpy.asarray(w)
+    if vis_slices < 2:
+        return numpy.zeros([1]), numpy.zeros(w.shape, dtype='int')
+    wmaxabs = numpy.max(numpy.abs(w))
+    planes = numpy.linspace(-wmaxabs, wmaxabs, vis_slices)
+    if wmaxabs == 0.0:
+        return planes, numpy.full(w.shape, vis_slices // 2, dtype='int')
+    wstack = planes[1] - planes[0]
+    labels = numpy.clip(numpy.round((w + wmaxabs) / wstack), 0, vis_slices - 1).astype('int')
+    return planes, labels
+
+
+def _wstack_planes(vis, **kwargs):
+    """ The w planes for a visibility, from either vis_slices or wstack (the spacing in w)
+    """
+    wstack = get_parameter(kwargs, "wstack", None)
+    if wstack is not None:
+        vis_slices = vis_wslices(vis, wstack)
+    else:
+        vis_slices = get_parameter(kwargs, "vis_slices", 1)
+    return w_planes(vis.w, vis_slices)
+
+
+@contextmanager
+def _plane_relative_w(vis, wplane):
+    """ Set the w of each row relative to its plane while finding the gridding plan
+    
+    The w column is restored on exit, also if an exception is raised.
+    
+    :param vis: Visibility, changed in place and restored
+    :param wplane: w of the plane of each row
+    """
+    w = vis.data['uvw'][:, 2].copy()
+    vis.data['uvw'][:, 2] -= wplane
+    try:
+        yield vis
+    finally:
+        vis.data['uvw'][:, 2] = w
+
+
+def predict_wstack(vis: Union[BlockVisibility, Visibility], model: Image,
+                   **kwargs) -> Union[BlockVisibility, Visibility]:
+    """ Predict using w stacking in a single pass over the visibilities
+    
+    The rows are binned into evenly spaced w planes (see w_planes) by one sort, which is kept with the cached
+    gridding plan. For each plane the model is multiplied by the conjugate w screen, padded, transformed and
+    degridded (one complex degrid) for the rows of the plane. Only one padded grid is held at a time. The w of
+    each row relative to its plane may be corrected by w projection (wstep). The w planes are set by vis_slices
+    or by wstack (the spacing in w). The w screens are generated by recurrence and cached between major cycles
+    (see get_w_screens, and the w_screen_cache and w_screen_resync parameters). The other parameters are as for
+    predict_2d.
+    
+    :param vis: Visibility to be predicted
+    :param model: model image
+    :return: resulting visibility (in place works)
+    """
+    if isinstance(vis, BlockVisibility):
+        log.debug("predict_wstack: coalescing prior to prediction")
+        avis = coalesce_visibility(vis, **kwargs)
+    else:
+        avis = vis
+    
+    assert isinstance(avis, Visibility), avis
+    
+    _, _, ny, nx = model.data.shape
+    
+    # The gridding plan is for the w of each row relative to its plane
+    wplanes, labels = _wstack_planes(avis, **kwargs)
+    with _plane_relative_w(avis, wplanes[labels]):
+        kernel_name, gcf, plan = get_gridding_plan(avis, model, **kwargs)
+    assert not isinstance(plan, IDGPlan), "Image domain gridding corrects the w term itself"
+    
+    complex_type, real_type, degridding_options, fft_options = get_gridding_options(degrid=True, **kwargs)
+    
+    # The gridding correction is applied once, before the w screens
+    npad = plan.shape[-1]
+    model_gcf = model.data * extract_mid(gcf, npixel=nx)
+    
+    newvis = numpy.zeros_like(avis.data['vis'])
+    partition = {plane: (rows, pplan) for plane, rows, pplan in plan.partition(labels)}
+    with workspace_pool.buffer([model.nchan, model.npol, npad, npad], complex_type, zero=False) as uvgrid:
+        for plane, w_beam in enumerate(get_w_screens(model, wplanes, **kwargs)):
+            if plane not in partition:
+                continue
+            rows, pplan = partition[plane]
+            pad_mid(model_gcf * numpy.conjugate(w_beam), npad, out=uvgrid)
+            fft(uvgrid, out=uvgrid, **fft_options)
+            newvis[rows] = convolutional_degrid(plan.kernel_list, (len(rows), newvis.shape[1]), uvgrid, plan=pplan,
+                                                **degridding_options)
+    avis.data['vis'] = newvis
+    
+    return _predict_2d_shift(vis, avis, model)
+
+
+def invert_wstack(vis: Visibility, im: Image, dopsf: bool = False, normalize: bool = True,
+                  **kwargs) -> (Image, numpy.ndarray):
+    """ Invert using w stacking in a single pass over the visibilities
+    
+    The rows are binned into evenly spaced w planes (see w_planes). The rows of each plane are gridded onto the
+    one padded grid, which is transformed, multiplied by the w screen of the plane and accumulated in place into
+    the image. The gridding correction is applied once at the end. If withpsf is True the PSF is gridded in the
+    same pass, as in invert_2d, and the result is (dirty image, sum of weights, psf). The other parameters are as
+    for predict_wstack and invert_2d, apart from imaginary which is not supported.
+    
+    :param vis: Visibility to be inverted
+    :param im: image template (not changed)
+    :param dopsf: Make the psf instead of the dirty image
+    :param normalize: Normalize by the sum of weights (True)
+    :return: resulting image, sum of weights
+    """
+    withpsf = get_parameter(kwargs, "withpsf", False)
+    assert not get_parameter(kwargs, "imaginary", False), "invert_wstack does not keep the imaginary part"
+    assert not (withpsf and dopsf), "withpsf cannot be combined with dopsf"
+    
+    if not isinstance(vis, Visibility):
+        svis = coalesce_visibility(vis, **kwargs)
+    else:
+        svis = vis
+    
+    # The shift to the image phase centre is applied to the visibility array, as in invert_2d
+    phasor = image_shift_phasor(svis, im)
+    if dopsf:
+        visdata = numpy.ones_like(svis.data['vis'])
+    else:
+        visdata = svis.data['vis']
+    if phasor is not None:
+        visdata = visdata * phasor[:, numpy.newaxis]
+    
+    nchan, npol, ny, nx = im.data.shape
+    
+    wplanes, labels = _wstack_planes(svis, **kwargs)
+    with _plane_relative_w(svis, wplanes[labels]):
+        kernel_name, gcf, plan = get_gridding_plan(svis, im, **kwargs)
+    assert not isinstance(plan, IDGPlan), "Image domain gridding corrects the w term itself"
+    nypad, nxpad = plan.shape[-2:]
+    
+    complex_type, real_type, gridding_options, fft_options = get_gridding_options(**kwargs)
+    
+    # With withpsf the dirty image is the first npol polarisations of the grid and the PSF the last npol
+    if withpsf:
+        plan = plan.with_polarisations(2 * npol)
+        psf_factors = numpy.ones([svis.nvis, 1])
+    gnpol = plan.shape[1]
+    
+    result = numpy.zeros([nchan, gnpol, ny, nx], dtype=real_type)
+    sumwt = numpy.zeros([nchan, gnpol])
+    partition = {plane: (rows, pplan) for plane, rows, pplan in plan.partition(labels)}
+    with workspace_pool.buffer([nchan, gnpol, nypad, nxpad], complex_type, zero=False) as imgridpad:
+        for plane, w_beam in enumerate(get_w_screens(im, wplanes, **kwargs)):
+            if plane not in partition:
+                continue
+            rows, pplan = partition[plane]
+            psf_terms = {}
+            if withpsf:
+                psf_terms = {'psf_factors': psf_factors[rows],
+                             'psf_phasor': None if phasor is None else phasor[rows]}
+            imgridpad[...] = 0.0
+            imgridpad, planewt = convolutional_grid(plan.kernel_list, imgridpad, visdata[rows],
+                                                    svis.data['imaging_weight'][rows], plan=pplan, **psf_terms,
+                                                    **gridding_options)
+            sumwt += planewt
+            imgridpad = ifft(imgridpad, out=imgridpad, **fft_options)
+            result += numpy.real(extract_mid(imgridpad, npixel=nx) * w_beam)
+    result *= extract_mid(gcf, npixel=nx).astype(real_type, copy=False)
+    
+    # Normalise weights for consistency with transform
+    sumwt /= float(nypad * nxpad)
+    
+    resultimage = create_image_from_array(result[:, :npol], im.wcs, im.polarisation_frame)
+    if normalize:
+        resultimage = normalize_sumwt(resultimage, sumwt[:, :npol])
+    if withpsf:
+        psfimage = create_image_from_array(result[:, npol:], im.wcs, im.polarisation_frame)
+        if normalize:
+            psfimage = normalize_sumwt(psfimage, sumwt[:, :npol])
+        return resultimage, sumwt[:, :npol], psfimage
+    return resultimage, sumwt
@@ -4,14 +4,18 @@
 from data_models.parameters import get_parameter
 from ..calibration.calibration_components import calibrate_component
 from ..component_support.arlexecute import arlexecute
-from ..imaging.imaging_components import invert_component, residual_component, \
-    predict_component, zero_vislist_component, subtract_vislist_component, restore_component, \
-    deconvolve_component
+from ..imaging.imaging_components import invert_component, residual_component, residual_psf_component, \
+    invert_psf_component, predict_component, zero_vislist_component, subtract_vislist_component, restore_component, \
+    deconvolve_component, invert_mfs_component, residual_mfs_component, deconvolve_mfs_component, \
+    mfs_reference_frequency
 
 
 def ical_component(vis_list, model_imagelist, context='2d', calibration_context='TG', do_selfcal=True, **kwargs):
     """Create graph for ICAL pipeline
 
+    If mfs is True the residuals are imaged as frequency moments over all the frequency windows (see
+    invert_mfs_component) and deconvolved by a multi-frequency clean (see deconvolve_mfs_component).
+
     :param vis_list:
     :param model_imagelist:
     :param context: imaging context e.g. '2d'
@@ -20,25 +24,41 @@ def ical_component(vis_list, model_imagelist, context='2d', calibration_context=
     :param kwargs: Parameters for functions in components
     :return:
     """
-    psf_imagelist = invert_component(vis_list, model_imagelist, dopsf=True, context=context, **kwargs)
+    mfs = get_parameter(kwargs, "mfs", False)
+    if mfs:
+        # All the frequency moments must be about the same reference frequency
+        kwargs['reference_frequency'] = arlexecute.execute(mfs_reference_frequency, nout=1)(vis_list)
     
-    model_vislist = zero_vislist_component(vis_list)
-    model_vislist = predict_component(model_vislist, model_imagelist, context=context, **kwargs)
+    # The PSF is made in the same pass as the first residual image
     if do_selfcal:
         # Make the predicted visibilities, selfcalibrate against it correcting the gains, then
         # form the residual visibility, then make the residual image
+        model_vislist = zero_vislist_component(vis_list)
+        model_vislist = predict_component(model_vislist, model_imagelist, context=context, **kwargs)
         vis_list = calibrate_component(vis_list, model_vislist,
                                        calibration_context=calibration_context, **kwargs)
         residual_vislist = subtract_vislist_component(vis_list, model_vislist)
-        residual_imagelist = invert_component(residual_vislist, model_imagelist, dopsf=True, context=context,
-                                              iteration=0, **kwargs)
+        if mfs:
+            residual_imagelist, psf_imagelist = invert_mfs_component(residual_vislist, model_imagelist,
+                                                                     withpsf=True, context=context, **kwargs)
+        else:
+            residual_imagelist, psf_imagelist = invert_psf_component(residual_vislist, model_imagelist,
+                                                                     context=context, iteration=0, **kwargs)
+    elif mfs:
+        residual_imagelist, psf_imagelist = residual_mfs_component(vis_list, model_imagelist, withpsf=True,
+                                                                   context=context, **kwargs)
     else:
         # If we are not selfcalibrating it's much easier and we can avoid an unnecessary round of gather/scatter
         # for visibility partitioning such as timeslices and wstack.
-        residual_imagelist = residual_component(vis_list, model_imagelist, context=context, **kwargs)
+        residual_imagelist, psf_imagelist = residual_psf_component(vis_list, model_imagelist, context=context,
+                                                                   **kwargs)
     
-    deconvolve_model_imagelist, _ = deconvolve_component(residual_imagelist, psf_imagelist, model_imagelist,
-                                                         prefix='cycle 0', **kwargs)
+    if mfs:
+        deconvolve_model_imagelist = deconvolve_mfs_component(residual_imagelist, psf_imagelist, model_imagelist,
+                                                              prefix='cycle 0', **kwargs)
+    else:
+        deconvolve_model_imagelist, _ = deconvolve_component(residual_imagelist, psf_imagelist, model_imagelist,
+                                                             prefix='cycle 0', **kwargs)
     
     nmajor = get_parameter(kwargs, "nmajor", 5)
     if nmajor > 1:
@@ -51,18 +71,33 @@ def ical_component(vis_list, model_imagelist, context='2d', calibration_context=
                                                calibration_context=calibration_context,
                                                iteration=cycle, **kwargs)
                 residual_vislist = subtract_vislist_component(vis_list, model_vislist)
-                residual_imagelist = invert_component(residual_vislist, model_imagelist, dopsf=False,
-                                                      context=context, **kwargs)
+                if mfs:
+                    residual_imagelist = invert_mfs_component(residual_vislist, model_imagelist, withpsf=False,
+                                                              context=context, **kwargs)
+                else:
+                    residual_imagelist = invert_component(residual_vislist, model_imagelist, dopsf=False,
+                                                          context=context, **kwargs)
+            elif mfs:
+                residual_imagelist = residual_mfs_component(vis_list, deconvolve_model_imagelist,
+                                                            context=context, **kwargs)
             else:
                 residual_imagelist = residual_component(vis_list, deconvolve_model_imagelist,
                                                         context=context, **kwargs)
             
             prefix = "cycle %d" % (cycle+1)
-            deconvolve_model_imagelist, _ = deconvolve_component(residual_imagelist, psf_imagelist,
-                                                                 deconvolve_model_imagelist,
-                                                                 prefix=prefix,
-                                                                 **kwargs)
+            if mfs:
+                deconvolve_model_imagelist = deconvolve_mfs_component(residual_imagelist, psf_imagelist,
+                                                                      deconvolve_model_imagelist, prefix=prefix,
+                                                                      **kwargs)
+            else:
+                deconvolve_model_imagelist, _ = deconvolve_component(residual_imagelist, psf_imagelist,
+                                                                     deconvolve_model_imagelist,
+                                                                     prefix=prefix,
+                                                                     **kwargs)
     residual_imagelist = residual_component(vis_list, deconvolve_model_imagelist, context=context, **kwargs)
+    if mfs:
+        # Restore with moment 0 of the PSF
+        psf_imagelist = len(deconvolve_model_imagelist) * [psf_imagelist]
     restore_imagelist = restore_component(deconvolve_model_imagelist, psf_imagelist, residual_imagelist)
     
     return arlexecute.execute((deconvolve_model_imagelist, residual_imagelist, restore_imagelist))
@@ -71,7 +106,9 @@ def ical_component(vis_list, model_imagelist, context='2d', calibration_context=
 def continuum_imaging_component(vis_list, model_imagelist, context='2d', **kwargs):
     """ Create graph for the continuum imaging pipeline.
     
-    Same as ICAL but with no selfcal.
+    Same as ICAL but with no selfcal. If mfs is True the residuals are imaged as frequency moments over all the
+    frequency windows (see invert_mfs_component) and deconvolved by a multi-frequency clean (see
+    deconvolve_mfs_component).
     
     :param vis_list:
     :param model_imagelist:
@@ -79,24 +116,43 @@ def continuum_imaging_component(vis_list, model_imagelist, context='2d', **kwarg
     :param kwargs: Parameters for functions in components
     :return:
     """
-    psf_imagelist = invert_component(vis_list, model_imagelist, dopsf=True, context=context, **kwargs)
-    
-    residual_imagelist = residual_component(vis_list, model_imagelist, context=context, **kwargs)
-    deconvolve_model_imagelist, _ = deconvolve_component(residual_imagelist, psf_imagelist, model_imagelist,
-                                                         prefix='cycle 0',
-                                                         **kwargs)
+    mfs = get_parameter(kwargs, "mfs", False)
+    if mfs:
+        # All the frequency moments must be about the same reference frequency
+        kwargs['reference_frequency'] = arlexecute.execute(mfs_reference_frequency, nout=1)(vis_list)
+        residual_imagelist, psf_imagelist = residual_mfs_component(vis_list, model_imagelist, withpsf=True,
+                                                                   context=context, **kwargs)
+        deconvolve_model_imagelist = deconvolve_mfs_component(residual_imagelist, psf_imagelist, model_imagelist,
+                                                              prefix='cycle 0', **kwargs)
+    else:
+        residual_imagelist, psf_imagelist = residual_psf_component(vis_list, model_imagelist, context=context,
+                                                                   **kwargs)
+        deconvolve_model_imagelist, _ = deconvolve_component(residual_imagelist, psf_imagelist, model_imagelist,
+                                                             prefix='cycle 0',
+                                                             **kwargs)
     
     nmajor = get_parameter(kwargs, "nmajor", 5)
     if nmajor > 1:
         for cycle in range(nmajor):
             prefix = "cycle %d" % (cycle+1)
-            residual_imagelist = residual_component(vis_list, deconvolve_model_imagelist, context=context, **kwargs)
-            deconvolve_model_imagelist, _ = deconvolve_component(residual_imagelist, psf_imagelist,
-                                                                 deconvolve_model_imagelist,
-                                                                 prefix=prefix,
-                                                                 **kwargs)
+            if mfs:
+                residual_imagelist = residual_mfs_component(vis_list, deconvolve_model_imagelist, context=context,
+                                                            **kwargs)
+                deconvolve_model_imagelist = deconvolve_mfs_component(residual_imagelist, psf_imagelist,
+                                                                      deconvolve_model_imagelist, prefix=prefix,
+                                                                      **kwargs)
+            else:
+                residual_imagelist = residual_component(vis_list, deconvolve_model_imagelist, context=context,
+                                                        **kwargs)
+                deconvolve_model_imagelist, _ = deconvolve_component(residual_imagelist, psf_imagelist,
+                                                                     deconvolve_model_imagelist,
+                                                                     prefix=prefix,
+                                                                     **kwargs)
     
     residual_imagelist = residual_component(vis_list, deconvolve_model_imagelist, context=context, **kwargs)
+    if mfs:
+        # Restore with moment 0 of the PSF
+        psf_imagelist = len(deconvolve_model_imagelist) * [psf_imagelist]
     restore_imagelist = restore_component(deconvolve_model_imagelist, psf_imagelist, residual_imagelist)
     return arlexecute.execute((deconvolve_model_imagelist, residual_imagelist, restore_imagelist))
 
@@ -2,19 +2,25 @@
 
 
 """
-import random
 import unittest
 
 import numpy
 from numpy.testing import assert_allclose
 
 from libs.fourier_transforms.convolutional_gridding import w_beam, coordinates, \
-    coordinates2, coordinateBounds, anti_aliasing_calculate, \
-    convolutional_degrid, convolutional_grid
+    coordinates2, coordinateBounds, anti_aliasing_calculate, frac_coord, \
+    convolutional_degrid, convolutional_grid, GriddingPlan, gridder_backends, get_gridder_backend, \
+    loop_grid_rows, loop_degrid_rows, numpy_grid_rows, numpy_degrid_rows, w_kernel, separate_kernel, \
+    separable_gridder_backends, loop_grid_rows_separable, loop_degrid_rows_separable, fold_half_plane, \
+    unfold_half_plane, weight_gridding, gridding_kernels, gridding_correction, kernel_shape_parameter, w_beams
+from libs.fourier_transforms.fft_support import fft, ifft, rfft, irfft, pad_mid
 
 
 class TestConvolutionalGridding(unittest.TestCase):
     
+    def setUp(self):
+        numpy.random.seed(180555)
+    
     @staticmethod
     def assertAlmostEqualScalar(a, result=1.0):
         result * numpy.ones_like(result)
@@ -43,28 +49,118 @@ class TestConvolutionalGridding(unittest.TestCase):
             _, aaf = anti_aliasing_calculate(shape, 8)
             self.assertAlmostEqual(numpy.max(aaf[..., aaf.shape[1] // 2, aaf.shape[0] // 2]), 0.18712109669890534)
 
+    def test_anti_aliasing_calculate_cached(self):
+        gcf, kernel = anti_aliasing_calculate((64, 64), 8)
+        cached_gcf, cached_kernel = anti_aliasing_calculate([64, 64], 8)
+        assert cached_kernel is kernel and numpy.array_equal(cached_gcf, gcf)
+        assert not kernel.flags.writeable
+        with self.assertRaises(ValueError):
+            kernel[0, 0, 0, 0] = 0.0
+        assert anti_aliasing_calculate((64, 64), 4)[1] is not kernel
+        # The kernel does not depend on the grid shape, and only the 1D factors of the gcf are kept
+        gcf256, kernel256 = anti_aliasing_calculate((256, 256), 8)
+        assert kernel256 is kernel and gcf256.shape == (256, 256)
+        assert_allclose(gcf, numpy.outer(gcf[32], gcf[:, 32]), rtol=1e-12)
+
+    def test_anti_aliasing_kernel_families(self):
+        for kernel in gridding_kernels:
+            gcf, aaf = anti_aliasing_calculate((60, 64), 8, support=6, kernel=kernel, padding=1.25)
+            assert gcf.shape == (60, 64)
+            assert aaf.shape == (8, 8, 14, 14)
+            self.assertAlmostEqual(gcf[30, 32], 1.0)
+            self.assertAlmostEqual(numpy.sum(aaf[0, 0]).real, 1.0)
+            assert numpy.all(gcf >= 1.0)
+    
+    def test_gridding_correction(self):
+        # Grid visibilities in 1D with the exact kernel and compare with the direct Fourier transform
+        npixel, padding = 100, 1.25
+        ngrid = int(round(npixel * padding))
+        for kernel in gridding_kernels:
+            for support, tolerance in [(4, 1e-5), (6, 1e-7)]:
+                beta = kernel_shape_parameter(support, padding)
+                rng = numpy.random.RandomState(1)
+                u = rng.uniform(-0.5 * ngrid + support + 1, 0.5 * ngrid - support - 1, 100)
+                vis = rng.normal(size=100)
+                grid = numpy.zeros(ngrid)
+                for uu, v in zip(u, vis):
+                    x = numpy.arange(support * 2) + int(numpy.ceil(ngrid // 2 + uu - support))
+                    grid[x] += v * gridding_kernels[kernel]((x - ngrid // 2 - uu) / support, beta)
+                image = numpy.fft.fftshift(numpy.fft.ifft(numpy.fft.ifftshift(grid))) * ngrid
+                image *= gridding_correction(ngrid, support, kernel, beta)
+                image = image[ngrid // 2 - npixel // 2:ngrid // 2 + npixel // 2]
+                l = numpy.arange(npixel) - npixel // 2
+                dft = numpy.exp(2j * numpy.pi * numpy.outer(l, u) / ngrid) @ vis
+                # The correction is normalised to unity at the centre
+                image *= dft[npixel // 2] / image[npixel // 2]
+                assert numpy.max(numpy.abs(image - dft)) < tolerance * numpy.sum(numpy.abs(vis)), \
+                    "%s support %d: %g" % (kernel, support, numpy.max(numpy.abs(image - dft)))
+    
     def test_w_kernel_beam(self):
         assert_allclose(numpy.real(w_beam(5, 0.1, 0))[0, 0], 1.0)
         self.assertAlmostEqualScalar(w_beam(5, 0.1, 100)[2, 2], 1)
         self.assertAlmostEqualScalar(w_beam(10, 0.1, 100)[5, 5], 1)
         self.assertAlmostEqualScalar(w_beam(11, 0.1, 1000)[5, 5], 1)
     
+    def test_w_beams(self):
+        # Evenly spaced w use the recurrence, and the others are evaluated exactly
+        for w in [numpy.linspace(-500.0, 500.0, 41), numpy.array([-20.0, 3.0, 400.0]), numpy.array([100.0])]:
+            beams = list(w_beams(64, 0.5, w, cx=30, cy=33, resync=16))
+            assert len(beams) == len(w)
+            for wk, beam in zip(w, beams):
+                assert_allclose(beam, w_beam(64, 0.5, wk, cx=30, cy=33), atol=1e-13)
+        # The beams are zero outside the unit circle
+        beams = list(w_beams(16, 2.5, [0.0, 10.0, 20.0]))
+        assert numpy.all(beams[2][w_beam(16, 2.5, 20.0) == 0.0] == 0.0)
+    
+    def test_w_kernel(self):
+        # Compare with the kernel extracted from the transform of the padded, oversampled w beam
+        npixel = 64
+        for oversampling, kernelwidth, remove_shift in [(1, 16, False), (4, 8, True), (8, 16, False)]:
+            gcf, _ = anti_aliasing_calculate((npixel, npixel))
+            screen = w_beam(npixel, 0.1, 300.0, remove_shift=remove_shift) / gcf
+            conv = ifft(pad_mid(screen, oversampling * npixel)) * oversampling ** 2
+            centre = oversampling * npixel // 2
+            ref = numpy.zeros([oversampling, oversampling, kernelwidth, kernelwidth], dtype='complex')
+            for y in range(oversampling):
+                slicey = slice(centre + oversampling * kernelwidth // 2 + y, centre - oversampling * kernelwidth // 2
+                               + y, -oversampling)
+                for x in range(oversampling):
+                    slicex = slice(centre + oversampling * kernelwidth // 2 + x,
+                                   centre - oversampling * kernelwidth // 2 + x, -oversampling)
+                    ref[y, x] = conv[slicey, slicex]
+            kernel = w_kernel(npixel, 0.1, 300.0, oversampling, kernelwidth, gcf=gcf, remove_shift=remove_shift)
+            assert_allclose(kernel, ref, atol=1e-12 * numpy.max(numpy.abs(ref)))
+
+    def _random_visibilities(self, nvis, npol=2, npixel=64, oversampling=4, nchan=1):
+        """ Random uv coordinates, visibilities and channels, and the anti-aliasing kernel of the grid
+        
+        :return: kernel, uv coordinates [nvis, 2], visibilities [nvis, npol], channel of each row
+        """
+        _, kernel = anti_aliasing_calculate((npixel, npixel), oversampling)
+        uvcoords = numpy.random.uniform(-0.25, 0.25, [nvis, 2])
+        vis = numpy.random.uniform(-1.0, 1.0, [nvis, npol]) + 1j * numpy.random.uniform(-1.0, 1.0, [nvis, npol])
+        chan = numpy.random.randint(0, nchan, nvis)
+        return kernel, uvcoords, vis, chan
+    
+    @staticmethod
+    def _kernel_list(kernel, nvis, factors=(1.0,)):
+        """ Kernel list with the kernel times each of factors, and a random choice of kernel for each row
+        """
+        return numpy.random.randint(0, len(factors), nvis), [factor * kernel for factor in factors]
+    
     def test_convolutional_grid(self):
         npixel = 256
         nvis = 10000
         nchan = 1
         npol = 4
         uvgrid = numpy.zeros([nchan, npol, npixel, npixel], dtype='complex')
-        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
         # kernel has shape [kernel_oversampling, kernel_oversampling, npixel, npixel] The fractional
         # part of the coordinate maps onto the first two axes.
-        # Make some uv coordinates with random locations
-        uvcoords = numpy.array([[random.uniform(-0.25, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        kernel, uvcoords, _, frequencymap = self._random_visibilities(nvis, npol, npixel, oversampling=8)
         # Make some visibilities, all complex unity
         vis = numpy.ones([nvis, nchan, npol], dtype='complex')
         visweights = numpy.ones([nvis, nchan, npol])
-        kernels = (numpy.zeros([nvis], dtype='int'), [kernel])
-        frequencymap = numpy.zeros([nvis], dtype='int')
+        kernels = self._kernel_list(kernel, nvis)
         # On my laptop the following takes about 34ss for 4e6 * 50 = 2e8 points so about 170 ns per point
         uvgrid, sumwt = convolutional_grid(kernels, uvgrid, vis, visweights, uvcoords, frequencymap)
         assert numpy.sum(sumwt) > 0.0
@@ -73,25 +169,471 @@ class TestConvolutionalGridding(unittest.TestCase):
         assert uvgrid.shape[2] == npixel
         assert uvgrid.shape[3] == npixel
 
+    def test_convolutional_grid_blocks(self):
+        npixel = 64
+        nvis = 1000
+        npol = 2
+        kernel, uvcoords, vis, frequencymap = self._random_visibilities(nvis, npol, npixel, nchan=2)
+        visweights = numpy.ones([nvis, npol])
+        # Two kernels so that the kernel lookup is exercised
+        kernels = self._kernel_list(kernel, nvis, [1.0, 2.0])
+
+        # Reference: add one kernel patch per visibility
+        refgrid = numpy.zeros([2, npol, npixel, npixel], dtype='complex')
+        gh, gw = kernel.shape[-2:]
+        for ivis in range(nvis):
+            y, yf = frac_coord(npixel, 4, uvcoords[ivis, 1])
+            x, xf = frac_coord(npixel, 4, uvcoords[ivis, 0])
+            y -= gh // 2
+            x -= gw // 2
+            kern = kernels[1][kernels[0][ivis]][yf, xf]
+            for pol in range(npol):
+                refgrid[frequencymap[ivis], pol, y:y + gh, x:x + gw] += kern * vis[ivis, pol]
+
+        for vis_block in [1, 99, nvis]:
+            uvgrid = numpy.zeros([2, npol, npixel, npixel], dtype='complex')
+            uvgrid, sumwt = convolutional_grid(kernels, uvgrid, vis, visweights, uvcoords, frequencymap,
+                                               vis_block=vis_block)
+            assert_allclose(uvgrid, refgrid, atol=1e-12)
+            assert_allclose(numpy.sum(sumwt, axis=0), npol * [nvis])
+
     def test_convolutional_degrid(self):
         npixel = 256
         nvis = 100000
         nchan = 1
         npol = 4
         uvgrid = numpy.ones([nchan, npol, npixel, npixel], dtype='complex')
-        gcf, kernel = anti_aliasing_calculate((npixel, npixel), 8)
         # kernel has shape [kernel_oversampling, kernel_oversampling, npixel, npixel] The fractional
         # part of the coordinate maps onto the first two axes.
-        # Make some uv coordinates with random locations
-        uvcoords = numpy.array([[random.uniform(-0.25, 0.25), random.uniform(-0.25, 0.25)] for ivis in range(nvis)])
+        kernel, uvcoords, _, frequencymap = self._random_visibilities(nvis, npol, npixel, oversampling=8)
         vshape = [nvis, npol]
-        kernels = (numpy.zeros([nvis], dtype='int'), [kernel])
-        frequencymap = numpy.zeros([nvis], dtype='int')
+        kernels = self._kernel_list(kernel, nvis)
 
         vis = convolutional_degrid(kernels, vshape, uvgrid, uvcoords, frequencymap)
         assert vis.shape[0] == nvis
         assert vis.shape[1] == npol
 
+    def test_convolutional_degrid_blocks(self):
+        npixel = 64
+        nvis = 1000
+        npol = 2
+        uvgrid = numpy.array([[coordinates2(npixel)[0] + 1j * (pol + chan + 1) * coordinates2(npixel)[1]
+                               for pol in range(npol)] for chan in range(2)])
+        kernel, uvcoords, _, frequencymap = self._random_visibilities(nvis, npol, npixel, nchan=2)
+        # Two kernels so that the kernel lookup is exercised, as in w projection
+        kernels = self._kernel_list(kernel, nvis, [1.0, 1j])
+
+        # Reference: sum one kernel weighted patch per visibility
+        refvis = numpy.zeros([nvis, npol], dtype='complex')
+        gh, gw = kernel.shape[-2:]
+        for ivis in range(nvis):
+            y, yf = frac_coord(npixel, 4, uvcoords[ivis, 1])
+            x, xf = frac_coord(npixel, 4, uvcoords[ivis, 0])
+            y -= gh // 2
+            x -= gw // 2
+            ckern = numpy.conjugate(kernels[1][kernels[0][ivis]][yf, xf])
+            for pol in range(npol):
+                refvis[ivis, pol] = numpy.sum(uvgrid[frequencymap[ivis], pol, y:y + gh, x:x + gw] * ckern)
+
+        for vis_block in [1, 99, nvis]:
+            vis = convolutional_degrid(kernels, [nvis, npol], uvgrid, uvcoords, frequencymap, vis_block=vis_block)
+            assert_allclose(vis, refvis, atol=1e-12)
+
+    def test_gridding_plan(self):
+        npixel = 64
+        nvis = 1000
+        npol = 2
+        kernel, uvcoords, vis, frequencymap = self._random_visibilities(nvis, npol, npixel)
+        visweights = numpy.ones([nvis, npol])
+        kernels = self._kernel_list(kernel, nvis)
+        shape = [1, npol, npixel, npixel]
+        plan = GriddingPlan(kernels, shape, uvcoords, frequencymap)
+
+        uvgrid, sumwt = convolutional_grid(kernels, numpy.zeros(shape, dtype='complex'), vis, visweights, uvcoords,
+                                           frequencymap)
+        planuvgrid, plansumwt = convolutional_grid(plan.kernel_list, numpy.zeros(shape, dtype='complex'), vis,
+                                                   visweights, plan=plan)
+        assert_allclose(planuvgrid, uvgrid)
+        assert_allclose(plansumwt, sumwt)
+
+        dvis = convolutional_degrid(kernels, [nvis, npol], uvgrid, uvcoords, frequencymap)
+        plandvis = convolutional_degrid(plan.kernel_list, [nvis, npol], uvgrid, plan=plan)
+        assert_allclose(plandvis, dvis)
+
+        with self.assertRaises(AssertionError):
+            convolutional_grid(plan.kernel_list, numpy.zeros([1, npol, 2 * npixel, 2 * npixel], dtype='complex'),
+                               vis, visweights, plan=plan)
+
+    def test_gridding_plan_partition(self):
+        npixel = 64
+        nvis = 1000
+        npol = 2
+        kernel, uvcoords, vis, chan = self._random_visibilities(nvis, npol, npixel, nchan=2)
+        visweights = numpy.ones([nvis, npol])
+        shape = [2, npol, npixel, npixel]
+        labels = numpy.random.randint(0, 5, nvis)
+        grid = numpy.random.randn(*shape) + 1j * numpy.random.randn(*shape)
+        plan = GriddingPlan(self._kernel_list(kernel, nvis), shape, uvcoords, chan)
+        refgrid, refsumwt = convolutional_grid(None, numpy.zeros(shape, dtype='complex'), vis, visweights, plan=plan)
+        refvis = convolutional_degrid(None, vis.shape, grid, plan=plan)
+        partition = plan.partition(labels)
+        assert partition is plan.partition(labels.copy())
+        assert [p[0] for p in partition] == sorted(set(labels))
+        sumgrid = numpy.zeros(shape, dtype='complex')
+        for label, rows, subplan in partition:
+            assert numpy.all(labels[rows] == label)
+            assert numpy.all(numpy.diff(rows) > 0)
+            sumgrid, sumwt = convolutional_grid(None, sumgrid, vis[rows], visweights[rows], plan=subplan)
+            assert_allclose(convolutional_degrid(None, vis[rows].shape, grid, plan=subplan), refvis[rows])
+        assert_allclose(sumgrid, refgrid, atol=1e-12 * numpy.max(numpy.abs(refgrid)))
+
+    def test_gridding_plan_with_kernels(self):
+        npixel = 64
+        nvis = 1000
+        npol = 2
+        kernel, uvcoords, vis, chan = self._random_visibilities(nvis, npol, npixel, nchan=2)
+        visweights = numpy.ones([nvis, npol])
+        shape = [2, npol, npixel, npixel]
+        phases = [numpy.exp(0.1j * k * numpy.arange(kernel.shape[-1])) for k in range(3)]
+        kind, kernels = self._kernel_list(kernel, nvis, phases)
+        otherkernels = [kernel * numpy.conjugate(phase) for phase in phases]
+        grid = numpy.random.randn(*shape) + 1j * numpy.random.randn(*shape)
+        plan = GriddingPlan((kind, kernels), shape, uvcoords, chan)
+        refplan = GriddingPlan((kind, otherkernels), shape, uvcoords, chan)
+        otherplan = plan.with_kernels('other', lambda: (kind, otherkernels))
+        assert otherplan is plan.with_kernels('other', None)
+        assert otherplan.corner is plan.corner
+        refgrid, refsumwt = convolutional_grid(None, numpy.zeros(shape, dtype='complex'), vis, visweights,
+                                               plan=refplan)
+        othergrid, othersumwt = convolutional_grid(None, numpy.zeros(shape, dtype='complex'), vis, visweights,
+                                                   plan=otherplan)
+        assert_allclose(othergrid, refgrid)
+        assert_allclose(convolutional_degrid(None, vis.shape, grid, plan=otherplan),
+                        convolutional_degrid(None, vis.shape, grid, plan=refplan))
+
+    def test_gridding_plan_with_polarisations(self):
+        npixel = 64
+        nvis = 1000
+        npol = 2
+        kernel, uvcoords, vis, chan = self._random_visibilities(nvis, npol, npixel, nchan=2)
+        visweights = numpy.random.uniform(0.5, 1.0, [nvis, npol])
+        shape = [2, npol, npixel, npixel]
+        plan = GriddingPlan(self._kernel_list(kernel, nvis), shape, uvcoords, chan)
+        stacked = plan.with_polarisations(2 * npol)
+        assert stacked is plan.with_polarisations(2 * npol)
+        assert stacked.shape == (2, 2 * npol, npixel, npixel)
+        refgrid, refsumwt = convolutional_grid(None, numpy.zeros(shape, dtype='complex'), vis, visweights, plan=plan)
+        psfgrid, _ = convolutional_grid(None, numpy.zeros(shape, dtype='complex'), numpy.ones_like(vis), visweights,
+                                        plan=plan)
+        for sparse in [False, True]:
+            grid, sumwt = convolutional_grid(None, numpy.zeros(stacked.shape, dtype='complex'),
+                                             numpy.concatenate([vis, numpy.ones_like(vis)], axis=1),
+                                             numpy.tile(visweights, 2), plan=stacked, sparse=sparse)
+            assert_allclose(grid[:, :npol], refgrid, atol=1e-12 * numpy.max(numpy.abs(refgrid)))
+            assert_allclose(grid[:, npol:], psfgrid, atol=1e-12 * numpy.max(numpy.abs(psfgrid)))
+            assert_allclose(sumwt[:, :npol], refsumwt)
+
+    def test_convolutional_grid_terms(self):
+        npixel = 64
+        nvis = 1000
+        npol = 2
+        kernel, uvcoords, vis, chan = self._random_visibilities(nvis, npol, npixel, nchan=2)
+        visweights = numpy.random.uniform(0.5, 1.0, [nvis, npol])
+        shape = [2, npol, npixel, npixel]
+        factors = numpy.random.uniform(-1.0, 1.0, [nvis, 2])
+        psf_factors = numpy.random.uniform(-1.0, 1.0, [nvis, 3])
+        psf_phasor = numpy.exp(1j * numpy.random.uniform(0.0, 2.0 * numpy.pi, nvis))
+        plan = GriddingPlan(self._kernel_list(kernel, nvis), shape, uvcoords, chan)
+        for p in [plan, plan.half_plane()]:
+            # Each term is the gridding of the visibilities or the psf phasor with the weights times its factors
+            refterms = [convolutional_grid(None, numpy.zeros(p.shape, dtype='complex'), vis,
+                                           visweights * factors[:, [k]], plan=p) for k in range(2)] + \
+                       [convolutional_grid(None, numpy.zeros(p.shape, dtype='complex'),
+                                           numpy.outer(psf_phasor, numpy.ones(npol)), visweights * psf_factors[:, [k]],
+                                           plan=p) for k in range(3)]
+            stacked = p.with_polarisations(5 * npol)
+            for kwargs in [{}, {'sparse': True}, {'threads': 2, 'tile_size': 16}]:
+                grid, sumwt = convolutional_grid(None, numpy.zeros(stacked.shape, dtype='complex'), vis, visweights,
+                                                 plan=stacked, factors=factors, psf_factors=psf_factors,
+                                                 psf_phasor=psf_phasor, **kwargs)
+                for term, (refgrid, refsumwt) in enumerate(refterms):
+                    assert_allclose(grid[:, term * npol:(term + 1) * npol], refgrid,
+                                    atol=1e-12 * numpy.max(numpy.abs(refgrid)))
+                    assert_allclose(sumwt[:, term * npol:(term + 1) * npol], refsumwt)
+        with self.assertRaises(AssertionError):
+            convolutional_grid(None, numpy.zeros(shape, dtype='complex'), vis, visweights, plan=plan,
+                               factors=factors)
+
+    def test_convolutional_grid_threads(self):
+        npixel = 128
+        nvis = 2000
+        npol = 2
+        kernel, uvcoords, vis, frequencymap = self._random_visibilities(nvis, npol, npixel)
+        visweights = numpy.ones([nvis, npol])
+        kernels = self._kernel_list(kernel, nvis)
+        shape = [1, npol, npixel, npixel]
+        plan = GriddingPlan(kernels, shape, uvcoords, frequencymap)
+
+        uvgrid, sumwt = convolutional_grid(plan.kernel_list, numpy.zeros(shape, dtype='complex'), vis, visweights,
+                                           plan=plan, tile_size=32)
+        tiled = [convolutional_grid(plan.kernel_list, numpy.zeros(shape, dtype='complex'), vis, visweights,
+                                    plan=plan, threads=threads, tile_size=32)
+                 for threads in [1, 2, 5]]
+        for tileduvgrid, tiledsumwt in tiled:
+            assert_allclose(tiledsumwt, sumwt)
+            # Bitwise reproducible for any number of threads, including none
+            assert numpy.array_equal(tileduvgrid, uvgrid)
+        # Other tile sizes agree to rounding
+        assert_allclose(convolutional_grid(plan.kernel_list, numpy.zeros(shape, dtype='complex'), vis, visweights,
+                                           plan=plan)[0], uvgrid, atol=1e-12)
+
+        dvis = convolutional_degrid(plan.kernel_list, [nvis, npol], uvgrid, plan=plan)
+        threadvis = convolutional_degrid(plan.kernel_list, [nvis, npol], uvgrid, plan=plan, threads=3, vis_block=100)
+        assert numpy.array_equal(threadvis, dvis)
+
+    def _backend_parity(self, grid_rows, degrid_rows, nvis=200):
+        npixel = 32
+        npol = 2
+        kernel, uvcoords, viswt, chan = self._random_visibilities(nvis, npol, npixel)
+        kernels = self._kernel_list(kernel, nvis, [1.0, 1j])
+        plan = GriddingPlan(kernels, [1, npol, npixel, npixel], uvcoords, chan)
+        flatkernels = plan.kernels.reshape(plan.kernels.shape[:3] + (-1,))
+        args = (plan.corner, plan.offsets, flatkernels, plan.kind, plan.yf, plan.xf)
+
+        refgrid = numpy.zeros([npol * npixel * npixel], dtype='complex')
+        numpy_grid_rows(refgrid, *args, viswt, npixel * npixel)
+        flatgrid = numpy.zeros([npol * npixel * npixel], dtype='complex')
+        grid_rows(flatgrid, *args, viswt, npixel * npixel)
+        assert_allclose(flatgrid, refgrid, atol=1e-12)
+
+        args = (plan.corner, plan.offsets, numpy.conjugate(flatkernels), plan.kind, plan.yf, plan.xf)
+        refvis = numpy.zeros([nvis, npol], dtype='complex')
+        numpy_degrid_rows(refgrid, *args, refvis, npixel * npixel)
+        vis = numpy.zeros([nvis, npol], dtype='complex')
+        degrid_rows(refgrid, *args, vis, npixel * npixel)
+        assert_allclose(vis, refvis, atol=1e-12)
+
+    def test_gridder_backend_loop(self):
+        self._backend_parity(loop_grid_rows, loop_degrid_rows)
+
+    def test_gridder_backends(self):
+        for name in gridder_backends.keys():
+            self._backend_parity(*get_gridder_backend(name))
+
+    def _separable_backend_parity(self, grid_rows, degrid_rows, nvis=200):
+        npixel = 32
+        npol = 2
+        kernel, uvcoords, viswt, chan = self._random_visibilities(nvis, npol, npixel)
+        plan = GriddingPlan(self._kernel_list(kernel, nvis), [1, npol, npixel, npixel], uvcoords, chan)
+        assert plan.separable is not None
+        flatkernels = plan.kernels.reshape(plan.kernels.shape[:3] + (-1,))
+        args = (plan.corner, plan.offsets, flatkernels, plan.kind, plan.yf, plan.xf)
+        sargs = (plan.corner, plan.offsets, plan.separable[0], plan.separable[1], plan.yf, plan.xf)
+        
+        refgrid = numpy.zeros([npol * npixel * npixel], dtype='complex')
+        numpy_grid_rows(refgrid, *args, viswt, npixel * npixel)
+        flatgrid = numpy.zeros([npol * npixel * npixel], dtype='complex')
+        grid_rows(flatgrid, *sargs, viswt, npixel * npixel)
+        assert_allclose(flatgrid, refgrid, atol=1e-12)
+        
+        refvis = numpy.zeros([nvis, npol], dtype='complex')
+        numpy_degrid_rows(refgrid, *args, refvis, npixel * npixel)
+        vis = numpy.zeros([nvis, npol], dtype='complex')
+        degrid_rows(refgrid, *sargs, vis, npixel * npixel)
+        assert_allclose(vis, refvis, atol=1e-12)
+    
+    def test_separate_kernel(self):
+        gcf, kernel = anti_aliasing_calculate((64, 64), 8)
+        ky, kx = separate_kernel(kernel)
+        assert ky.shape == (8, 8) and kx.shape == (8, 8)
+        assert_allclose(ky[:, numpy.newaxis, :, numpy.newaxis] * kx[numpy.newaxis, :, numpy.newaxis, :], kernel,
+                        atol=1e-15)
+        assert separate_kernel(1j * kernel) is None
+        assert separate_kernel(w_kernel(64, 0.1, 300.0, 4, 8, gcf=gcf)) is None
+    
+    def test_gridder_backend_separable_loop(self):
+        self._separable_backend_parity(loop_grid_rows_separable, loop_degrid_rows_separable)
+    
+    def test_gridder_backends_separable(self):
+        for name in separable_gridder_backends.keys():
+            self._separable_backend_parity(*get_gridder_backend(name, separable=True))
+    
+    def test_convolutional_grid_separable(self):
+        npixel = 64
+        nvis = 1000
+        npol = 4
+        kernel, uvcoords, vis, chan = self._random_visibilities(nvis, npol, npixel, oversampling=8)
+        visweights = numpy.ones([nvis, npol])
+        kernels = self._kernel_list(kernel, nvis)
+        shape = [1, npol, npixel, npixel]
+        dense = GriddingPlan(kernels, shape, uvcoords, chan, separable=False)
+        separable = GriddingPlan(kernels, shape, uvcoords, chan)
+        assert dense.separable is None and separable.separable is not None
+        refgrid, refsumwt = convolutional_grid(None, numpy.zeros(shape, dtype='complex'), vis, visweights, plan=dense)
+        uvgrid, sumwt = convolutional_grid(None, numpy.zeros(shape, dtype='complex'), vis, visweights,
+                                           plan=separable)
+        assert_allclose(uvgrid, refgrid, atol=1e-12)
+        assert_allclose(sumwt, refsumwt)
+        refvis = convolutional_degrid(None, vis.shape, refgrid, plan=dense)
+        newvis = convolutional_degrid(None, vis.shape, refgrid, plan=separable)
+        assert_allclose(newvis, refvis, atol=1e-12)
+
+    def test_convolutional_grid_single(self):
+        npixel = 64
+        nvis = 1000
+        npol = 2
+        kernel, uvcoords, vis, chan = self._random_visibilities(nvis, npol, npixel, oversampling=8)
+        visweights = numpy.ones([nvis, npol])
+        shape = [1, npol, npixel, npixel]
+        for factors in [[1.0], [1.0, 1j]]:
+            plan = GriddingPlan(self._kernel_list(kernel, nvis, factors), shape, uvcoords, chan)
+            for name in gridder_backends.keys():
+                refgrid, refsumwt = convolutional_grid(None, numpy.zeros(shape, dtype='complex'), vis, visweights,
+                                                       plan=plan, gridder=name)
+                uvgrid, sumwt = convolutional_grid(None, numpy.zeros(shape, dtype='complex64'), vis, visweights,
+                                                   plan=plan, gridder=name)
+                assert uvgrid.dtype == numpy.complex64
+                assert sumwt.dtype == numpy.float64
+                assert_allclose(uvgrid, refgrid, atol=1e-5 * numpy.max(numpy.abs(refgrid)))
+                assert_allclose(sumwt, refsumwt)
+                refvis = convolutional_degrid(None, vis.shape, refgrid, plan=plan, gridder=name)
+                newvis = convolutional_degrid(None, vis.shape, uvgrid, plan=plan, gridder=name)
+                assert_allclose(newvis, refvis, atol=1e-5 * numpy.max(numpy.abs(refvis)))
+
+    def test_convolutional_grid_half_plane(self):
+        npixel = 64
+        nvis = 1000
+        npol = 2
+        kernel, uvcoords, vis, chan = self._random_visibilities(nvis, npol, npixel, oversampling=8, nchan=2)
+        visweights = numpy.ones([nvis, npol])
+        shape = [2, npol, npixel, npixel]
+        model = numpy.random.randn(*shape)
+        for factors in [[1.0], [1.0, 1j]]:
+            plan = GriddingPlan(self._kernel_list(kernel, nvis, factors), shape, uvcoords, chan)
+            half = plan.half_plane()
+            assert half is plan.half_plane()
+            assert half.shape == (2, npol, npixel + 8, 8 + npixel // 2 + 1)
+            refgrid, refsumwt = convolutional_grid(None, numpy.zeros(shape, dtype='complex'), vis, visweights,
+                                                   plan=plan)
+            refimage = ifft(refgrid).real
+            refvis = convolutional_degrid(None, vis.shape, fft(model), plan=plan)
+            for name in gridder_backends.keys():
+                for threads in [None, 2]:
+                    hgrid, sumwt = convolutional_grid(None, numpy.zeros(half.shape, dtype='complex'), vis,
+                                                      visweights, plan=half, gridder=name, threads=threads,
+                                                      tile_size=16)
+                    image = irfft(fold_half_plane(hgrid, half.kernel_shape), npixel)
+                    assert_allclose(image, refimage, atol=1e-12 * numpy.max(numpy.abs(refimage)))
+                    assert_allclose(sumwt, refsumwt)
+                hgrid = unfold_half_plane(rfft(model), numpy.zeros(half.shape, dtype='complex'), half.kernel_shape)
+                newvis = convolutional_degrid(None, vis.shape, hgrid, plan=half, gridder=name)
+                assert_allclose(newvis, refvis, atol=1e-12 * numpy.max(numpy.abs(refvis)))
+    
+    def test_convolutional_grid_sparse(self):
+        npixel = 64
+        nvis = 1000
+        npol = 2
+        kernel, uvcoords, vis, chan = self._random_visibilities(nvis, npol, npixel, oversampling=8, nchan=2)
+        visweights = numpy.ones([nvis, npol])
+        shape = [2, npol, npixel, npixel]
+        model = fft(numpy.random.randn(*shape))
+        for factors in [[1.0], [1.0, 1j]]:
+            plan = GriddingPlan(self._kernel_list(kernel, nvis, factors), shape, uvcoords, chan)
+            for p in [plan, plan.half_plane()]:
+                grid = numpy.random.randn(*p.shape) + 1j * numpy.random.randn(*p.shape)
+                refgrid, refsumwt = convolutional_grid(None, numpy.zeros(p.shape, dtype='complex'), vis, visweights,
+                                                       plan=p)
+                refvis = convolutional_degrid(None, vis.shape, grid, plan=p)
+                for dtype, tol in [('complex', 1e-12), ('complex64', 1e-5)]:
+                    sgrid, sumwt = convolutional_grid(None, numpy.zeros(p.shape, dtype=dtype), vis, visweights,
+                                                      plan=p, sparse=True)
+                    assert_allclose(sgrid, refgrid, atol=tol * numpy.max(numpy.abs(refgrid)))
+                    assert_allclose(sumwt, refsumwt)
+                    svis = convolutional_degrid(None, vis.shape, grid.astype(dtype), plan=p, sparse=True)
+                    assert_allclose(svis, refvis, atol=tol * numpy.max(numpy.abs(refvis)))
+                    assert (numpy.dtype(dtype), False) in p._sparse
+                # The operator is built once
+                assert p.sparse_operator('complex') is p.sparse_operator('complex')
+            refvis = convolutional_degrid(None, vis.shape, model, plan=plan)
+            assert_allclose(convolutional_degrid(None, vis.shape, model, plan=plan, sparse=True), refvis,
+                            atol=1e-12 * numpy.max(numpy.abs(refvis)))
+    
+    def test_convolutional_grid_sparse_limit(self):
+        import libs.fourier_transforms.convolutional_gridding as convolutional_gridding
+        nvis = 100
+        kernel, uvcoords, _, chan = self._random_visibilities(nvis, 1, 32)
+        vis = numpy.ones([nvis, 1], dtype='complex')
+        shape = [1, 1, 32, 32]
+        plan = GriddingPlan(self._kernel_list(kernel, nvis), shape, uvcoords, chan)
+        refgrid, _ = convolutional_grid(None, numpy.zeros(shape, dtype='complex'), vis, numpy.ones([nvis, 1]),
+                                        plan=plan)
+        max_bytes = convolutional_gridding.sparse_operator_max_bytes
+        try:
+            convolutional_gridding.sparse_operator_max_bytes = plan.sparse_operator_bytes() - 1
+            grid, _ = convolutional_grid(None, numpy.zeros(shape, dtype='complex'), vis, numpy.ones([nvis, 1]),
+                                         plan=plan, sparse=True)
+            assert len(plan._sparse) == 0
+            assert_allclose(grid, refgrid)
+        finally:
+            convolutional_gridding.sparse_operator_max_bytes = max_bytes
+    
+    def test_weight_gridding_half_plane(self):
+        nvis = 1000
+        npol = 2
+        shape = [2, npol, 32, 32]
+        uvcoords = numpy.random.uniform(-0.2, 0.2, [nvis, 2])
+        uvcoords[:20, 0] = 0.0
+        visweights = numpy.random.uniform(0.5, 1.0, [nvis, npol])
+        chan = numpy.random.randint(0, 2, nvis)
+        refweights, refdensity, refgrid = weight_gridding(shape, visweights, uvcoords, chan)
+        weights, density, densitygrid = weight_gridding(shape, visweights, uvcoords, chan, half_plane=True)
+        assert densitygrid.shape == (2, npol, 32, 17)
+        assert_allclose(densitygrid[..., :16], refgrid[..., 16:], atol=1e-12)
+        assert_allclose(density, refdensity, atol=1e-12)
+        assert_allclose(weights, refweights, atol=1e-12)
+    
+    def test_weight_gridding(self):
+        nvis = 1000
+        npol = 2
+        shape = [2, npol, 32, 32]
+        uvcoords = numpy.random.uniform(-0.2, 0.2, [nvis, 2])
+        visweights = numpy.random.uniform(0.5, 1.0, [nvis, npol])
+        chan = numpy.random.randint(0, 2, nvis)
+        # Density grid summed one sample at a time, counting each sample at (u, v) and (-u, -v)
+        refgrid = numpy.zeros(shape)
+        for flip in [-1.0, 1.0]:
+            y, _ = frac_coord(32, 1.0, flip * uvcoords[:, 1])
+            x, _ = frac_coord(32, 1.0, flip * uvcoords[:, 0])
+            for ivis in range(nvis):
+                refgrid[chan[ivis], :, y[ivis], x[ivis]] += visweights[ivis]
+        weights, density, densitygrid = weight_gridding(shape, visweights, uvcoords, chan)
+        assert_allclose(densitygrid, refgrid, atol=1e-12)
+        assert_allclose(weights * density, visweights)
+        natural, density, densitygrid = weight_gridding(shape, visweights, uvcoords, chan, weighting='natural')
+        assert natural is visweights and density is None
+        # Briggs weighting goes from uniform to natural as the robustness increases
+        for half_plane in [False, True]:
+            briggs = weight_gridding(shape, visweights, uvcoords, chan, weighting='briggs', robustness=10.0,
+                                     half_plane=half_plane)[0]
+            assert_allclose(briggs, visweights, rtol=1e-6)
+            briggs = weight_gridding(shape, visweights, uvcoords, chan, weighting='briggs', robustness=-10.0,
+                                     half_plane=half_plane)[0]
+            for c in range(2):
+                ratio = briggs[chan == c] / weights[chan == c]
+                assert_allclose(ratio, ratio[0] * numpy.ones_like(ratio), rtol=1e-6)
+        assert_allclose(weight_gridding(shape, visweights, uvcoords, chan, weighting='briggs', half_plane=True)[0],
+                        weight_gridding(shape, visweights, uvcoords, chan, weighting='briggs')[0], rtol=1e-12)
+        # Super-uniform weighting sums over the cells of a smaller field of view
+        superweights, density, densitygrid = weight_gridding(shape, visweights, uvcoords, chan,
+                                                             weighting='super-uniform')
+        assert densitygrid.shape == (2, npol, 11, 11)
+        assert_allclose(numpy.sum(densitygrid), 2 * numpy.sum(visweights))
+        assert_allclose(superweights, weight_gridding(shape, visweights, uvcoords, chan, field_of_view=1.0 / 3.0)[0])
+        assert numpy.all(density >= weight_gridding(shape, visweights, uvcoords, chan)[1] - 1e-12)
+    
+    def test_gridder_backend_fallback(self):
+        assert get_gridder_backend('no_such_gridder') == gridder_backends['numpy']
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -7,7 +7,8 @@ import unittest
 
 from numpy.testing import assert_allclose
 
-from libs.fourier_transforms.fft_support import extract_mid, pad_mid, extract_oversampled
+from libs.fourier_transforms.fft_support import extract_mid, pad_mid, extract_oversampled, fft, ifft, \
+    fft_backends, get_fft_backend, set_fft_backend, WorkspacePool, rfft, irfft, real_fft_backends
 from libs.fourier_transforms.convolutional_gridding import coordinates2
 
 
@@ -33,12 +34,102 @@ class TestFFTSupport(unittest.TestCase):
             # And extracting the middle should recover the original data_models
             assert_allclose(extract_mid(cs_pad, npixel), cs)
     
+    def test_pad_extract_out(self):
+        for npixel, N2 in [(100, 128), (128, 256), (128, 128)]:
+            cs = 1 + self._pattern(npixel)
+            out = numpy.ones([N2, N2], dtype='complex')
+            assert pad_mid(cs, N2, out=out) is out
+            assert_allclose(out, pad_mid(cs, N2))
+            mid = numpy.zeros([npixel, npixel], dtype='complex')
+            assert extract_mid(out, npixel, out=mid) is mid
+            assert_allclose(mid, cs)
+    
+    def test_workspace_pool(self):
+        pool = WorkspacePool(max_free_bytes=3 * 64 * 64 * 16)
+        with pool.buffer([64, 64]) as a:
+            a[...] = 1.0
+            assert pool.statistics()['in_use_bytes'] == a.nbytes
+        with pool.buffer([64, 64]) as b:
+            assert b is a
+            assert numpy.max(numpy.abs(b)) == 0.0
+            with pool.buffer([64, 64]) as c:
+                assert c is not b
+        d = pool.get([64, 64], dtype='complex64')
+        assert d.dtype == numpy.complex64
+        pool.release(d)
+        stats = pool.statistics()
+        assert stats['allocated'] == 3
+        assert stats['reused'] == 1
+        assert stats['in_use_bytes'] == 0
+        # All the arrays fit in the pool
+        assert stats['free_bytes'] == 2 * 64 * 64 * 16 + 64 * 64 * 8
+        pool.clear()
+        assert pool.statistics()['free_bytes'] == 0
+    
     def test_extract_oversampled(self):
         for npixel, kernel_oversampling in [(1, 2), (2, 3), (3, 2), (4, 2), (5, 3)]:
             a = 1 + self._pattern(npixel * kernel_oversampling)
             ex = extract_oversampled(a, 0, 0, kernel_oversampling, npixel) / kernel_oversampling ** 2
             assert_allclose(ex, 1 + self._pattern(npixel))
 
+    def test_fft_single(self):
+        a = 1 + self._pattern(64)
+        for transform in [fft, ifft]:
+            result = transform(a.astype('complex64'))
+            assert result.dtype == numpy.complex64
+            assert_allclose(result, transform(a), atol=1e-5 * numpy.max(numpy.abs(transform(a))))
+            assert transform(a).dtype == numpy.complex128
+
+    def test_fft_shift_free(self):
+        for shape in [(64, 64), (62, 64), (2, 1, 32, 30), (63, 64)]:
+            a = numpy.random.randn(*shape) + 1j * numpy.random.randn(*shape)
+            axes = [len(shape) - 2, len(shape) - 1]
+            ref = numpy.fft.fftshift(numpy.fft.fft2(numpy.fft.ifftshift(a, axes=axes)), axes=axes)
+            assert_allclose(fft(a), ref, atol=1e-12)
+            ref = numpy.fft.fftshift(numpy.fft.ifft2(numpy.fft.ifftshift(a, axes=axes)), axes=axes)
+            assert_allclose(ifft(a), ref, atol=1e-12)
+            # In place
+            b = a.copy()
+            result = ifft(b, out=b)
+            assert result is b
+            assert_allclose(b, ref, atol=1e-12)
+            # Real input
+            assert_allclose(fft(a.real), fft(a.real + 0j), atol=1e-12)
+    
+    def test_fft_backends(self):
+        a = numpy.random.randn(2, 1, 64, 64) + 1j * numpy.random.randn(2, 1, 64, 64)
+        for name in fft_backends.keys():
+            for workers in [1, 2]:
+                assert_allclose(fft(a, backend=name, workers=workers), fft(a, backend='numpy'), atol=1e-10)
+                assert_allclose(ifft(a, backend=name, workers=workers), ifft(a, backend='numpy'), atol=1e-12)
+                assert_allclose(ifft(fft(a, backend=name, workers=workers), backend=name), a, atol=1e-12)
+    
+    def test_rfft(self):
+        a = numpy.random.randn(2, 1, 64, 32)
+        columns = (16 + numpy.arange(17)) % 32
+        for name in real_fft_backends.keys():
+            half = rfft(a, backend=name)
+            assert half.shape == (2, 1, 64, 17)
+            assert_allclose(half, fft(a)[..., columns], atol=1e-10)
+            assert_allclose(irfft(half, 32, backend=name), a, atol=1e-12)
+        # Any grid: irfft of the Hermitian part is the real part of ifft
+        g = numpy.random.randn(64, 32) + 1j * numpy.random.randn(64, 32)
+        rows = (64 - numpy.arange(64)) % 64
+        hermitian = 0.5 * (g + numpy.conjugate(g[rows][:, (32 - numpy.arange(32)) % 32]))
+        assert_allclose(irfft(hermitian[:, columns], 32), ifft(g).real, atol=1e-12)
+        assert rfft(a.astype('float32')).dtype == numpy.complex64
+    
+    def test_set_fft_backend(self):
+        old_backend, old_workers = get_fft_backend()
+        old_name = [name for name in fft_backends.keys() if fft_backends[name] == old_backend][0]
+        try:
+            set_fft_backend('scipy', 2)
+            assert get_fft_backend() == (fft_backends['scipy'], 2)
+            set_fft_backend('no_such_fft')
+            assert get_fft_backend() == (fft_backends['numpy'], 2)
+        finally:
+            set_fft_backend(old_name, old_workers)
+
 
 if __name__ == '__main__':
     unittest.main()
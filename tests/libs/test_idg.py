@@ -0,0 +1,76 @@
+""" Unit tests for image domain gridding
+
+
+"""
+import unittest
+
+import numpy
+from numpy.testing import assert_allclose
+
+from libs.fourier_transforms.fft_support import fft, ifft, pad_mid, extract_mid
+from libs.fourier_transforms.idg import IDGPlan, idg_grid, idg_degrid, idg_taper, idg_correction
+
+
+class TestIDG(unittest.TestCase):
+
+    def setUp(self):
+        numpy.random.seed(180555)
+        self.npixel = 48
+        self.ngrid = 96
+        self.nvis = 400
+        self.cellsize = 0.004
+        self.fov = self.ngrid * self.cellsize
+        self.image = numpy.random.randn(2, 1, self.npixel, self.npixel)
+        self.uvcoords = numpy.random.uniform(-0.3, 0.3, [self.nvis, 2])
+        self.w = numpy.random.uniform(-50.0, 50.0, self.nvis)
+        self.chan = numpy.random.randint(0, 2, self.nvis)
+        self.vis = numpy.random.randn(self.nvis, 1) + 1j * numpy.random.randn(self.nvis, 1)
+        # Direct Fourier transform including the w term
+        l = (numpy.arange(self.npixel) - self.npixel // 2) * self.cellsize
+        nm1 = numpy.sqrt(1.0 - l[:, numpy.newaxis] ** 2 - l[numpy.newaxis, :] ** 2) - 1.0
+        u, v = (self.uvcoords * self.ngrid / self.fov).T
+        self.dft = numpy.exp(-2j * numpy.pi * (v[:, numpy.newaxis, numpy.newaxis] * l[numpy.newaxis, :, numpy.newaxis] +
+                                               u[:, numpy.newaxis, numpy.newaxis] * l[numpy.newaxis, numpy.newaxis, :] +
+                                               self.w[:, numpy.newaxis, numpy.newaxis] * nm1[numpy.newaxis, ...]))
+
+    def test_idg_taper(self):
+        for kernel in ['kaiser_bessel', 'pswf']:
+            taper = idg_taper(32, kernel=kernel)
+            self.assertAlmostEqual(taper[16], 1.0)
+            assert taper[0] < 1e-4
+            correction = idg_correction(32, kernel=kernel)
+            assert_allclose(correction[taper > 0.0] * taper[taper > 0.0], 1.0)
+            assert numpy.all(correction[taper == 0.0] == 0.0)
+
+    def test_idg_plan(self):
+        plan = IDGPlan([2, 1, self.ngrid, self.ngrid], self.uvcoords, self.chan, self.w, (self.fov, self.fov))
+        assert plan.kernel_shape == (32, 32)
+        assert numpy.all(numpy.sort(plan.order) == numpy.arange(self.nvis))
+        # Each row is at least margin from the edges of its subgrid
+        assert numpy.all(numpy.abs(plan.du) <= 16 - plan.margin)
+        assert numpy.all(numpy.abs(plan.dv) <= 16 - plan.margin)
+        assert numpy.all(plan.subgrid_chan[plan.subgrid] == self.chan[plan.order])
+        assert sum(s1 - s0 for s0, s1 in plan.batches(50)) == plan.nsubgrids
+        with self.assertRaises(AssertionError):
+            IDGPlan([2, 1, self.ngrid, self.ngrid], self.uvcoords, self.chan, 10 * self.w, (self.fov, self.fov))
+
+    def test_idg(self):
+        gcf = numpy.outer(idg_correction(self.ngrid, 6), idg_correction(self.ngrid, 6))
+        refvis = numpy.einsum('vyx,vyx->v', self.dft, self.image[self.chan, 0])
+        for subgrid_size in [32, 48]:
+            plan = IDGPlan([2, 1, self.ngrid, self.ngrid], self.uvcoords, self.chan, self.w, (self.fov, self.fov),
+                           subgrid_size=subgrid_size, support=6)
+            vis = idg_degrid(self.vis.shape, fft(pad_mid(self.image, self.ngrid) * gcf), plan, vis_block=100)
+            assert numpy.linalg.norm(vis[:, 0] - refvis) < 1e-6 * numpy.linalg.norm(refvis)
+            grid, sumwt = idg_grid(numpy.zeros(plan.shape, dtype='complex'), self.vis, numpy.ones(self.vis.shape),
+                                   plan, vis_block=100)
+            image = extract_mid(ifft(grid) * gcf, self.npixel) * self.ngrid ** 2
+            for chan in range(2):
+                rows = self.chan == chan
+                refimage = numpy.einsum('vyx,v->yx', numpy.conjugate(self.dft[rows]), self.vis[rows, 0])
+                assert_allclose(image[chan, 0], refimage, atol=1e-6 * numpy.max(numpy.abs(refimage)))
+                self.assertAlmostEqual(sumwt[chan, 0], numpy.sum(rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
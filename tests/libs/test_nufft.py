@@ -0,0 +1,76 @@
+""" Unit tests for the non-uniform FFT
+
+
+"""
+import unittest
+
+import numpy
+from numpy.testing import assert_allclose
+
+from libs.fourier_transforms.convolutional_gridding import convolutional_grid, convolutional_degrid, \
+    fold_half_plane, unfold_half_plane
+from libs.fourier_transforms.fft_support import fft, ifft, rfft, irfft, pad_mid, extract_mid
+from libs.fourier_transforms.nufft import es_kernel, nufft_parameters, nufft_grid_size, es_correction, NUFFTPlan
+
+
+class TestNUFFT(unittest.TestCase):
+    
+    def setUp(self):
+        numpy.random.seed(180555)
+        self.npixel = 64
+        self.nvis = 300
+        self.image = numpy.random.randn(1, 1, self.npixel, self.npixel)
+        self.uvcoords = numpy.random.uniform(-0.4, 0.4, [self.nvis, 2])
+        self.vis = numpy.random.randn(self.nvis, 1) + 1j * numpy.random.randn(self.nvis, 1)
+        # Direct Fourier transform
+        pixels = numpy.arange(self.npixel) - self.npixel // 2
+        self.dft = numpy.exp(-2j * numpy.pi * (self.uvcoords[:, 1, numpy.newaxis, numpy.newaxis] *
+                                               pixels[numpy.newaxis, :, numpy.newaxis] +
+                                               self.uvcoords[:, 0, numpy.newaxis, numpy.newaxis] *
+                                               pixels[numpy.newaxis, numpy.newaxis, :]))
+    
+    def test_es_kernel(self):
+        assert_allclose(es_kernel([-1.0, 0.0, 1.0, 1.5], 10.0), [numpy.exp(-10.0), 1.0, numpy.exp(-10.0), 0.0])
+    
+    def test_nufft_parameters(self):
+        support, beta, upsampling = nufft_parameters(1e-6)
+        assert upsampling == 1.25
+        assert support == 10
+        support2, _, _ = nufft_parameters(1e-6, upsampling=2.0)
+        assert support2 < support
+        assert nufft_parameters(1e-12)[2] == 2.0
+        assert nufft_grid_size(64, 1.25, support) == 80
+        assert nufft_grid_size(100, 1.25, support) % 2 == 0
+    
+    def test_nufft(self):
+        refvis = numpy.einsum('vyx,yx->v', self.dft, self.image[0, 0])
+        refimage = numpy.einsum('vyx,v->yx', numpy.conjugate(self.dft), self.vis[:, 0]).real
+        for epsilon, upsampling in [(1e-4, None), (1e-6, None), (1e-6, 2.0), (1e-10, None)]:
+            support, beta, upsampling = nufft_parameters(epsilon, upsampling)
+            ngrid = nufft_grid_size(self.npixel, upsampling, support)
+            correction = es_correction(ngrid, support, beta)
+            gcf = numpy.outer(correction, correction)
+            plan = NUFFTPlan([1, 1, ngrid, ngrid], self.uvcoords, numpy.zeros([self.nvis], dtype='int'), support,
+                             beta)
+            # Type 2
+            vis = convolutional_degrid(None, self.vis.shape, fft(pad_mid(self.image, ngrid) * gcf), plan=plan)
+            assert numpy.linalg.norm(vis[:, 0] - refvis) < 10 * epsilon * numpy.linalg.norm(refvis)
+            # Type 1
+            grid, _ = convolutional_grid(None, numpy.zeros(plan.shape, dtype='complex'), self.vis,
+                                         numpy.ones(self.vis.shape), plan=plan)
+            image = ngrid ** 2 * extract_mid(ifft(grid).real * gcf, self.npixel)[0, 0]
+            assert numpy.linalg.norm(image - refimage) < 10 * epsilon * numpy.linalg.norm(refimage)
+            # Half plane
+            half = plan.half_plane()
+            hgrid, _ = convolutional_grid(None, numpy.zeros(half.shape, dtype='complex'), self.vis,
+                                          numpy.ones(self.vis.shape), plan=half)
+            assert_allclose(irfft(fold_half_plane(hgrid, half.kernel_shape), ngrid), ifft(grid).real,
+                            atol=1e-12 * numpy.max(numpy.abs(ifft(grid).real)))
+            hgrid = unfold_half_plane(rfft(pad_mid(self.image, ngrid) * gcf),
+                                      numpy.zeros(half.shape, dtype='complex'), half.kernel_shape)
+            assert_allclose(convolutional_degrid(None, self.vis.shape, hgrid, plan=half), vis,
+                            atol=1e-12 * numpy.max(numpy.abs(vis)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -14,10 +14,10 @@ from data_models.polarisation import PolarisationFrame
 from libs.image.operations import create_image_from_array
 
 from processing_components.image.deconvolution import deconvolve_cube, restore_cube
-from processing_components.image.operations import export_image_to_fits
+from processing_components.image.operations import export_image_to_fits, calculate_image_frequency_moments
 from processing_components.util.testing_support import create_low_test_image_from_gleam, create_low_test_beam, create_named_configuration
 from processing_components.visibility.base import create_visibility
-from processing_components.imaging.base import predict_2d, invert_2d, create_image_from_visibility
+from processing_components.imaging.base import predict_2d, invert_2d, invert_mfs, create_image_from_visibility
 
 log = logging.getLogger(__name__)
 
@@ -138,6 +138,28 @@ class TestImageDeconvolutionMSMFS(unittest.TestCase):
         export_image_to_fits(self.cmodel, "%s/test_deconvolve_mmclean_quadratic_psf-clean.fits" % self.dir)
         assert numpy.max(self.residual.data) < 3.0
 
+    def test_invert_mfs(self):
+        dirty_taylor, sumwt, psf_taylor = invert_mfs(self.vis, self.model, nmoments=2, withpsf=True)
+        assert dirty_taylor.shape[0] == 2
+        assert psf_taylor.shape[0] == 4
+        # The channels have the same weights, so the moments are those of the cube divided by nchan
+        for image, taylor in [(self.dirty, dirty_taylor), (self.psf, psf_taylor)]:
+            refmoments = calculate_image_frequency_moments(image, nmoments=taylor.shape[0])
+            numpy.testing.assert_allclose(taylor.data, refmoments.data / self.nchan,
+                                          atol=1e-7 * numpy.max(numpy.abs(refmoments.data)))
+        moments, _ = invert_mfs(self.vis, self.model, nmoments=2)
+        numpy.testing.assert_allclose(moments.data, dirty_taylor.data)
+    
+    def test_deconvolve_mmclean_linear_mfs(self):
+        dirty_taylor, sumwt, psf_taylor = invert_mfs(self.vis, self.model, nmoments=2, withpsf=True)
+        self.comp, self.residual = deconvolve_cube(dirty_taylor, psf_taylor, niter=self.niter, gain=0.1,
+                                                   algorithm='mmclean',
+                                                   scales=[0, 3, 10], threshold=0.01, findpeak='ARL',
+                                                   fractional_threshold=0.01, window=self.innerquarter)
+        assert self.comp.shape == dirty_taylor.shape
+        assert self.residual.wcs.wcs.ctype[3] == 'MOMENT'
+        assert numpy.max(self.residual.data) < 3.0
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -16,9 +16,12 @@ from processing_components.component_support.arlexecute import arlexecute
 from processing_components.image.operations import export_image_to_fits, smooth_image
 from processing_components.imaging.base import predict_skycomponent_visibility
 from processing_components.imaging.imaging_components import zero_vislist_component, predict_component, \
-    invert_component, subtract_vislist_component
+    invert_component, subtract_vislist_component, invert_psf_component, weight_component
+from processing_components.imaging.weighting import weight_visibility
 from processing_components.skycomponent.operations import find_skycomponents, find_nearest_skycomponent, \
     insert_skycomponent
+from processing_components.visibility.base import copy_visibility
+from processing_components.visibility.operations import concatenate_visibility
 from processing_components.util.testing_support import create_named_configuration, ingest_unittest_visibility, \
     create_unittest_model, \
     insert_unittest_errors, create_unittest_components
@@ -220,10 +223,76 @@ class TestImaging(unittest.TestCase):
         self.actualSetUp(dospectral=True, dopol=True)
         self._predict_base(context='wstack', extra='_spectral', fluxthreshold=4.0, vis_slices=41)
     
+    def test_predict_wstack_planes(self):
+        self.actualSetUp()
+        self._predict_base(context='wstack_planes', fluxthreshold=2.0, vis_slices=41)
+    
+    def test_predict_wstack_planes_wprojection(self):
+        self.actualSetUp()
+        self._predict_base(context='wstack_planes', extra='_wprojection', fluxthreshold=3.0, wstep=2.5,
+                           vis_slices=11, oversampling=2)
+    
+    def test_predict_wstack_planes_spectral_pol(self):
+        self.actualSetUp(dospectral=True, dopol=True)
+        self._predict_base(context='wstack_planes', extra='_spectral', fluxthreshold=4.0, vis_slices=41)
+    
     def test_invert_2d(self):
         self.actualSetUp(zerow=True)
         self._invert_base(context='2d', positionthreshold=2.0, check_components=False)
     
+    def test_predict_2d_single(self):
+        self.actualSetUp(zerow=True)
+        self._predict_base(context='2d', extra='_single', precision='single')
+    
+    def test_invert_2d_single(self):
+        self.actualSetUp(zerow=True)
+        self._invert_base(context='2d', extra='_single', positionthreshold=2.0, check_components=False,
+                          precision='single')
+    
+    def test_predict_2d_half_plane(self):
+        self.actualSetUp(zerow=True)
+        self._predict_base(context='2d', extra='_half_plane', half_plane=True)
+    
+    def test_invert_2d_half_plane(self):
+        self.actualSetUp(zerow=True)
+        self._invert_base(context='2d', extra='_half_plane', positionthreshold=2.0, check_components=False,
+                          half_plane=True)
+    
+    def test_invert_wprojection_half_plane(self):
+        self.actualSetUp()
+        self._invert_base(context='2d', extra='_wprojection_half_plane', positionthreshold=2.0, wstep=10.0,
+                          oversampling=2, half_plane=True)
+    
+    def test_predict_2d_kaiser_bessel(self):
+        self.actualSetUp(zerow=True)
+        self._predict_base(context='2d', extra='_kaiser_bessel', kernel='kaiser_bessel', support=6, padding=1.25)
+    
+    def test_invert_2d_kaiser_bessel(self):
+        self.actualSetUp(zerow=True)
+        self._invert_base(context='2d', extra='_kaiser_bessel', positionthreshold=2.0, check_components=True,
+                          kernel='kaiser_bessel', support=6, padding=1.25)
+    
+    def test_invert_2d_pswf(self):
+        self.actualSetUp(zerow=True)
+        self._invert_base(context='2d', extra='_pswf', positionthreshold=2.0, check_components=True,
+                          kernel='pswf', support=4, padding=1.5)
+    
+    def test_predict_nufft(self):
+        self.actualSetUp(zerow=True)
+        self._predict_base(context='nufft')
+    
+    def test_invert_nufft(self):
+        self.actualSetUp(zerow=True)
+        self._invert_base(context='nufft', positionthreshold=2.0, check_components=True)
+    
+    def test_predict_idg(self):
+        self.actualSetUp()
+        self._predict_base(context='idg', subgrid_size=64)
+    
+    def test_invert_idg(self):
+        self.actualSetUp()
+        self._invert_base(context='idg', positionthreshold=2.0, check_components=True, subgrid_size=64)
+    
     def test_invert_facets(self):
         self.actualSetUp()
         self._invert_base(context='facets', positionthreshold=2.0, check_components=True, facets=8)
@@ -239,6 +308,58 @@ class TestImaging(unittest.TestCase):
         self._invert_base(context='facets', extra='_wprojection', check_components=True,
                           positionthreshold=2.0, wstep=10.0, oversampling=2, facets=4)
     
+    def test_invert_facets_batched(self):
+        self.actualSetUp()
+        self._invert_base(context='facets_batched', positionthreshold=2.0, check_components=True, facets=8)
+    
+    def test_invert_facets_batched_wprojection(self):
+        self.actualSetUp()
+        self._invert_base(context='facets_batched', extra='_wprojection', check_components=True,
+                          positionthreshold=2.0, wstep=10.0, oversampling=2, facets=4)
+    
+    def test_invert_facets_batched_same(self):
+        self.actualSetUp()
+        for kwargs in [{}, {'wstep': 10.0, 'oversampling': 2}]:
+            dirty = [arlexecute.compute(invert_component(self.vis_list, self.model_graph, context=context, facets=4,
+                                                         **kwargs)[0], sync=True)
+                     for context in ['facets', 'facets_batched']]
+            numpy.testing.assert_allclose(dirty[1][0].data, dirty[0][0].data,
+                                          atol=1e-12 * numpy.max(numpy.abs(dirty[0][0].data)))
+    
+    def test_weight_component_merged_density_grids(self):
+        self.actualSetUp(freqwin=3)
+        vis_list = arlexecute.compute(self.vis_list, sync=True)
+        model_list = len(vis_list) * [self.model]
+        # The merged density grid weights the windows as one data set
+        allvis = concatenate_visibility([copy_visibility(vis) for vis in vis_list], sort=False)
+        allvis, _, _ = weight_visibility(allvis, self.model, weighting='uniform', imaging_weight_cache=False)
+        weighted = weight_component([copy_visibility(vis) for vis in vis_list], model_list, weighting='uniform',
+                                    merge_density_grids=True)
+        weighted = arlexecute.compute(weighted, sync=True)
+        separate = arlexecute.compute(weight_component(vis_list, model_list, weighting='uniform'), sync=True)
+        start = 0
+        for vis, separatevis in zip(weighted, separate):
+            numpy.testing.assert_allclose(vis.imaging_weight, allvis.imaging_weight[start:start + vis.nvis],
+                                          rtol=1e-12)
+            assert not numpy.allclose(vis.imaging_weight, separatevis.imaging_weight)
+            start += vis.nvis
+        assert start == allvis.nvis
+    
+    def test_invert_psf_component(self):
+        self.actualSetUp()
+        for context, kwargs in [('2d', {}), ('2d', {'wstep': 10.0, 'oversampling': 2}), ('wstack', {'vis_slices': 11}),
+                                ('wstack_planes', {'vis_slices': 11})]:
+            dirty_list, psf_list = invert_psf_component(self.vis_list, self.model_graph, context=context, **kwargs)
+            dirty, psf = arlexecute.compute([dirty_list[0], psf_list[0]], sync=True)
+            refdirty = arlexecute.compute(invert_component(self.vis_list, self.model_graph, context=context,
+                                                           **kwargs)[0], sync=True)
+            refpsf = arlexecute.compute(invert_component(self.vis_list, self.model_graph, context=context, dopsf=True,
+                                                         **kwargs)[0], sync=True)
+            numpy.testing.assert_allclose(dirty[0].data, refdirty[0].data,
+                                          atol=1e-12 * numpy.max(numpy.abs(refdirty[0].data)))
+            numpy.testing.assert_allclose(psf[0].data, refpsf[0].data, atol=1e-12)
+            numpy.testing.assert_allclose(psf[1], refpsf[1])
+    
     @unittest.skip("Correcting twice?")
     def test_invert_facets_wstack(self):
         self.actualSetUp()
@@ -278,6 +399,19 @@ class TestImaging(unittest.TestCase):
         self._invert_base(context='wstack', extra='_spectral_pol', positionthreshold=2.0,
                           vis_slices=41)
     
+    def test_invert_wstack_planes(self):
+        self.actualSetUp()
+        self._invert_base(context='wstack_planes', positionthreshold=1.0, vis_slices=41)
+    
+    def test_invert_wstack_planes_wprojection(self):
+        self.actualSetUp()
+        self._invert_base(context='wstack_planes', extra='_wprojection', positionthreshold=1.0, wstep=2.5,
+                          vis_slices=11, oversampling=2)
+    
+    def test_invert_wstack_planes_spectral_pol(self):
+        self.actualSetUp(dospectral=True, dopol=True)
+        self._invert_base(context='wstack_planes', extra='_spectral_pol', positionthreshold=2.0, vis_slices=41)
+    
     def test_weighting(self):
         
         self.actualSetUp()
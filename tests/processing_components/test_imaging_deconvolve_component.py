@@ -14,9 +14,9 @@ from astropy.coordinates import SkyCoord
 from data_models.polarisation import PolarisationFrame
 
 from processing_components.imaging.imaging_components import invert_component, deconvolve_component, \
-    residual_component, restore_component
+    residual_component, restore_component, invert_mfs_component, deconvolve_mfs_component, mfs_reference_frequency
 from processing_components.component_support.arlexecute import arlexecute
-from processing_components.image.operations import export_image_to_fits, smooth_image
+from processing_components.image.operations import export_image_to_fits, smooth_image, qa_image
 from processing_components.imaging.base import predict_skycomponent_visibility
 from processing_components.skycomponent.operations import insert_skycomponent
 from processing_components.util.testing_support import create_named_configuration, ingest_unittest_visibility, \
@@ -170,6 +170,38 @@ class TestImagingDeconvolveGraph(unittest.TestCase):
         export_image_to_fits(restored, '%s/test_imaging_%s_overlap_mmclean_restored.fits'
                              % (self.dir, arlexecute.type()))
 
+    
+    def test_deconvolve_and_restore_mfs(self):
+        self.actualSetUp(add_errors=True)
+        reference_frequency = mfs_reference_frequency(arlexecute.compute(self.vis_list, sync=True))
+        dirty, psf = invert_mfs_component(self.vis_list, self.model_imagelist, nmoments=3,
+                                          reference_frequency=reference_frequency, withpsf=True, context='2d')
+        dirty_moments, psf_moments = arlexecute.compute([dirty, psf], sync=True)
+        assert dirty_moments[0].wcs.wcs.ctype[3] == 'MOMENT'
+        assert dirty_moments[0].shape[0] == 3
+        assert psf_moments[0].shape[0] == 6
+        
+        dec_imagelist = deconvolve_mfs_component(dirty, psf, self.model_imagelist, reference_frequency, niter=1000,
+                                                 fractional_threshold=0.01, scales=[0, 3, 10],
+                                                 algorithm='msmfsclean', threshold=0.1, gain=0.7)
+        residual_imagelist = residual_component(self.vis_list, model_imagelist=dec_imagelist, context='2d')
+        restored = restore_component(model_imagelist=dec_imagelist,
+                                     psf_imagelist=len(dec_imagelist) * [psf],
+                                     residual_imagelist=residual_imagelist)[0]
+        
+        restored, residual_imagelist = arlexecute.compute([restored, residual_imagelist], sync=True)
+        
+        export_image_to_fits(restored, '%s/test_imaging_%s_mfs_restored.fits' % (self.dir, arlexecute.type()))
+        
+        # The brightest component is at the phase centre
+        qa = qa_image(restored)
+        assert numpy.abs(qa.data['max'] - 115.5) < 1.0, str(qa)
+        peak = numpy.unravel_index(numpy.argmax(restored.data), restored.shape)
+        assert peak[2:] == (self.npixel // 2, self.npixel // 2), str(peak)
+        for residual, _ in residual_imagelist:
+            qa = qa_image(residual)
+            assert qa.data['rms'] < 12.0, str(qa)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -11,7 +11,11 @@ from astropy.coordinates import SkyCoord
 
 from data_models.polarisation import PolarisationFrame
 
-from libs.imaging.imaging_params import get_frequency_map, w_kernel_list
+import libs.imaging.imaging_params
+from libs.imaging.imaging_params import get_frequency_map, w_kernel_list, get_gridding_plan, \
+    clear_gridding_plan_cache, clear_w_kernel_cache, get_w_screens, clear_w_screen_cache, gridding_plan_cache_nbytes
+from libs.fourier_transforms.nufft import NUFFTPlan
+from libs.image.operations import create_w_term_like
 
 from processing_components.util.testing_support import create_named_configuration, create_low_test_image_from_gleam
 from processing_components.visibility.base import create_visibility
@@ -93,6 +97,102 @@ class TestImagingParams(unittest.TestCase):
                                                     wstep=50, oversampling=3,
                                                     maxsupport=128)
 
+    def test_w_kernel_list_cache(self):
+        clear_w_kernel_cache()
+        kernel_indices, kernels = w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50, oversampling=2)
+        # Second call: the kernels come from the memory cache
+        cached_indices, cached_kernels = w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50,
+                                                       oversampling=2)
+        assert numpy.all(cached_indices == kernel_indices)
+        assert all(ck is k for ck, k in zip(cached_kernels, kernels))
+        assert not kernels[0].flags.writeable
+        # Different parameters: new kernels
+        _, other_kernels = w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=25, oversampling=2)
+        assert len(other_kernels) != len(kernels)
+        # On-disk cache survives clearing the memory cache
+        cache_dir = "%s/test_w_kernel_list_cache" % self.dir
+        w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50, oversampling=2, w_kernel_cache=False)
+        w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50, oversampling=2,
+                      w_kernel_cache_dir=cache_dir)
+        clear_w_kernel_cache()
+        _, disk_kernels = w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50, oversampling=2,
+                                        w_kernel_cache_dir=cache_dir)
+        for dk, k in zip(disk_kernels, kernels):
+            numpy.testing.assert_array_equal(dk, k)
+        
+    def test_w_kernel_list_processes(self):
+        _, kernels = w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50, oversampling=2,
+                                   w_kernel_cache=False)
+        _, pkernels = w_kernel_list(self.vis, self.model, kernelwidth=16, wstep=50, oversampling=2,
+                                    w_kernel_cache=False, w_kernel_processes=2)
+        for pk, k in zip(pkernels, kernels):
+            numpy.testing.assert_array_equal(pk, k)
+
+    def test_get_gridding_plan(self):
+        clear_gridding_plan_cache()
+        _, _, plan = get_gridding_plan(self.vis, self.model)
+        assert plan.shape == (self.model.nchan, self.model.npol, 2 * 128, 2 * 128)
+        assert plan.nvis == self.vis.nvis
+        assert plan.padding == 2
+        # Same uvw and image: the plan comes from the cache
+        _, _, cached_plan = get_gridding_plan(self.vis, self.model)
+        assert cached_plan is plan
+        # Different gridding parameters: a new plan
+        _, _, other_plan = get_gridding_plan(self.vis, self.model, oversampling=4)
+        assert other_plan is not plan
+        # Changed uvw: a new plan
+        self.vis.data['uvw'][..., 2] *= 0.5
+        _, _, changed_plan = get_gridding_plan(self.vis, self.model)
+        assert changed_plan is not plan
+        _, _, uncached_plan = get_gridding_plan(self.vis, self.model, gridding_plan_cache=False)
+        assert uncached_plan is not changed_plan
+    
+    def test_get_gridding_plan_kernel_family(self):
+        clear_gridding_plan_cache()
+        _, gcf, plan = get_gridding_plan(self.vis, self.model, kernel='kaiser_bessel', support=6, padding=1.25)
+        # The kernel family is evaluated at each visibility
+        assert isinstance(plan, NUFFTPlan)
+        assert plan.shape == (self.model.nchan, self.model.npol, 160, 160)
+        assert gcf.shape == (160, 160)
+        # With w projection the kernel tables are used
+        _, _, wplan = get_gridding_plan(self.vis, self.model, kernel='kaiser_bessel', support=6, padding=1.25,
+                                        wstep=50.0)
+        assert not isinstance(wplan, NUFFTPlan)
+
+    def test_gridding_plan_cache_bytes(self):
+        clear_gridding_plan_cache()
+        _, _, plan = get_gridding_plan(self.vis, self.model)
+        nbytes = gridding_plan_cache_nbytes()
+        assert nbytes >= plan.corner.nbytes
+        # The sparse operator is built lazily and counts towards the limit
+        operator = plan.sparse_operator('complex')
+        assert gridding_plan_cache_nbytes() >= nbytes + operator.data.nbytes
+        max_bytes = libs.imaging.imaging_params.gridding_plan_cache_max_bytes
+        try:
+            libs.imaging.imaging_params.gridding_plan_cache_max_bytes = gridding_plan_cache_nbytes() + 1
+            _, _, other_plan = get_gridding_plan(self.vis, self.model, oversampling=4)
+            # Over the limit: the least recently used plan is removed and its caches released
+            assert get_gridding_plan(self.vis, self.model)[2] is not plan
+            assert len(plan._sparse) == 0
+        finally:
+            libs.imaging.imaging_params.gridding_plan_cache_max_bytes = max_bytes
+    
+    def test_get_w_screens(self):
+        clear_w_screen_cache()
+        w = numpy.linspace(-100.0, 100.0, 21)
+        screens = get_w_screens(self.model, w)
+        assert len(screens) == len(w)
+        for wk, screen in zip(w, screens):
+            numpy.testing.assert_allclose(screen, create_w_term_like(self.model, wk).data[0, 0], atol=1e-13)
+            assert not screen.flags.writeable
+        # Same image geometry and w: the screens come from the cache
+        assert get_w_screens(self.model, w) is screens
+        assert get_w_screens(self.model, w[:-1]) is not screens
+        # Without the cache the screens are generated one at a time
+        uncached = get_w_screens(self.model, w, w_screen_cache=False)
+        assert not isinstance(uncached, list)
+        numpy.testing.assert_allclose(next(uncached), screens[0])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -147,6 +147,26 @@ class TestPipelineGraphs(unittest.TestCase):
         assert numpy.abs(qa.data['max'] - 116.9) < 1.0, str(qa)
         assert numpy.abs(qa.data['min'] + 0.118) < 1.0, str(qa)
     
+    def test_continuum_imaging_pipeline_mfs(self):
+        self.actualSetUp(add_errors=False, block=True)
+        continuum_imaging_list = \
+            continuum_imaging_component(self.vis_list, model_imagelist=self.model_imagelist, context='2d',
+                                        algorithm='msmfsclean', mfs=True, facets=1,
+                                        scales=[0, 3, 10],
+                                        niter=1000, fractional_threshold=0.1,
+                                        nmoments=2, nchan=self.freqwin,
+                                        threshold=2.0, nmajor=5, gain=0.1)
+        clean, residual, restored = arlexecute.compute(continuum_imaging_list, sync=True)
+        export_image_to_fits(clean[0], '%s/test_pipelines_continuum_imaging_pipeline_mfs_clean.fits' % self.dir)
+        export_image_to_fits(residual[0][0],
+                             '%s/test_pipelines_continuum_imaging_pipeline_mfs_residual.fits' % self.dir)
+        export_image_to_fits(restored[0],
+                             '%s/test_pipelines_continuum_imaging_pipeline_mfs_restored.fits' % self.dir)
+        
+        qa = qa_image(restored[0])
+        assert numpy.abs(qa.data['max'] - 116.9) < 1.0, str(qa)
+        assert numpy.abs(qa.data['min'] + 0.118) < 1.0, str(qa)
+    
     def test_ical_pipeline(self):
         amp_errors = {'T': 0.0, 'G': 0.00, 'B': 0.0}
         phase_errors = {'T': 0.1, 'G': 0.0, 'B': 0.0}
@@ -182,6 +202,36 @@ class TestPipelineGraphs(unittest.TestCase):
         assert numpy.abs(qa.data['max'] - 116.9) < 1.0, str(qa)
         assert numpy.abs(qa.data['min'] + 0.118) < 1.0, str(qa)
 
+    
+    def test_ical_pipeline_mfs(self):
+        amp_errors = {'T': 0.0, 'G': 0.00, 'B': 0.0}
+        phase_errors = {'T': 0.1, 'G': 0.0, 'B': 0.0}
+        self.actualSetUp(add_errors=True, block=True, amp_errors=amp_errors, phase_errors=phase_errors)
+        
+        controls = create_calibration_controls()
+        
+        controls['T']['first_selfcal'] = 1
+        controls['T']['timescale'] = 'auto'
+        
+        ical_list = \
+            ical_component(self.vis_list, model_imagelist=self.model_imagelist, context='2d',
+                           calibration_context='T', controls=controls, do_selfcal=True,
+                           global_solution=False,
+                           algorithm='msmfsclean', mfs=True,
+                           facets=1,
+                           scales=[0, 3, 10],
+                           niter=1000, fractional_threshold=0.1,
+                           nmoments=2, nchan=self.freqwin,
+                           threshold=2.0, nmajor=5, gain=0.1)
+        clean, residual, restored = arlexecute.compute(ical_list, sync=True)
+        export_image_to_fits(clean[0], '%s/test_pipelines_ical_pipeline_mfs_clean.fits' % self.dir)
+        export_image_to_fits(residual[0][0], '%s/test_pipelines_ical_pipeline_mfs_residual.fits' % self.dir)
+        export_image_to_fits(restored[0], '%s/test_pipelines_ical_pipeline_mfs_restored.fits' % self.dir)
+        
+        qa = qa_image(restored[0])
+        assert numpy.abs(qa.data['max'] - 116.9) < 1.0, str(qa)
+        assert numpy.abs(qa.data['min'] + 0.118) < 1.0, str(qa)
+
 
 if __name__ == '__main__':
     unittest.main()
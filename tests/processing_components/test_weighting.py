@@ -18,8 +18,11 @@ from processing_components.image.operations import export_image_to_fits
 from processing_components.imaging.base import invert_2d
 from processing_components.imaging.base import create_image_from_visibility
 from processing_components.imaging.weighting import weight_visibility, taper_visibility_gaussian, taper_visibility_tukey
+from processing_components.imaging.weighting import density_grid_visibility, clear_imaging_weight_cache, \
+    imaging_weight_cache_nbytes
+import processing_components.imaging.weighting
 from processing_components.util.testing_support import create_named_configuration
-from processing_components.visibility.base import create_visibility
+from processing_components.visibility.base import create_visibility, create_visibility_from_rows
 
 log = logging.getLogger(__name__)
 
@@ -86,6 +89,65 @@ class TestWeighting(unittest.TestCase):
         assert density is None
         assert densitygrid is None
 
+    def test_weighting_briggs(self):
+        self.actualSetUp()
+        uniform = weight_visibility(self.componentvis, self.model, weighting='uniform')[0].imaging_weight.copy()
+        for weighting in ['briggs', 'super-briggs']:
+            vis, density, densitygrid = weight_visibility(self.componentvis, self.model, weighting=weighting,
+                                                          robustness=0.0)
+            assert numpy.all(vis.imaging_weight <= self.componentvis.weight)
+            assert numpy.all(vis.imaging_weight > 0.0)
+        natural = weight_visibility(self.componentvis, self.model, weighting='briggs', robustness=5.0)[0]
+        numpy.testing.assert_allclose(natural.imaging_weight, self.componentvis.weight, rtol=1e-3)
+        vis, density, densitygrid = weight_visibility(self.componentvis, self.model, weighting='super-uniform')
+        assert densitygrid.shape[-1] < self.model.shape[-1]
+        assert numpy.all(density >= 1.0 / uniform[uniform > 0.0].max())
+    
+    def test_weighting_cache(self):
+        self.actualSetUp()
+        clear_imaging_weight_cache()
+        vis, density, densitygrid = weight_visibility(self.componentvis, self.model, weighting='uniform')
+        weights = vis.imaging_weight.copy()
+        vis.data['imaging_weight'][...] = 0.0
+        # Same uvw, weights and image: the weights come from the cache
+        cached, cached_density, cached_densitygrid = weight_visibility(vis, self.model, weighting='uniform')
+        assert cached_densitygrid is densitygrid
+        numpy.testing.assert_array_equal(cached.imaging_weight, weights)
+        # Flagging changes the weights
+        vis.data['weight'][0, ...] = 0.0
+        flagged, _, flagged_densitygrid = weight_visibility(vis, self.model, weighting='uniform')
+        assert flagged_densitygrid is not densitygrid
+        assert flagged.imaging_weight[0, 0] == 0.0
+        _, _, uncached_densitygrid = weight_visibility(vis, self.model, weighting='uniform', imaging_weight_cache=False)
+        assert uncached_densitygrid is not flagged_densitygrid
+    
+    def test_weighting_cache_bytes(self):
+        self.actualSetUp()
+        clear_imaging_weight_cache()
+        vis, density, densitygrid = weight_visibility(self.componentvis, self.model, weighting='uniform')
+        nbytes = imaging_weight_cache_nbytes()
+        assert nbytes == vis.imaging_weight.nbytes + density.nbytes + densitygrid.nbytes
+        max_bytes = processing_components.imaging.weighting.imaging_weight_cache_max_bytes
+        try:
+            processing_components.imaging.weighting.imaging_weight_cache_max_bytes = nbytes + 1
+            # Over the limit: the least recently used weights are removed
+            _, _, other_densitygrid = weight_visibility(self.componentvis, self.model, weighting='super-uniform')
+            assert imaging_weight_cache_nbytes() < 2 * nbytes
+            assert weight_visibility(self.componentvis, self.model, weighting='uniform')[2] is not densitygrid
+        finally:
+            processing_components.imaging.weighting.imaging_weight_cache_max_bytes = max_bytes
+    
+    def test_weighting_merged_density_grids(self):
+        self.actualSetUp()
+        ref = weight_visibility(self.componentvis, self.model, weighting='uniform')[0].imaging_weight.copy()
+        # The density grids of parts of the data sum to the density grid of all of it
+        parts = [self.componentvis.time < 0.0, self.componentvis.time >= 0.0]
+        visparts = [create_visibility_from_rows(self.componentvis, rows) for rows in parts]
+        densitygrid = sum(density_grid_visibility(vis, self.model, weighting='uniform') for vis in visparts)
+        for rows, vis in zip(parts, visparts):
+            vis, _, _ = weight_visibility(vis, self.model, weighting='uniform', densitygrid=densitygrid)
+            numpy.testing.assert_allclose(vis.imaging_weight, ref[rows], rtol=1e-12)
+    
     def test_tapering_Gaussian(self):
         self.actualSetUp()
         size_required = 0.01